@@ -1,3 +1,15 @@
-from .domain import *
-from .app import *
 from .cli import *
+
+
+def __getattr__(name: str):
+    # the domain and application modules import zensols.nlp and zensols.amr
+    # (and in turn spaCy), so import them only when one of their classes is
+    # first used rather than each time the command line starts
+    import importlib
+    if not name.startswith('_'):
+        mod_name: str
+        for mod_name in ('domain', 'app'):
+            mod = importlib.import_module(f'.{mod_name}', __name__)
+            if hasattr(mod, name):
+                return getattr(mod, name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
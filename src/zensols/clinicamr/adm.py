@@ -3,10 +3,15 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import List, Dict, Set, Iterable, Union
+from typing import List, Tuple, Dict, Set, FrozenSet, Iterable, Union, Optional
 from dataclasses import dataclass, field
+import sys
+import os
 import logging
-from zensols.persist import ReadOnlyStash
+import threading
+import itertools as it
+from zensols.persist import Stash, ReadOnlyStash, FactoryStash
+from zensols.multi import MultiProcessFactoryStash
 from zensols.mimic import MimicError, Section, Note, HospitalAdmission
 from zensols.mimic import Corpus as MimicCorpus
 from zensols.mimic.regexnote import DischargeSummaryNote
@@ -14,9 +19,13 @@ from zensols.amr import (
     AmrFeatureSentence, AmrFeatureDocument, AmrSentence, AmrDocument
 )
 from zensols.amr.annotate import AnnotationFeatureDocumentParser
+from .instrument import PipelineInstrument
+from .coref import NoteBlockCoreference
+from .index import AdmissionCorpusIndex
+from .parafac import ClinicAmrParagraphFactory
 from .domain import (
-    _ParagraphIndex, _SectionIndex, _NoteIndex, ParseFailure,
-    AdmissionAmrFeatureDocument
+    ClinicAmrError, _ParagraphIndex, _SectionIndex, _NoteIndex, ParseFailure,
+    CacheFingerprint, AdmissionBuildInfo, AdmissionAmrFeatureDocument
 )
 
 logger = logging.getLogger(__name__)
@@ -26,6 +35,12 @@ logger = logging.getLogger(__name__)
 class AdmissionAmrFactoryStash(ReadOnlyStash):
     """A stash that CRUDs instances of :obj:`.AdmissionAmrFeatureDocument`.
 
+    Admissions can be loaded from several threads at once.  Reads of the
+    :obj:`corpus` database are serialized, as are calls to the annotator's
+    coreference resolver, which is not known to be reentrant.  The paragraphs
+    of the admission, which take most of the time, are parsed concurrently
+    (see :class:`~zensols.clinicamr.parafac.ClinicAmrParagraphFactory`).
+
     """
     corpus: MimicCorpus = field()
     """The MIMIC-III corpus."""
@@ -41,8 +56,35 @@ class AdmissionAmrFactoryStash(ReadOnlyStash):
     keep_summary_sections: Union[List[str], Set[str]] = field()
     """The sections to keep in each clinical note.  The rest are filtered."""
 
+    instrument: PipelineInstrument = field(default_factory=PipelineInstrument)
+    """Records the time spent on coreference resolution."""
+
+    coref_mode: str = field(default='admission')
+    """Either ``admission`` to resolve coreferences over all sentences of the
+    admission at once, or ``note`` to resolve them by note with
+    :obj:`coref_blocks`.
+
+    """
+    coref_blocks: NoteBlockCoreference = field(
+        default_factory=NoteBlockCoreference)
+    """Resolves coreferences by note when :obj:`coref_mode` is ``note``."""
+
+    corpus_index: AdmissionCorpusIndex = field(default=None)
+    """The index of sections, note categories and concepts updated with each
+    created admission, or ``None`` to not index.
+
+    """
+    paragraph_factory: ClinicAmrParagraphFactory = field(default=None)
+    """The factory that creates the admission's paragraphs, whose
+    :obj:`~.ClinicAmrParagraphFactory.fingerprint` is kept with each admission
+    so it is rebuilt when the paragraph configuration changes, or ``None`` to
+    only rebuild on selection changes.
+
+    """
     def __post_init__(self):
         super().__post_init__()
+        self._corpus_lock = threading.RLock()
+        self._coref_lock = threading.Lock()
         if self.keep_notes is not None and not isinstance(self.keep_notes, set):
             self.keep_notes = frozenset(self.keep_notes)
         if self.keep_summary_sections is not None and \
@@ -51,7 +93,8 @@ class AdmissionAmrFactoryStash(ReadOnlyStash):
 
     def _load_note(self, note: Note, include_sections: Set[str],
                    sents: List[AmrFeatureSentence],
-                   fails: List[ParseFailure]) -> _NoteIndex:
+                   fails: List[ParseFailure],
+                   para_keys: List[str]) -> _NoteIndex:
         """Index a note and track its sentences as section and paragraph levels.
 
         :param note: the note to create
@@ -62,6 +105,8 @@ class AdmissionAmrFactoryStash(ReadOnlyStash):
 
         :param fails: a list of sentences with a failed AMR parse
 
+        :param para_keys: the list to populate with the paragraph keys
+
         :return: a note, section and paragraph level index
 
         """
@@ -78,6 +123,9 @@ class AdmissionAmrFactoryStash(ReadOnlyStash):
             pix: int
             for pix, para in enumerate(sec.paragraphs):
                 para_begin: int = len(sents)
+                key: str = ClinicAmrParagraphFactory.get_cache_key(para)
+                para_keys.append(
+                    f'{note.row_id}-{sec.id}-{pix}' if key is None else key)
                 assert isinstance(para, AmrFeatureDocument)
                 assert isinstance(para.amr, AmrDocument)
                 # each sentence is added to be retrieved in domain class indexes
@@ -104,47 +152,56 @@ class AdmissionAmrFactoryStash(ReadOnlyStash):
             category=note.id.replace('-', ' '),
             secs=tuple(sec_ixs))
 
-    def load(self, name: str) -> AdmissionAmrFeatureDocument:
-        """Load an admission from the MIMIC-III package and parse it for
-        language and AMRs.
+    def _get_selection(self) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """Return the note categories and sections kept in admissions."""
+        return tuple(map(lambda s: None if s is None else frozenset(s),
+                         (self.keep_notes, self.keep_summary_sections)))
 
-        :param name: the MIMIC-III admission ID
+    def _get_fingerprint(self) -> CacheFingerprint:
+        """Return the configuration of the admission's paragraphs."""
+        if self.paragraph_factory is not None:
+            return self.paragraph_factory.fingerprint
 
-        :return: the parsed admission
+    def _assemble(self, name: str) -> AdmissionAmrFeatureDocument:
+        """Create an admission document from its (possibly cached) paragraphs
+        without resolving coreferences.
 
         """
-        if logger.isEnabledFor(logging.INFO):
-            logger.info(f'loading admission: {name}...')
         # MIMIC components index admissions and notes by ints
         hadm_id = int(name)
-        if not self.exists(hadm_id):
+        ds_cat: str = DischargeSummaryNote.CATEGORY
+        with self._corpus_lock:
+            if not self.exists(hadm_id):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'no admission: {hadm_id}')
+                return None
+            adm: HospitalAdmission = self.corpus.get_hospital_adm_by_id(
+                hadm_id)
             if logger.isEnabledFor(logging.DEBUG):
-                logger.debug(f'no admission: {hadm_id}')
-            return None
-        notes: List[_NoteIndex] = []
+                logger.debug(f'admin retrieved: {adm}')
+            by_cat: Dict[str, List[int]] = self.corpus.note_event_persister.\
+                get_row_ids_by_category(int(hadm_id), self.keep_notes)
+            ds_notes: List[int] = by_cat[ds_cat]
+            if len(ds_notes) == 0:
+                raise MimicError(
+                    f'No discharge sumamries for admission: {adm.hadm_id}')
+            # take only the most recent (sorted in DB layer)
+            ds_note: Note = adm[ds_notes[0]]
+            ant_notes: List[Note] = []
+            cat: str
+            row_ids: List[int]
+            for cat, row_ids in by_cat.items():
+                if cat != ds_cat:
+                    ant_notes.extend(map(
+                        lambda i: adm[str(i)], sorted(row_ids)))
         sents: List[AmrFeatureSentence] = []
         fails: List[ParseFailure] = []
-        adm: HospitalAdmission = self.corpus.get_hospital_adm_by_id(hadm_id)
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug(f'admin retrieved: {adm}')
-        ds_cat: str = DischargeSummaryNote.CATEGORY
-        by_cat: Dict[str, List[int]] = self.corpus.note_event_persister.\
-            get_row_ids_by_category(int(hadm_id), self.keep_notes)
-        ds_notes: List[int] = by_cat[ds_cat]
-        if len(ds_notes) == 0:
-            raise MimicError(
-                f'No discharge sumamries for admission: {adm.hadm_id}')
-        # take only the most recent (sorted in DB layer)
-        ds_note: Note = adm[ds_notes[0]]
+        para_keys: List[str] = []
         ds_ix: _NoteIndex = self._load_note(
-            ds_note, self.keep_summary_sections, sents, fails)
-        cat: str
-        row_ids: List[int]
-        for cat, row_ids in by_cat.items():
-            if cat != ds_cat:
-                notes.extend(map(
-                    lambda i: self._load_note(adm[str(i)], None, sents, fails),
-                    sorted(row_ids)))
+            ds_note, self.keep_summary_sections, sents, fails, para_keys)
+        notes: List[_NoteIndex] = list(map(
+            lambda n: self._load_note(n, None, sents, fails, para_keys),
+            ant_notes))
         if logger.isEnabledFor(logging.INFO):
             logger.info(f'parsed {len(sents)} sentences not including ' +
                         f'{len(fails)} AMR parse failures')
@@ -154,17 +211,218 @@ class AdmissionAmrFactoryStash(ReadOnlyStash):
             hadm_id=adm.hadm_id,
             _ds_ix=ds_ix,
             _ant_ixs=tuple(notes),
-            parse_fails=fails)
+            parse_fails=tuple(fails),
+            build_info=AdmissionBuildInfo(
+                *self._get_selection(), para_keys=tuple(para_keys),
+                fingerprint=self._get_fingerprint()))
         doc.amr.reindex_variables()
-        if self.amr_annotator.coref_resolver is not None:
+        return doc
+
+    def _index(self, doc: AdmissionAmrFeatureDocument):
+        if self.corpus_index is not None:
+            with self.instrument.measure('index'):
+                self.corpus_index.add(doc)
+
+    def _resolve_coref(self, doc: AdmissionAmrFeatureDocument):
+        resolver = self.amr_annotator.coref_resolver
+        if resolver is not None:
             logger.info('resolving coreferences...')
-            self.amr_annotator.coref_resolver(doc)
+            with self._coref_lock, self.instrument.measure('coref'):
+                if self.coref_mode == 'note':
+                    self.coref_blocks.resolve(resolver, doc)
+                elif self.coref_mode == 'admission':
+                    resolver(doc)
+                else:
+                    raise ClinicAmrError(
+                        f'Unknown coreference mode: {self.coref_mode}')
+
+    def load(self, name: str) -> AdmissionAmrFeatureDocument:
+        """Load an admission from the MIMIC-III package and parse it for
+        language and AMRs.
+
+        :param name: the MIMIC-III admission ID
+
+        :return: the parsed admission
+
+        """
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'loading admission: {name}...')
+        doc: AdmissionAmrFeatureDocument = self._assemble(name)
+        if doc is not None:
+            self._resolve_coref(doc)
+            self._index(doc)
         return doc
 
+    def _is_current(self, info: AdmissionBuildInfo) -> bool:
+        """Whether an admission was built with the current configuration."""
+        fp: CacheFingerprint = self._get_fingerprint()
+        return info is not None and \
+            info.is_selection(*self._get_selection()) and \
+            (fp is None or info.fingerprint == fp)
+
+    def rebuild(self, doc: AdmissionAmrFeatureDocument) -> \
+            Tuple[AdmissionAmrFeatureDocument, bool]:
+        """Bring a (cached) admission up to date with the current note and
+        section selection and paragraph configuration (see
+        :obj:`paragraph_factory`).  The admission is re-assembled from the
+        paragraph cache, so AMRs are only parsed for paragraphs not yet cached
+        or parsed with a different configuration.  Coreferences are only
+        resolved again when the admission's paragraphs or their parse
+        configuration have changed.
+
+        :param doc: an admission previously created by this instance
+
+        :return: the up to date admission and whether it changed
+
+        """
+        prev: AdmissionBuildInfo = doc.build_info
+        if self._is_current(prev):
+            return doc, False
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'rebuilding admission {doc.hadm_id} with the ' +
+                        'changed selection or paragraph configuration')
+        new_doc: AdmissionAmrFeatureDocument = self._assemble(doc.hadm_id)
+        if new_doc is None:
+            if self.corpus_index is not None:
+                self.corpus_index.delete(doc.hadm_id)
+            return None, True
+        if prev is not None and prev.para_keys == new_doc.build_info.para_keys:
+            fp: CacheFingerprint = new_doc.build_info.fingerprint
+            if prev.fingerprint == fp:
+                # same sentences, so keep the resolved coreferences
+                doc.build_info = new_doc.build_info
+                return doc, True
+            # admissions built by previous versions are assumed to have the
+            # parse configuration of the paragraph cache
+            if fp is None or prev.fingerprint is None or \
+               fp.is_parse(prev.fingerprint):
+                # only the decorations changed, which keeps the graph
+                # variables and thus the coreferences
+                new_doc.coreference_relations = doc.coreference_relations
+                self._index(new_doc)
+                return new_doc, True
+        self._resolve_coref(new_doc)
+        self._index(new_doc)
+        return new_doc, True
+
     def keys(self) -> Iterable[str]:
         # bypass cache stash
-        return map(str, self.corpus.admission_persister.get_keys())
+        with self._corpus_lock:
+            return tuple(map(
+                str, self.corpus.admission_persister.get_keys()))
 
     def exists(self, name: str) -> bool:
         # bypass cache stash
-        return self.corpus.admission_persister.exists(int(name))
+        with self._corpus_lock:
+            return self.corpus.admission_persister.exists(int(name))
+
+
+@dataclass
+class AdmissionAmrStash(FactoryStash):
+    """A factory stash that rebuilds cached admissions created with a
+    different note and section selection or paragraph configuration (see
+    :meth:`.AdmissionAmrFactoryStash.rebuild`) rather than needing the cache
+    to be cleared when they change.  Admissions cached by previous versions
+    (without build information) are rebuilt on first access.
+
+    """
+    def load_current(self, name: str) -> Optional[AdmissionAmrFeatureDocument]:
+        """Return a cached admission only if it need not be rebuilt, which
+        never parses or resolves coreferences.  Coreferences can only be
+        resolved on the main thread (see
+        :obj:`~zensols.amr.coref.CoreferenceResolver.use_multithreading`).
+
+        :return: the cached admission or ``None`` if it is not cached or must
+                 be rebuilt by :meth:`load`
+
+        """
+        doc: AdmissionAmrFeatureDocument = self.delegate.load(name)
+        if doc is not None and self.factory._is_current(doc.build_info):
+            return doc
+
+    def load(self, name: str) -> AdmissionAmrFeatureDocument:
+        doc: AdmissionAmrFeatureDocument = self.delegate.load(name)
+        if doc is None:
+            return super().load(name)
+        changed: bool
+        doc, changed = self.factory.rebuild(doc)
+        if changed:
+            if doc is None:
+                self.delegate.delete(name)
+            else:
+                self.delegate.dump(name, doc)
+        return doc
+
+
+@dataclass
+class AdmissionAmrBatchStash(MultiProcessFactoryStash):
+    """Parses admissions across a process pool and writes them to the
+    :obj:`delegate` cache stash.  Each child process creates its own
+    :class:`.AdmissionAmrFactoryStash` (and thus its own corpus and annotator)
+    from the application configuration.
+
+    Processing is resumable since admissions already in the cache are skipped
+    and admissions that fail to parse are logged without stopping the other
+    admissions in the worker's chunk.
+
+    """
+    limit: int = field(default=sys.maxsize)
+    """The maximum number of (not yet cached) admissions to parse."""
+
+    def _calculate_has_data(self) -> bool:
+        # always spawn work so partially completed runs are resumed
+        return False
+
+    def _create_data(self) -> Iterable[str]:
+        cached: Set[str] = set(self.delegate.keys())
+        keys: Iterable[str] = filter(
+            lambda k: k not in cached, self.factory.keys())
+        keys = tuple(it.islice(keys, self.limit))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'parsing {len(keys)} admissions ' +
+                        f'({len(cached)} already cached)')
+        return keys
+
+    def _flush_caches(self):
+        """Commit the batched writes of the admission and paragraph caches
+        (see :obj:`.ShardedSqliteStash.batch_size`) since child processes exit
+        without running exit handlers.
+
+        """
+        stashes: List[Stash] = [self.delegate]
+        pfac: ClinicAmrParagraphFactory = self.factory.paragraph_factory
+        if pfac is not None:
+            stashes.append(pfac.stash)
+            if pfac.failure_cache is not None:
+                stashes.append(pfac.failure_cache.stash)
+        stash: Stash
+        for stash in filter(lambda s: hasattr(s, 'flush'), stashes):
+            stash.flush()
+
+    def _process(self, chunk: List[str]) -> \
+            Iterable[Tuple[str, AdmissionAmrFeatureDocument]]:
+        pid: int = os.getpid()
+        try:
+            hadm_id: str
+            for hadm_id in chunk:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        f'parsing admission {hadm_id} in process {pid}')
+                inst: PipelineInstrument = self.factory.instrument
+                try:
+                    with inst.measure('admission'):
+                        doc: AdmissionAmrFeatureDocument = \
+                            self.factory.load(hadm_id)
+                except Exception as e:
+                    logger.exception(
+                        f'could not parse admission {hadm_id}: {e}')
+                    continue
+                finally:
+                    # measurements in child processes are only kept in the
+                    # trace
+                    inst.flush()
+                if doc is not None:
+                    yield (hadm_id, doc)
+        finally:
+            # the last admission is dumped before the generator finishes
+            self._flush_caches()
@@ -3,15 +3,20 @@
 """
 from __future__ import annotations
 __author__ = 'Paul Landes'
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Tuple, Dict, Any
 from dataclasses import dataclass, field
 import logging
+import threading
 from pathlib import Path
-import pandas as pd
 from zensols.config import ConfigFactory
-from zensols.persist import Stash
+from zensols.persist import Stash, persisted
 from zensols.cli import ApplicationError
-from zensols.nlp import FeatureToken, FeatureDocumentParser
+from .instrument import PipelineInstrument
+if TYPE_CHECKING:
+    import pandas as pd
+    from zensols.nlp import FeatureDocumentParser
+    from zensols.amr import AmrSentence
+    from zensols.amr.model import AmrGenerator
 
 logger = logging.getLogger(__name__)
 
@@ -20,23 +25,49 @@ logger = logging.getLogger(__name__)
 class Application(object):
     """Clincial Domain Abstract Meaning Representation Graphs.
 
+    The document parser and admission stash are created from
+    :obj:`config_factory` only when an action first uses them, so actions such
+    as :meth:`show_profile` do not load the parser models.
+
     """
     config_factory: ConfigFactory = field()
     """For creating app config resources."""
 
-    doc_parser: FeatureDocumentParser = field()
-    """The document parser used for the :meth:`parse` action."""
+    doc_parser_name: str = field()
+    """The section name of the document parser used for the :meth:`parse`
+    action.
 
-    adm_amr_stash: Stash = field()
-    """A stash that CRUDs instances of :class:`~.AdmissionAmrFeatureDocument`.
+    """
+    adm_amr_stash_name: str = field()
+    """The section name of the stash that CRUDs instances of
+    :class:`~.AdmissionAmrFeatureDocument`.
 
     """
     dumper: 'Dumper' = field()
     """Plots and writes AMR content in human readable formats."""
 
+    instrument: PipelineInstrument = field(default_factory=PipelineInstrument)
+    """Records the time spent in each stage of the pipeline."""
+
     def __post_init__(self):
+        from zensols.nlp import FeatureToken
         FeatureToken.WRITABLE_FEATURE_IDS = tuple('norm cui_'.split())
 
+    @property
+    @persisted('_doc_parser')
+    def doc_parser(self) -> FeatureDocumentParser:
+        """The document parser used for the :meth:`parse` action."""
+        return self.config_factory(self.doc_parser_name)
+
+    @property
+    @persisted('_adm_amr_stash')
+    def adm_amr_stash(self) -> Stash:
+        """A stash that CRUDs instances of
+        :class:`~.AdmissionAmrFeatureDocument`.
+
+        """
+        return self.config_factory(self.adm_amr_stash_name)
+
     def show_admission(self, hadm_id: str):
         """Print an admission by ID.
 
@@ -48,50 +79,226 @@ class Application(object):
         stash: AdmissionAmrFactoryStash = self.adm_amr_stash
         adm: AdmissionAmrFeatureDocument = stash.load(hadm_id)
         adm.write()
+        self._write_profile()
+
+    def _write_profile(self):
+        """Write the per stage timings if instrumentation is enabled."""
+        inst: PipelineInstrument = self.instrument
+        if inst.enabled:
+            inst.flush()
+            if inst.trace_path is not None and inst.trace_path.is_file():
+                # include the measurements of child processes
+                inst = PipelineInstrument.from_trace(
+                    inst.trace_path, inst.run_id)
+            print('profile:')
+            inst.write(1)
+
+    def index_admissions(self):
+        """Add the cached admissions to the section, note category and concept
+        index.
+
+        """
+        from .index import AdmissionCorpusIndex
+        index: AdmissionCorpusIndex = self.config_factory(
+            'camr_adm_corpus_index')
+        cache: Stash = self.adm_amr_stash.delegate
+        hadm_id: str
+        for hadm_id in cache.keys():
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f'indexing admission {hadm_id}')
+            index.add(cache.load(hadm_id))
+        print(index.get_stats())
+
+    def query_index(self, section: str = None, category: str = None,
+                    cui: str = None, limit: int = None, text: bool = False):
+        """Find admission sections or sentences in the index.
+
+        :param section: the section name (i.e. ``discharge-diagnosis``)
+
+        :param category: the note category (i.e. ``discharge-summary``)
+
+        :param cui: the concept unique identifier of sentences to find
+
+        :param limit: the maximum number of results
+
+        :param text: whether to print the sentences of each result
+
+        """
+        from .index import AdmissionSpan, AdmissionCorpusIndex
+        index: AdmissionCorpusIndex = self.config_factory(
+            'camr_adm_corpus_index')
+        spans: Tuple[AdmissionSpan, ...] = index.query(
+            sec_name=section, category=category, cui=cui, limit=limit)
+        if not text:
+            span: AdmissionSpan
+            for span in spans:
+                span.write()
+        else:
+            for span, doc in index.create_documents(
+                    spans, self.adm_amr_stash.delegate):
+                span.write()
+                doc.write(1, include_amr=False, include_normalized=False,
+                          sent_kwargs=dict(include_amr=False))
+
+    def serve(self, port: int = None):
+        """Start a local HTTP service that parses note text and admissions
+        with the models kept loaded.  Use ``CTRL-C`` to stop.
+
+        :param port: the port to listen on, which defaults to the configured
+                     ``service_port``
+
+        """
+        from .server import ParseService
+        service: ParseService = self.config_factory('camr_parse_service')
+        if port is not None:
+            service.port = port
+        service.serve()
+
+    def show_failures(self, limit: int = None):
+        """Print the paragraphs that could not be parsed and are skipped until
+        they are retried.
+
+        :param limit: the maximum number of (most recent) failures to print
+
+        """
+        from .failure import ParagraphFailureCache
+        cache: ParagraphFailureCache = self.config_factory(
+            'camr_paragraph_failure_cache')
+        cache.write(limit=limit)
+
+    def show_profile(self, trace_file: Path):
+        """Summarize the per stage timings of the last run in a trace file.
+
+        :param trace_file: the JSON lines file written by the instrumentation
+
+        """
+        if not trace_file.is_file():
+            raise ApplicationError(f'No such trace file: {trace_file}')
+        PipelineInstrument.from_trace(trace_file).write()
+
+    def parse_admissions(self, workers: int = None, limit: int = None):
+        """Parse and cache all admissions not yet cached using a process pool.
+
+        :param workers: the number of processes to use, 0 for all CPU cores, or
+                        negative to use all but that many cores
 
-    def _generate_adm(self, hadm_id: str) -> pd.DataFrame:
-        from typing import List, Dict, Any
+        :param limit: the maximum number of admissions to parse
+
+        """
+        from .adm import AdmissionAmrBatchStash
+        stash: AdmissionAmrBatchStash = self.config_factory(
+            'camr_adm_amr_batch_stash')
+        if workers is not None:
+            stash.workers = workers
+        if limit is not None:
+            stash.limit = limit
+        stash.prime()
+        self._write_profile()
+
+    def benchmark(self, output_file: Path = Path('target/bench/bench.json'),
+                  ids: str = None, notes: int = 10):
+        """Measure sentence, paragraph and admission parsing throughput and
+        memory use with cold and warm caches.
+
+        :param output_file: the JSON results file
+
+        :param ids: a comma separated list of admission IDs used to benchmark
+                    the paragraph and admission stages
+
+        :param notes: the number of synthetic notes used to benchmark the
+                      parser
+
+        """
+        from .bench import Benchmark, BenchmarkResult
+        bench: Benchmark = self.config_factory('camr_benchmark')
+        bench.n_notes = notes
+        if ids is not None:
+            bench.hadm_ids = tuple(ids.split(','))
+        results: Tuple[BenchmarkResult, ...] = bench.run()
+        bench.write_json(results, output_file)
+        res: BenchmarkResult
+        for res in results:
+            print(res)
+        logger.info(f'wrote: {output_file}')
+
+    def _get_generate_sents(self, hadm_id: str, stash: Stash,
+                            corpus_lock: threading.Lock) -> \
+            Tuple[List[Tuple[Any, ...]], List[AmrSentence]]:
+        """Parse the discharge summary of an admission and return the sentences
+        to generate.
+
+        :param stash: the MIMIC-III corpus admission stash
+
+        :param corpus_lock: serializes reads of the corpus database, which is
+                            not thread safe, while the paragraphs are parsed
+                            concurrently
+
+        :return: the output row data (without generated text) and the AMR
+                 sentences used to generate each
+
+        """
         from zensols.mimic import Section, Note, HospitalAdmission
         from zensols.mimic.regexnote import DischargeSummaryNote
-        from zensols.amr import (
-            AmrFeatureSentence, AmrFeatureDocument,
-            AmrGeneratedSentence, AmrGeneratedDocument,
-        )
-        from zensols.amr.model import AmrGenerator
+        from zensols.amr import AmrFeatureSentence, AmrFeatureDocument
 
         if logger.isEnabledFor(logging.INFO):
-            logger.info(f'generating admission {hadm_id}')
-        generator: AmrGenerator = self.config_factory('amr_generator_amrlib')
-        stash: Stash = self.config_factory('mimic_corpus').hospital_adm_stash
-        adm: HospitalAdmission = stash[hadm_id]
-        by_cat: Dict[str, Tuple[Note]] = adm.notes_by_category
-        ds_notes: Tuple[Note] = by_cat[DischargeSummaryNote.CATEGORY]
-        if len(ds_notes) == 0:
-            raise ApplicationError(
-                f'No discharge sumamries for admission: {hadm_id}')
-        ds_notes = sorted(ds_notes, key=lambda n: n.chartdate, reverse=True)
-        ds_note: Note = ds_notes[0]
+            logger.info(f'parsing admission {hadm_id}')
+        with corpus_lock:
+            adm: HospitalAdmission = stash[hadm_id]
+            by_cat: Dict[str, Tuple[Note]] = adm.notes_by_category
+            ds_notes: Tuple[Note] = by_cat[DischargeSummaryNote.CATEGORY]
+            if len(ds_notes) == 0:
+                raise ApplicationError(
+                    f'No discharge sumamries for admission: {hadm_id}')
+            ds_notes = sorted(
+                ds_notes, key=lambda n: n.chartdate, reverse=True)
+            ds_note: Note = ds_notes[0]
         if logger.isEnabledFor(logging.INFO):
             logger.info(f'generating from note {ds_note}')
         rows: List[Tuple[Any, ...]] = []
-        cols: List[str] = 'hadm_id note_id sec_id sec_name org gen'.split()
+        sents: List[AmrSentence] = []
         sec: Section
         for sec in ds_note.sections.values():
             if logger.isEnabledFor(logging.INFO):
                 logger.info(
-                    f'generating sentences for section {sec.name} ({sec.id})')
+                    f'parsing sentences for section {sec.name} ({sec.id})')
             para: AmrFeatureDocument
             for para in sec.paragraphs:
-                gen_para: AmrGeneratedDocument = generator(para.amr)
-                assert len(gen_para) == len(para)
                 sent: AmrFeatureSentence
-                gen_sent: AmrGeneratedSentence
-                for sent, gen_sent in zip(para, gen_para):
+                for sent in para:
                     rows.append((hadm_id, ds_note.row_id, sec.id, sec.name,
-                                 sent.norm, gen_sent.text))
-        return pd.DataFrame(rows, columns=cols)
+                                 sent.norm))
+                    sents.append(sent.amr)
+        return rows, sents
+
+    def _generate_adm(self, generator: AmrGenerator, hadm_id: str,
+                      rows: List[Tuple[Any, ...]], sents: List[AmrSentence],
+                      batch_size: int) -> pd.DataFrame:
+        """Generate text from the sentences of an admission in batches."""
+        from zensols.amr import AmrDocument, AmrGeneratedDocument
+        import pandas as pd
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'generating {len(sents)} sentences of {hadm_id}')
+        cols: List[str] = 'hadm_id note_id sec_id sec_name org gen'.split()
+        gens: List[str] = []
+        # an admission without sentences still needs a positive step
+        batch_size = max(len(sents) if batch_size is None else batch_size, 1)
+        start: int
+        for start in range(0, len(sents), batch_size):
+            batch: Tuple[AmrSentence, ...] = tuple(
+                sents[start:start + batch_size])
+            with self.instrument.measure('generate'):
+                gen_doc: AmrGeneratedDocument = generator(AmrDocument(batch))
+            assert len(gen_doc) == len(batch)
+            gens.extend(map(lambda s: s.text, gen_doc))
+        return pd.DataFrame(
+            list(map(lambda r: r[0] + (r[1],), zip(rows, gens))),
+            columns=cols)
 
-    def generate(self, ids: str, output_dir: Path = None):
+    def generate(self, ids: str, output_dir: Path = None, workers: int = 1,
+                 batch_size: int = None, output_format: str = 'csv',
+                 resume: bool = False):
         """Creates samples of generated AMR text by first parsing clinical
         sentences into graphs.
 
@@ -99,13 +306,75 @@ class Application(object):
 
         :param output_dir: the output directory
 
+        :param workers: the number of admissions to parse concurrently, which
+                        are given to a single generator as they are parsed
+
+        :param batch_size: the number of graphs given to the generator at a
+                           time, which defaults to all of an admission's
+
+        :param output_format: the output file type: ``csv`` or ``parquet``
+
+        :param resume: whether to keep admissions already in the output file
+                       and skip generating them
+
         """
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        from .writer import GeneratedSentenceWriter
+
+        if batch_size is not None and batch_size < 1:
+            raise ApplicationError(
+                f'Batch size must be a positive integer: {batch_size}')
         if output_dir is None:
             output_dir = self.dumper.target_dir
-        output_path = output_dir / 'generated-sents.csv'
-        hadm_ids: List[str] = ids.split(',')
-        dfs: Tuple[pd.DataFrame] = tuple(map(self._generate_adm, hadm_ids))
-        df: pd.DataFrame = pd.concat(dfs)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        df.to_csv(output_path)
+        output_path = output_dir / f'generated-sents.{output_format}'
+        writer = GeneratedSentenceWriter(output_path, resume=resume)
+        hadm_ids: List[str] = list(filter(
+            lambda i: not writer.is_complete(i), ids.split(',')))
+        stash: Stash = self.config_factory('mimic_corpus').hospital_adm_stash
+        generator: AmrGenerator = self.config_factory('amr_generator_amrlib')
+        corpus_lock = threading.Lock()
+        workers = max(workers, 1)
+        # admissions are parsed in the parse pool while the (not thread safe)
+        # generator runs on its own thread; both are returned in order
+        parsing: deque = deque()
+        generating: deque = deque()
+
+        def generate_next():
+            hadm_id, fut = parsing.popleft()
+            try:
+                rows, sents = fut.result()
+            except Exception as e:
+                logger.exception(f'could not parse {hadm_id}: {e}')
+                return
+            generating.append((hadm_id, gen_pool.submit(
+                self._generate_adm, generator, hadm_id, rows, sents,
+                batch_size)))
+
+        def write_next():
+            hadm_id, fut = generating.popleft()
+            try:
+                writer.write(fut.result())
+            except Exception as e:
+                logger.exception(f'could not generate {hadm_id}: {e}')
+
+        pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='generate-parse')
+        gen_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='generate')
+        with writer, pool, gen_pool:
+            hadm_id: str
+            for hadm_id in hadm_ids:
+                parsing.append((hadm_id, pool.submit(
+                    self._get_generate_sents, hadm_id, stash, corpus_lock)))
+                # bound the number of parsed admissions held in memory
+                while len(parsing) > workers:
+                    generate_next()
+                while len(generating) > workers:
+                    write_next()
+            while len(parsing) > 0:
+                generate_next()
+            while len(generating) > 0:
+                write_next()
         logger.info(f'wrote: {output_path}')
+        self._write_profile()
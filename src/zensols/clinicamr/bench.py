@@ -0,0 +1,308 @@
+"""Benchmark the throughput and memory use of sentence, paragraph and admission
+parsing.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Dict, Any, Iterable, Callable
+from dataclasses import dataclass, field, asdict
+import sys
+import time
+import json
+import random
+import platform
+import resource
+import logging
+from datetime import datetime
+from pathlib import Path
+from zensols.config import ConfigFactory
+from zensols.amrspring import AmrPrediction
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StubAmrParseClient(object):
+    """Stands in for the SPRING server client by returning a trivial graph for
+    each sentence so benchmarks measure this package rather than the model.
+
+    """
+    latency: float = field(default=0)
+    """The number of seconds each request takes."""
+
+    def _create_graph(self, sent: str) -> str:
+        n_toks: int = len(sent.split())
+        snt: str = sent.replace('"', "'")
+        return f'# ::snt {snt}\n(s / sentence :quant {n_toks})'
+
+    def parse(self, sents: Iterable[str]) -> List[AmrPrediction]:
+        sents = tuple(sents)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return list(map(
+            lambda s: AmrPrediction(
+                sent=s, graph=self._create_graph(s), error=None),
+            sents))
+
+
+@dataclass
+class SyntheticNoteFactory(object):
+    """Creates reproducible discharge summary like notes with MIMIC-III style
+    masks, sections and paragraphs.
+
+    """
+    SECTIONS = ('History of Present Illness', 'Past Medical History',
+                'Hospital Course', 'Discharge Diagnosis',
+                'Discharge Instructions')
+    """The section headers used in the notes."""
+
+    SENTENCES = (
+        'Patient was admitted on [**2150-1-3**] with shortness of breath.',
+        'He was seen by Dr. [**Last Name (STitle) 1234**] in the ED.',
+        'CXR showed bilateral infiltrates consistent with pneumonia.',
+        'She was started on vancomycin and zosyn for HCAP.',
+        'Troponins were negative x3 and EKG was unchanged from prior.',
+        'Hct remained stable at 30 and no transfusion was needed.',
+        'The patient was transferred to [**Hospital1 18**] for further care.',
+        'Follow up with your PCP Dr. [**First Name (STitle) 567**] in 1 week.',
+        'Creatinine peaked at 2.1 and improved with IV fluids.',
+        'Pain was controlled with oxycodone and tylenol.')
+    """The sentence templates used to create paragraphs."""
+
+    seed: int = field(default=0)
+    """The random seed used so the same notes are created each run."""
+
+    sections: int = field(default=4)
+    """The number of sections in each note."""
+
+    paragraphs: int = field(default=2)
+    """The number of paragraphs in each section."""
+
+    sentences: int = field(default=3)
+    """The number of sentences in each paragraph."""
+
+    example_path: Path = field(
+        default=Path('test-resources/clinical-example.txt'))
+    """A file with clinical text added to the sentence templates if it
+    exists.
+
+    """
+    def _get_sentences(self) -> Tuple[str, ...]:
+        sents: Tuple[str, ...] = self.SENTENCES
+        if self.example_path is not None and self.example_path.is_file():
+            sents = sents + (' '.join(self.example_path.read_text().split()),)
+        return sents
+
+    def create(self, n_notes: int) -> Iterable[str]:
+        """Create synthetic notes.
+
+        :param n_notes: the number of notes to create
+
+        """
+        rand = random.Random(self.seed)
+        sents: Tuple[str, ...] = self._get_sentences()
+        for _ in range(n_notes):
+            secs: List[str] = [
+                'Admission Date:  [**2150-1-1**]  ' +
+                'Discharge Date:  [**2150-1-9**]']
+            sec: str
+            for sec in rand.sample(
+                    self.SECTIONS, min(self.sections, len(self.SECTIONS))):
+                paras: List[str] = []
+                for _ in range(self.paragraphs):
+                    paras.append(' '.join(rand.choices(
+                        sents, k=self.sentences)))
+                secs.append(f'{sec}:\n' + '\n\n'.join(paras))
+            yield '\n\n'.join(secs)
+
+
+@dataclass
+class BenchmarkResult(object):
+    """The measurements of a benchmark stage."""
+
+    stage: str = field()
+    """The name of the benchmarked component."""
+
+    cache: str = field()
+    """Either ``cold`` or ``warm`` for whether caches were cleared first."""
+
+    seconds: float = field()
+    """The wall time in seconds."""
+
+    sentences: int = field(default=0)
+    """The number of sentences parsed."""
+
+    paragraphs: int = field(default=0)
+    """The number of paragraphs parsed."""
+
+    admissions: int = field(default=0)
+    """The number of admissions parsed."""
+
+    peak_rss_mb: float = field(default=0)
+    """The peak resident memory of the process in megabytes after the stage
+    ran.
+
+    """
+    def _rate(self, count: int) -> float:
+        return count / self.seconds if self.seconds > 0 else 0
+
+    def asdict(self) -> Dict[str, Any]:
+        """Return the measurements and the per second rates."""
+        dct: Dict[str, Any] = asdict(self)
+        dct.update(
+            sentences_per_sec=self._rate(self.sentences),
+            paragraphs_per_sec=self._rate(self.paragraphs),
+            admissions_per_sec=self._rate(self.admissions))
+        return dct
+
+    def __str__(self) -> str:
+        return (f'{self.stage} ({self.cache}): {self.seconds:.2f}s, ' +
+                f'sents/s={self._rate(self.sentences):.1f}, ' +
+                f'paras/s={self._rate(self.paragraphs):.1f}, ' +
+                f'adms/s={self._rate(self.admissions):.2f}, ' +
+                f'rss={self.peak_rss_mb:.0f}MB')
+
+
+@dataclass
+class Benchmark(object):
+    """Measures the throughput of the SPRING parser, the paragraph factory and
+    the admission factory stash with cold and warm caches.  The parser stage
+    uses notes created by :class:`.SyntheticNoteFactory`.  The paragraph and
+    admission stages need the MIMIC-III database and are skipped when no
+    :obj:`hadm_ids` are given.
+
+    To measure only this package's code, configure the application to use
+    :class:`.StubAmrParseClient` (see the ``bench`` make target).
+
+    """
+    config_factory: ConfigFactory = field()
+    """Used to create the benchmarked components."""
+
+    note_factory: SyntheticNoteFactory = field(
+        default_factory=SyntheticNoteFactory)
+    """Creates the notes for the parser stage."""
+
+    n_notes: int = field(default=10)
+    """The number of synthetic notes to parse."""
+
+    hadm_ids: Tuple[str, ...] = field(default=())
+    """The admissions used by the paragraph and admission stages."""
+
+    def _get_peak_rss(self) -> float:
+        rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux and bytes on macOS
+        return rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+    def _measure(self, stage: str, cache: str,
+                 fn: Callable[[], Tuple[int, int, int]]) -> BenchmarkResult:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'benchmarking {stage} ({cache})')
+        start: float = time.perf_counter()
+        sents, paras, adms = fn()
+        res = BenchmarkResult(
+            stage=stage,
+            cache=cache,
+            seconds=time.perf_counter() - start,
+            sentences=sents,
+            paragraphs=paras,
+            admissions=adms,
+            peak_rss_mb=self._get_peak_rss())
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(str(res))
+        return res
+
+    def _bench_parser(self) -> Iterable[BenchmarkResult]:
+        from zensols.nlp import FeatureDocument, FeatureDocumentParser
+        from .spring import SpringAmrParser
+        fac: ConfigFactory = self.config_factory
+        doc_parser: FeatureDocumentParser = fac(fac.config.get_option(
+            'doc_parser', 'clinicamr_default'))
+        para_fac = fac('camr_paragraph_factory')
+        # paragraphs are parsed without coreference resolution
+        annotator = para_fac.parse_annotator
+        parser = para_fac.amr_parser
+        paras: Tuple[FeatureDocument, ...] = tuple(map(
+            doc_parser, filter(
+                lambda p: len(p.strip()) > 0,
+                '\n\n'.join(self.note_factory.create(self.n_notes)).
+                split('\n\n'))))
+
+        def parse() -> Tuple[int, int, int]:
+            sents: int = sum(map(
+                lambda p: len(annotator.annotate(p).sents), paras))
+            return sents, len(paras), 0
+
+        if isinstance(parser, SpringAmrParser):
+            parser.normalizer.clear()
+        yield self._measure('parser', 'cold', parse)
+        yield self._measure('parser', 'warm', parse)
+
+    def _bench_paragraph(self) -> Iterable[BenchmarkResult]:
+        from zensols.mimic import Corpus, HospitalAdmission
+        from .parafac import ClinicAmrParagraphFactory
+        fac: ConfigFactory = self.config_factory
+        para_fac: ClinicAmrParagraphFactory = fac('camr_paragraph_factory')
+        corpus: Corpus = fac('mimic_corpus')
+
+        def parse() -> Tuple[int, int, int]:
+            sents: int = 0
+            paras: int = 0
+            hadm_id: str
+            for hadm_id in self.hadm_ids:
+                adm: HospitalAdmission = corpus.get_hospital_adm_by_id(
+                    int(hadm_id))
+                for notes in adm.notes_by_category.values():
+                    for note in notes:
+                        for sec in note.sections.values():
+                            for para in para_fac.create(sec):
+                                sents += len(para.sents)
+                                paras += 1
+            return sents, paras, 0
+
+        para_fac.clear()
+        yield self._measure('paragraph', 'cold', parse)
+        yield self._measure('paragraph', 'warm', parse)
+
+    def _bench_admission(self) -> Iterable[BenchmarkResult]:
+        from .adm import AdmissionAmrFactoryStash
+        fac: ConfigFactory = self.config_factory
+        stash: AdmissionAmrFactoryStash = fac('camr_adm_amr_factory_stash')
+
+        def parse() -> Tuple[int, int, int]:
+            sents: int = sum(map(
+                lambda i: len(stash.load(i).sents), self.hadm_ids))
+            return sents, 0, len(self.hadm_ids)
+
+        fac('camr_paragraph_factory').clear()
+        yield self._measure('admission', 'cold', parse)
+        yield self._measure('admission', 'warm', parse)
+
+    def run(self) -> Tuple[BenchmarkResult, ...]:
+        """Run the benchmarks and return the results of each stage."""
+        results: List[BenchmarkResult] = list(self._bench_parser())
+        if len(self.hadm_ids) > 0:
+            results.extend(self._bench_paragraph())
+            results.extend(self._bench_admission())
+        else:
+            logger.warning('no admissions given--skipping paragraph ' +
+                           'and admission benchmarks')
+        return tuple(results)
+
+    def write_json(self, results: Iterable[BenchmarkResult], path: Path):
+        """Write the results with the run environment as JSON for regression
+        tracking.
+
+        """
+        data: Dict[str, Any] = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'n_notes': self.n_notes,
+            'hadm_ids': list(self.hadm_ids),
+            'results': list(map(lambda r: r.asdict(), results))}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=4)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'wrote: {path}')
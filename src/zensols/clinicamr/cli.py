@@ -31,6 +31,24 @@ class ApplicationFactory(CliApplicationFactory):
         config_factory = harness.get_config_factory()
         return config_factory('camr_adm_amr_stash')
 
+    @classmethod
+    def get_admission_streamer(cls: Type, **kwargs: Dict[str, Any]) -> \
+            'AdmissionStreamer':
+        """Return an iterator over admissions, notes, sections or paragraphs.
+
+        :param kwargs: attributes to set on the streamer, such as
+                       ``note_categories`` and ``section_names``
+
+        """
+        harness: CliHarness = cls.create_harness()
+        config_factory = harness.get_config_factory()
+        streamer = config_factory('camr_adm_amr_streamer')
+        k: str
+        v: Any
+        for k, v in kwargs.items():
+            setattr(streamer, k, v)
+        return streamer
+
 
 def main(args: List[str] = sys.argv, **kwargs: Dict[str, Any]) -> ActionResult:
     harness: CliHarness = ApplicationFactory.create_harness(relocate=False)
@@ -0,0 +1,154 @@
+"""Coreference resolution over note sized blocks of long admissions.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Dict, Iterable, Callable
+from dataclasses import dataclass, field
+import logging
+import itertools as it
+from zensols.amr import AmrFeatureSentence, AmrFeatureDocument, AmrDocument
+from .domain import _NoteIndex, AdmissionAmrFeatureDocument
+
+logger = logging.getLogger(__name__)
+
+# a coreferent: (<sentence index>, <variable>)
+Coreferent = Tuple[int, str]
+
+
+@dataclass
+class NoteBlockCoreference(object):
+    """Resolves coreferences within each note (block) of an admission rather
+    than over all of its sentences at once, which is too slow and takes too
+    much memory for long admissions.  Coreferences across notes are found by
+    resolving the last and first :obj:`window` sentences of each pair of
+    consecutive blocks.  The chains of all blocks and windows are merged when
+    they share a coreferent.
+
+    The admission's variables must already be reindexed (see
+    :meth:`~zensols.amr.AmrDocument.reindex_variables`) so they are unique
+    across blocks.
+
+    """
+    window: int = field(default=10)
+    """The number of sentences on each side of a block boundary that are
+    resolved together to link blocks, or 0 to only resolve within blocks.
+
+    """
+    max_block: int = field(default=None)
+    """The maximum number of sentences of a block, which splits long notes,
+    or ``None`` to use a block per note.
+
+    """
+    def _get_note_spans(self, doc: AdmissionAmrFeatureDocument) -> \
+            Iterable[Tuple[int, int]]:
+        note: _NoteIndex
+        for note in (doc._ds_ix,) + tuple(doc._ant_ixs):
+            # notes and sections might not have paragraphs
+            spans: Tuple[Tuple[int, int], ...] = () if note is None else \
+                tuple(map(lambda p: p.span,
+                          it.chain.from_iterable(
+                              map(lambda s: s.paras, note.secs))))
+            if len(spans) > 0 and spans[-1][1] > spans[0][0]:
+                yield (spans[0][0], spans[-1][1])
+
+    def _get_blocks(self, spans: Iterable[Tuple[int, int]]) -> \
+            List[Tuple[int, int]]:
+        """Split note spans in to blocks of at most :obj:`max_block` sentences.
+
+        """
+        blocks: List[Tuple[int, int]] = []
+        begin: int
+        end: int
+        for begin, end in spans:
+            step: int = (end - begin) if self.max_block is None \
+                else max(self.max_block, 1)
+            blocks.extend(map(lambda b: (b, min(b + step, end)),
+                              range(begin, end, step)))
+        return blocks
+
+    def _get_windows(self, blocks: List[Tuple[int, int]]) -> \
+            List[Tuple[int, int]]:
+        """Return the spans across each pair of consecutive blocks."""
+        if self.window <= 0:
+            return []
+        return list(map(
+            lambda p: (max(p[0][0], p[0][1] - self.window),
+                       min(p[1][1], p[1][0] + self.window)),
+            zip(blocks, blocks[1:])))
+
+    @staticmethod
+    def _merge(chains: Iterable[Iterable[Coreferent]]) -> \
+            Tuple[Tuple[Coreferent, ...], ...]:
+        """Merge coreference chains that share a coreferent.
+
+        :return: sorted chains, each sorted by sentence index and variable
+
+        """
+        parents: Dict[Coreferent, Coreferent] = {}
+
+        def find(ref: Coreferent) -> Coreferent:
+            root: Coreferent = ref
+            while parents[root] != root:
+                root = parents[root]
+            while parents[ref] != root:
+                parents[ref], ref = root, parents[ref]
+            return root
+
+        chain: Iterable[Coreferent]
+        for chain in chains:
+            chain = tuple(chain)
+            ref: Coreferent
+            for ref in chain:
+                parents.setdefault(ref, ref)
+            for ref in chain[1:]:
+                a: Coreferent = find(chain[0])
+                b: Coreferent = find(ref)
+                if a != b:
+                    parents[max(a, b)] = min(a, b)
+        groups: Dict[Coreferent, List[Coreferent]] = {}
+        for ref in parents.keys():
+            groups.setdefault(find(ref), []).append(ref)
+        return tuple(sorted(map(lambda g: tuple(sorted(g)), filter(
+            lambda g: len(g) > 1, groups.values()))))
+
+    def _resolve_span(self, resolver: Callable[[AmrFeatureDocument], None],
+                      doc: AdmissionAmrFeatureDocument,
+                      span: Tuple[int, int]) -> \
+            Iterable[Tuple[Coreferent, ...]]:
+        """Resolve a span of sentences of the admission.
+
+        :return: the chains with admission level sentence indexes
+
+        """
+        begin: int = span[0]
+        sents: Tuple[AmrFeatureSentence, ...] = doc.sents[begin:span[1]]
+        block = AmrFeatureDocument(
+            sents=sents,
+            amr=AmrDocument(tuple(map(lambda s: s.amr, sents))))
+        resolver(block)
+        chains = block.coreference_relations
+        return map(lambda c: tuple(map(lambda r: (r[0] + begin, r[1]), c)),
+                   () if chains is None else chains)
+
+    def resolve(self, resolver: Callable[[AmrFeatureDocument], None],
+                doc: AdmissionAmrFeatureDocument):
+        """Set the coreferences of an admission.
+
+        :param resolver: resolves the coreferences of an AMR document, such as
+                         the annotator's coreference resolver
+
+        :param doc: the admission to resolve
+
+        """
+        blocks: List[Tuple[int, int]] = self._get_blocks(
+            self._get_note_spans(doc))
+        windows: List[Tuple[int, int]] = self._get_windows(blocks)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'resolving coreferences over {len(blocks)} blocks ' +
+                        f'and {len(windows)} windows')
+        chains: List[Tuple[Coreferent, ...]] = []
+        span: Tuple[int, int]
+        for span in blocks + windows:
+            chains.extend(self._resolve_span(resolver, doc, span))
+        doc.coreference_relations = self._merge(chains)
@@ -3,9 +3,11 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import List
+from typing import Tuple, List, Dict, Any
 from dataclasses import dataclass, field
+from string import Formatter
 from penman.graph import Graph, Triple, Attribute
+from zensols.persist import persisted
 from zensols.nlp import FeatureToken
 from zensols.amr.docparser import TokenAnnotationFeatureDocumentDecorator
 
@@ -15,13 +17,45 @@ class ClinicTokenAnnotationFeatureDocumentDecorator(
         TokenAnnotationFeatureDocumentDecorator):
     """Override token feature annotation by adding CUI data.
 
+    Only the token features referenced in :obj:`feature_format` are accessed
+    and the formatted strings are memoized by those features' values since
+    relatively few concepts make up most of the mentions.
+
     """
     feature_format: str = field(default='[{cui_}]: {pref_name_} ({tui_descs_})')
     """The format used for CUI annotated tokens."""
 
+    cache_size: int = field(default=100000)
+    """The maximum number of formatted strings to memoize."""
+
+    _formatted: Dict[Tuple[str, ...], str] = field(
+        default_factory=dict, init=False, repr=False)
+    """Formatted strings keyed by the values of :obj:`format_ids`."""
+
+    @property
+    @persisted('_format_ids')
+    def format_ids(self) -> Tuple[str, ...]:
+        """The token feature IDs referenced in :obj:`feature_format`."""
+        # the (unique) top level attribute names of each replacement field,
+        # such as ``cui_`` in ``{cui_}`` or ``{cui_!r}``
+        return tuple(dict.fromkeys(map(
+            lambda f: f[1].split('.')[0].split('[')[0],
+            filter(lambda f: f[1] is not None and len(f[1]) > 0,
+                   Formatter().parse(self.feature_format)))))
+
     def _format_feature_value(self, tok: FeatureToken) -> str:
         if tok.is_concept and self.feature_format is not None:
-            return self.feature_format.format(**tok.asdict())
+            fids: Tuple[str, ...] = self.format_ids
+            vals: Tuple[Any, ...] = tuple(map(
+                lambda f: getattr(tok, f), fids))
+            # key by string since some features values are not hashable
+            key: Tuple[str, ...] = tuple(map(str, vals))
+            val: str = self._formatted.get(key)
+            if val is None:
+                val = self.feature_format.format(**dict(zip(fids, vals)))
+                if len(self._formatted) < self.cache_size:
+                    self._formatted[key] = val
+            return val
         return getattr(tok, self.feature_id)
 
     def _annotate_token(self, tok: FeatureToken, source: Triple,
@@ -3,12 +3,14 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import Tuple, List, Iterable, Type
-from dataclasses import dataclass, field
+from typing import (
+    Tuple, List, Iterable, Type, FrozenSet, Any, Dict, Union, Sequence
+)
+from dataclasses import dataclass, field, fields
 from abc import ABCMeta, abstractmethod
 import sys
-import copy
 from io import TextIOBase
+import numpy as np
 from zensols.config import Writable
 from zensols.persist import NotPickleable
 from zensols.util import APIError
@@ -21,7 +23,19 @@ class ClinicAmrError(APIError):
     pass
 
 
-@dataclass
+def _set_index_state(self, state: Union[Tuple[Any, ...], Dict[str, Any]]):
+    """Unpickle an index, which are immutable and shared by clones.  Indexes
+    pickled before they had slots have a dictionary state.
+
+    """
+    flds = fields(self)
+    if isinstance(state, dict):
+        state = tuple(map(lambda f: state[f.name], flds))
+    for f, val in zip(flds, state):
+        object.__setattr__(self, f.name, val)
+
+
+@dataclass(frozen=True, slots=True)
 class _ParagraphIndex(object):
     """A paragraph index as a span of sentence entries in
     :class:`._IndexedDocument`.
@@ -31,8 +45,10 @@ class _ParagraphIndex(object):
     """The 0-index sentence beginning and inclusive ending that make up the
     paragraph."""
 
+    __setstate__ = _set_index_state
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class _SectionIndex(object):
     """A section made up of paragraph sentence spans.
 
@@ -46,6 +62,8 @@ class _SectionIndex(object):
     paras: Tuple[_ParagraphIndex, ...] = field()
     """Paragraph sentence spans."""
 
+    __setstate__ = _set_index_state
+
     @property
     def span(self) -> Tuple[int, int]:
         """The 0-index sentence beginning and inclusive ending that make up the
@@ -55,7 +73,7 @@ class _SectionIndex(object):
         return (self.paras[0].span[0], self.paras[-1].span[1])
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class _NoteIndex(object):
     """The sections that make up a note.
 
@@ -69,6 +87,8 @@ class _NoteIndex(object):
     secs: Tuple[_SectionIndex, ...] = field()
     """The section indexes the make up the note."""
 
+    __setstate__ = _set_index_state
+
     @property
     def span(self) -> Tuple[int, int]:
         """The 0-index sentence beginning and inclusive ending that make up the
@@ -82,8 +102,10 @@ class _IndexedDocument(Writable, NotPickleable, metaclass=ABCMeta):
     """A base class for index container classes that create AMR documents.
 
     """
-    def __init__(self, sents: Tuple[AmrFeatureSentence]):
+    def __init__(self, sents: Tuple[AmrFeatureSentence],
+                 span_index: 'AdmissionSpanIndex' = None):
         self._sents = sents
+        self._span_index = span_index
 
     @abstractmethod
     def create_document(self) -> AmrFeatureDocument:
@@ -96,10 +118,18 @@ class _IndexedDocument(Writable, NotPickleable, metaclass=ABCMeta):
 
         """
         span: Tuple[int, int] = index.span
-        sents: List[AmrFeatureSentence] = self._sents[span[0]:span[1]]
-        return AmrFeatureDocument(
-            sents=tuple(sents),
-            amr=AmrDocument(tuple(map(lambda s: s.amr, sents))))
+        if self._span_index is not None:
+            return self._span_index.create_view(*span)
+        return _create_span_doc(self._sents, *span)
+
+
+def _create_span_doc(sents: Sequence[AmrFeatureSentence],
+                     begin: int, end: int) -> AmrFeatureDocument:
+    """Create a document from a span of sentences."""
+    sents: List[AmrFeatureSentence] = sents[begin:end]
+    return AmrFeatureDocument(
+        sents=tuple(sents),
+        amr=AmrDocument(tuple(map(lambda s: s.amr, sents))))
 
 
 @dataclass
@@ -137,8 +167,9 @@ class SectionDocument(_IndexedDocument):
     """An index container class that creates AMR paragraph documents.
 
     """
-    def __init__(self, sents: Tuple[AmrFeatureSentence], sec_ix: _SectionIndex):
-        super().__init__(sents)
+    def __init__(self, sents: Tuple[AmrFeatureSentence], sec_ix: _SectionIndex,
+                 span_index: 'AdmissionSpanIndex' = None):
+        super().__init__(sents, span_index)
         self._sec_ix = sec_ix
 
     @property
@@ -172,8 +203,9 @@ class NoteDocument(_IndexedDocument):
     """An index container class that creates AMR clinical note documents.
 
     """
-    def __init__(self, sents: Tuple[AmrFeatureSentence], note_ix: _NoteIndex):
-        super().__init__(sents)
+    def __init__(self, sents: Tuple[AmrFeatureSentence], note_ix: _NoteIndex,
+                 span_index: 'AdmissionSpanIndex' = None):
+        super().__init__(sents, span_index)
         self._note_ix = note_ix
 
     @property
@@ -191,8 +223,8 @@ class NoteDocument(_IndexedDocument):
 
     def create_sections(self) -> Iterable[SectionDocument]:
         """Return the clinical section documents of this section."""
-        return map(lambda sec: SectionDocument(self._sents, sec),
-                   self._note_ix.secs)
+        return map(lambda sec: SectionDocument(
+            self._sents, sec, self._span_index), self._note_ix.secs)
 
     def write(self, depth: int = 0, writer: TextIOBase = sys.stdout):
         self._write_line(f'note: {self.row_id} ({self.category})',
@@ -203,6 +235,208 @@ class NoteDocument(_IndexedDocument):
             self._write_object(sec, depth + 1, writer)
 
 
+class AdmissionSpanIndex(object):
+    """A flat array index of the note, section and paragraph sentence spans
+    of an admission.  Notes are found by row ID, sections by name or ID and
+    paragraphs by their index in constant time, and queries across notes
+    (i.e. all history of present illness paragraphs of the antecedent notes)
+    use array operations rather than walking the index hierarchy.
+
+    The documents created for spans are memoized, so they are shared by all
+    callers and should not be modified.
+
+    """
+    _PARA_COLS = 'note sec para begin end'.split()
+    _SEC_COLS = 'note sec_id para_begin para_end'.split()
+
+    def __init__(self, sents: Sequence[AmrFeatureSentence],
+                 notes: Tuple[_NoteIndex, ...]):
+        """Initialize.
+
+        :param sents: the admission's sentences
+
+        :param notes: the discharge summary index followed by the antecedent
+                      note indexes
+
+        """
+        self._sents = sents
+        self._notes = notes
+        paras: List[Tuple[int, ...]] = []
+        secs: List[Tuple[int, ...]] = []
+        self._sec_names: List[str] = []
+        self._sec_ixs: List[_SectionIndex] = []
+        self._sec_rows: Dict[Tuple[int, int], int] = {}
+        self._note_rows: Dict[int, int] = {}
+        nix: int
+        note: _NoteIndex
+        for nix, note in enumerate(notes):
+            self._note_rows[note.row_id] = nix
+            sec: _SectionIndex
+            for sec in note.secs:
+                srow: int = len(secs)
+                self._sec_rows[(note.row_id, sec.id)] = srow
+                self._sec_names.append(sec.name)
+                self._sec_ixs.append(sec)
+                secs.append((nix, sec.id, len(paras),
+                             len(paras) + len(sec.paras)))
+                pix: int
+                para: _ParagraphIndex
+                for pix, para in enumerate(sec.paras):
+                    paras.append((nix, srow, pix) + tuple(para.span))
+        self.paras: np.ndarray = np.array(paras, dtype=np.int64).\
+            reshape(-1, len(self._PARA_COLS))
+        """The paragraph rows with columns: note row, section row, paragraph
+        index in the section, sentence begin and end.
+
+        """
+        self.secs: np.ndarray = np.array(secs, dtype=np.int64).\
+            reshape(-1, len(self._SEC_COLS))
+        """The section rows with columns: note row, section ID, paragraph row
+        begin and end.
+
+        """
+        self._sec_names_arr: np.ndarray = np.array(self._sec_names, dtype=str)
+        self._views: Dict[Tuple[int, int], AmrFeatureDocument] = {}
+        self._note_docs: Dict[int, NoteDocument] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # memoized views are recreated as needed
+        state: Dict[str, Any] = dict(self.__dict__)
+        state['_views'] = {}
+        state['_note_docs'] = {}
+        return state
+
+    def create_view(self, begin: int, end: int) -> AmrFeatureDocument:
+        """Return the (memoized) document of a span of sentences."""
+        key: Tuple[int, int] = (begin, end)
+        doc: AmrFeatureDocument = self._views.get(key)
+        if doc is None:
+            doc = _create_span_doc(self._sents, begin, end)
+            self._views[key] = doc
+        return doc
+
+    def get_note(self, row_id: int) -> NoteDocument:
+        """Return a note by its MIMIC-III row ID."""
+        nix: int = self._note_rows[row_id]
+        note: NoteDocument = self._note_docs.get(nix)
+        if note is None:
+            note = NoteDocument(self._sents, self._notes[nix], self)
+            self._note_docs[nix] = note
+        return note
+
+    def get_paragraph(self, row_id: int, sec_id: int,
+                      para_idx: int) -> AmrFeatureDocument:
+        """Return a paragraph by its note, section and index in the section."""
+        sec: np.ndarray = self.secs[self._sec_rows[(row_id, sec_id)]]
+        prow: int = sec[2] + para_idx
+        if para_idx < 0 or prow >= sec[3]:
+            raise IndexError(f'No paragraph {para_idx} in section {sec_id}')
+        return self.create_view(*map(int, self.paras[prow, 3:5]))
+
+    def _get_section_mask(self, sec_name: str = None, sec_id: int = None,
+                          antecedents: bool = None) -> np.ndarray:
+        mask: np.ndarray = np.ones(len(self.secs), dtype=bool)
+        if sec_name is not None:
+            # the indexes use spaces in place of dashes
+            mask &= self._sec_names_arr == sec_name.replace('-', ' ')
+        if sec_id is not None:
+            mask &= self.secs[:, 1] == sec_id
+        if antecedents is not None:
+            # the discharge summary is the first note
+            mask &= (self.secs[:, 0] > 0) == antecedents
+        return mask
+
+    def find_sections(self, sec_name: str = None, sec_id: int = None,
+                      antecedents: bool = None) -> \
+            Iterable[SectionDocument]:
+        """Return the sections that match all given criteria.
+
+        :param sec_name: the section name
+
+        :param sec_id: the section ID
+
+        :param antecedents: ``True`` for only antecedent note sections,
+                            ``False`` for only discharge summary sections
+
+        """
+        return map(lambda r: SectionDocument(
+            self._sents, self._sec_ixs[r], self),
+            np.flatnonzero(self._get_section_mask(
+                sec_name, sec_id, antecedents)))
+
+    def find_paragraphs(self, sec_name: str = None, sec_id: int = None,
+                        antecedents: bool = None) -> \
+            Iterable[AmrFeatureDocument]:
+        """Return the paragraphs of sections that match all given criteria
+        (see :meth:`find_sections`).
+
+        """
+        srows: np.ndarray = np.flatnonzero(self._get_section_mask(
+            sec_name, sec_id, antecedents))
+        spans: np.ndarray = self.paras[np.isin(self.paras[:, 1], srows), 3:5]
+        return map(lambda s: self.create_view(int(s[0]), int(s[1])), spans)
+
+
+@dataclass(frozen=True)
+class CacheFingerprint(object):
+    """Hashes of the configuration a cached paragraph or admission was created
+    with, which tell whether the cached data is stale and whether it must be
+    parsed again or only decorated again.
+
+    """
+    parse: str = field()
+    """The hash of the AMR parser, model and medical parser, which change the
+    parsed graphs and token features.
+
+    """
+    decorate: str = field()
+    """The hash of the settings applied after parsing, such as the CUI format
+    of the annotation decorators and the ``id`` and ``is_header`` metadata.
+
+    """
+    roles: Tuple[str, ...] = field(default=())
+    """The graph attribute roles (i.e. ``:cui-id``) added by the annotation
+    decorators, which are removed before decorating again.
+
+    """
+    def is_parse(self, other: 'CacheFingerprint') -> bool:
+        """Whether ``other`` has the same parse configuration."""
+        return other is not None and self.parse == other.parse
+
+
+@dataclass(frozen=True)
+class AdmissionBuildInfo(object):
+    """The note and section selection and the paragraphs an admission document
+    was built from.  This is used to tell whether a cached admission is stale
+    and whether its sentences (and thus its coreferences) have changed.
+
+    """
+    keep_notes: FrozenSet[str] = field()
+    """The note categories kept in the admission, or ``None`` for all."""
+
+    keep_summary_sections: FrozenSet[str] = field()
+    """The discharge summary sections kept, or ``None`` for all."""
+
+    para_keys: Tuple[str, ...] = field()
+    """The paragraph cache keys (see
+    :meth:`~zensols.clinicamr.parafac.ClinicAmrParagraphFactory.get_cache_key`)
+    in the order their sentences were added to the admission.
+
+    """
+    fingerprint: CacheFingerprint = field(default=None)
+    """The paragraph configuration the admission was built with, or ``None``
+    if unknown (built by a previous version).
+
+    """
+    def is_selection(self, keep_notes: FrozenSet[str],
+                     keep_summary_sections: FrozenSet[str]) -> bool:
+        """Whether the admission was built with a note and section selection.
+
+        """
+        return self.keep_notes == keep_notes and \
+            self.keep_summary_sections == keep_summary_sections
+
+
 @dataclass
 class AdmissionAmrFeatureDocument(AmrFeatureDocument):
     """An AMR feature document whose :obj:`sents` consist of all parsed
@@ -221,21 +455,50 @@ class AdmissionAmrFeatureDocument(AmrFeatureDocument):
     parse_fails: Tuple[ParseFailure, ...] = field(default=None)
     """Sentences who have parsed features, but the AMR parse failed."""
 
+    build_info: AdmissionBuildInfo = field(default=None)
+    """The selection and paragraphs used to build the admission, or ``None``
+    if unknown (created by a previous version).
+
+    """
+    def __getstate__(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = super().__getstate__()
+        # the memoized index is not persisted, and is only present if accessed
+        state.pop('_span_index_memo', None)
+        return state
+
+    @property
+    def span_index(self) -> AdmissionSpanIndex:
+        """The (memoized and not persisted) array index of the admission's
+        notes, sections and paragraphs.
+
+        """
+        span_index: AdmissionSpanIndex = self.__dict__.get('_span_index_memo')
+        if span_index is None:
+            span_index = AdmissionSpanIndex(
+                self.sents, (self._ds_ix,) + tuple(self._ant_ixs))
+            self.__dict__['_span_index_memo'] = span_index
+        return span_index
+
     def create_discharge_summary(self) -> NoteDocument:
         """Return the discharge summary note."""
-        return NoteDocument(self.sents, self._ds_ix)
+        return self.span_index.get_note(self._ds_ix.row_id)
 
     def create_note_antecedents(self) -> Iterable[NoteDocument]:
         """Return the clinical notes of the admission."""
-        return map(lambda note_ix: NoteDocument(self.sents, note_ix),
+        return map(lambda note_ix: self.span_index.get_note(note_ix.row_id),
                    self._ant_ixs)
 
     def clone(self, cls: Type[TokenContainer] = None, **kwargs) -> \
             TokenContainer:
         clone = super().clone(cls, **kwargs)
-        clone._ds_ix = copy.deepcopy(self._ds_ix)
-        clone._ant_ixs = copy.deepcopy(self._ant_ixs)
-        clone.parse_fails = copy.deepcopy(self.parse_fails)
+        # the indexes are immutable and the failures are not modified so they
+        # are shared rather than copied
+        clone._ds_ix = self._ds_ix
+        clone._ant_ixs = self._ant_ixs
+        clone.parse_fails = self.parse_fails
+        clone.build_info = self.build_info
+        # the index's views are of this instance's sentences
+        clone.__dict__.pop('_span_index_memo', None)
         return clone
 
     def write(self, depth: int = 0, writer: TextIOBase = sys.stdout):
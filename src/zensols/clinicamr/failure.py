@@ -0,0 +1,197 @@
+"""A cache of paragraphs that could not be parsed so they are not parsed again
+on every load of their notes.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import Tuple, Dict, Iterable
+from dataclasses import dataclass, field
+import sys
+import time
+import logging
+import threading
+import textwrap as tw
+from io import TextIOBase
+from zensols.config import Writable
+from zensols.persist import Stash
+from zensols.amr import AmrError
+from zensols.amrspring import AmrServiceError, AmrServiceRequestError
+from .domain import ClinicAmrError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ParagraphFailure(Writable):
+    """A paragraph that could not be parsed or annotated."""
+
+    key: str = field()
+    """The paragraph's key in the paragraph cache stash."""
+
+    parser_id: str = field()
+    """The AMR parser and model used when the paragraph failed."""
+
+    error: str = field()
+    """The error raised by the parse."""
+
+    text: str = field()
+    """The paragraph text."""
+
+    created: float = field()
+    """The time (seconds since the epoch) of the last failure."""
+
+    attempts: int = field(default=1)
+    """The number of times the paragraph failed."""
+
+    def write(self, depth: int = 0, writer: TextIOBase = sys.stdout):
+        created: str = time.strftime(
+            '%Y-%m-%d %H:%M', time.localtime(self.created))
+        self._write_line(f'{self.key}: parser={self.parser_id}, ' +
+                         f'attempts={self.attempts}, last={created}',
+                         depth, writer)
+        self._write_line(f'error: {self.error}', depth + 1, writer)
+        self._write_line(f'text: {tw.shorten(self.text, 70)}',
+                         depth + 1, writer)
+
+
+@dataclass
+class ParagraphFailureCache(Writable):
+    """Records paragraphs that could not be parsed, keyed by their paragraph
+    cache key, so they are skipped rather than sent to the parser again.
+    Whether a recorded failure is parsed again is given by
+    :obj:`retry_policy`:
+
+      * ``never``: never parse again until the cache is cleared
+      * ``days``: parse again after :obj:`retry_days` days or when the parser
+        (:obj:`parser_id`) changes
+      * ``version``: parse again only when the parser changes
+
+    Only errors raised by the parser (see :meth:`is_parse_error`) are
+    recorded.  Other errors, such as connection errors to the SPRING server or
+    errors raised by decorators, are not since they are not caused by the
+    paragraph.
+
+    """
+    _RETRY_POLICIES = frozenset('never days version'.split())
+
+    stash: Stash = field()
+    """Persists the :class:`.ParagraphFailure` instances."""
+
+    parser_id: str = field(default=None)
+    """Identifies the AMR parser and model used to parse the paragraphs."""
+
+    retry_policy: str = field(default='version')
+    """When to parse a failed paragraph again: ``never``, ``days`` or
+    ``version`` (see class docs).
+
+    """
+    retry_days: float = field(default=30)
+    """The number of days after which a failure is retried with the ``days``
+    :obj:`retry_policy`.
+
+    """
+    def __post_init__(self):
+        if self.retry_policy not in self._RETRY_POLICIES:
+            raise ClinicAmrError(
+                f'Unknown retry policy: {self.retry_policy}')
+        self._lock = threading.Lock()
+
+    def is_parse_error(self, error: Exception) -> bool:
+        """Whether an error was raised by the parser or returned by the SPRING
+        server, rather than by the transport to the server or the rest of the
+        pipeline.
+
+        """
+        return isinstance(error, (AmrError, AmrServiceError)) and \
+            not isinstance(error, AmrServiceRequestError)
+
+    def is_retry(self, fail: ParagraphFailure) -> bool:
+        """Whether a failed paragraph should be parsed again."""
+        if self.retry_policy == 'never':
+            return False
+        if fail.parser_id != self.parser_id:
+            return True
+        if self.retry_policy == 'days':
+            return (time.time() - fail.created) >= self.retry_days * 86400
+        return False
+
+    def get_skip(self, key: str) -> ParagraphFailure:
+        """Return the failure of a paragraph if it should not be parsed, or
+        ``None`` if it has not failed or should be retried.
+
+        """
+        fail: ParagraphFailure = self.stash.load(key)
+        if fail is not None and not self.is_retry(fail):
+            return fail
+
+    def add(self, key: str, text: str, error: Exception) -> ParagraphFailure:
+        """Record (another) failure of a paragraph.
+
+        :return: the recorded failure, or ``None`` if ``error`` is not a
+                 parse error (see :meth:`is_parse_error`)
+
+        """
+        if not self.is_parse_error(error):
+            return None
+        with self._lock:
+            prev: ParagraphFailure = self.stash.load(key)
+            fail = ParagraphFailure(
+                key=key,
+                parser_id=self.parser_id,
+                error=f'{type(error).__name__}: {error}',
+                text=text,
+                created=time.time(),
+                attempts=1 if prev is None else prev.attempts + 1)
+            self.stash.dump(key, fail)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'recorded failure: {key}')
+        return fail
+
+    def remove(self, key: str):
+        """Remove the failure of a paragraph that has since been parsed."""
+        if self.stash.exists(key):
+            self.stash.delete(key)
+
+    def failures(self) -> Iterable[ParagraphFailure]:
+        """Return the recorded failures."""
+        return filter(lambda f: f is not None,
+                      map(self.stash.load, self.stash.keys()))
+
+    def _get_stats(self, fails: Iterable[ParagraphFailure]) -> Dict[str, int]:
+        stats: Dict[str, int] = {'failures': 0, 'retry': 0}
+        fail: ParagraphFailure
+        for fail in fails:
+            stats['failures'] += 1
+            stats['retry'] += self.is_retry(fail)
+            etype: str = 'error: ' + fail.error.split(':')[0]
+            stats[etype] = stats.get(etype, 0) + 1
+        return stats
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return the number of recorded failures, those that would be retried
+        and the number of failures by error type.
+
+        """
+        return self._get_stats(self.failures())
+
+    def write(self, depth: int = 0, writer: TextIOBase = sys.stdout,
+              limit: int = None):
+        """Write the most recent failures and the statistics of all failures.
+
+        :param limit: the maximum number of failures to write
+
+        """
+        fails: Tuple[ParagraphFailure, ...] = tuple(sorted(
+            self.failures(), key=lambda f: f.created, reverse=True))
+        fail: ParagraphFailure
+        for fail in fails[:limit]:
+            fail.write(depth, writer)
+        k: str
+        v: int
+        for k, v in self._get_stats(fails).items():
+            self._write_line(f'{k}: {v}', depth, writer)
+
+    def clear(self):
+        """Remove all recorded failures."""
+        self.stash.clear()
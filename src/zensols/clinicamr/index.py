@@ -0,0 +1,272 @@
+"""A persistent inverted index of the sections, note categories and concepts
+of parsed admissions.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Dict, Set, Any, Iterable
+from dataclasses import dataclass, field
+import sys
+import os
+import logging
+import threading
+import sqlite3
+from io import TextIOBase
+from pathlib import Path
+from zensols.config import Writable
+from zensols.persist import Stash
+from zensols.nlp import FeatureToken
+from zensols.amr import AmrFeatureDocument
+from .domain import _NoteIndex, _SectionIndex, AdmissionAmrFeatureDocument
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AdmissionSpan(Writable):
+    """A span of sentences in a section of an admission's note."""
+
+    hadm_id: str = field()
+    """The MIMIC-III admission ID."""
+
+    row_id: int = field()
+    """The MIMIC-III unique row ID of the clinical note."""
+
+    category: str = field()
+    """The category of the note (i.e. ``discharge summary``)."""
+
+    sec_id: int = field()
+    """The :obj:`~zensols.mimic.note.Section.id`."""
+
+    sec_name: str = field()
+    """The :obj:`~zensols.mimic.note.Section.name`."""
+
+    span: Tuple[int, int] = field()
+    """The 0-index sentence beginning and ending (exclusive) in the
+    admission.
+
+    """
+    def write(self, depth: int = 0, writer: TextIOBase = sys.stdout):
+        self._write_line(
+            f'hadm={self.hadm_id}, note={self.row_id} ({self.category}), ' +
+            f'section={self.sec_name} ({self.sec_id}), ' +
+            f'sents={self.span[0]}-{self.span[1]}', depth, writer)
+
+
+@dataclass
+class AdmissionCorpusIndex(object):
+    """An SQLite index of admission sections by section name and note category
+    and of sentences by the concepts (CUIs) of their tokens.  Admissions are
+    added as they are parsed by
+    :class:`~zensols.clinicamr.adm.AdmissionAmrFactoryStash`, and
+    :meth:`query` finds the sentence spans of admissions without loading
+    them.  Use :meth:`create_documents` to read only the matching sentences.
+
+    """
+    _SPAN_COLS = 'hadm_id row_id category sec_id sec_name begin end'
+
+    path: Path = field()
+    """The SQLite database file."""
+
+    timeout: float = field(default=60)
+    """The seconds to wait on other processes' write locks."""
+
+    def __post_init__(self):
+        self._local = threading.local()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """Return the connection of the current process and thread."""
+        local: threading.local = self._local
+        pid: int = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            # connections are not carried over from a forked process
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('pragma journal_mode=wal')
+            conn.executescript('''
+create table if not exists section (
+  hadm_id text, row_id integer, category text, sec_id integer,
+  sec_name text, begin integer, end integer,
+  primary key (hadm_id, row_id, sec_id));
+create index if not exists section_name on section (sec_name);
+create index if not exists section_category on section (category);
+create table if not exists concept (
+  cui text, hadm_id text, row_id integer, sec_id integer, sent integer);
+create index if not exists concept_cui on concept (cui);
+create index if not exists concept_adm on concept (hadm_id);''')
+            conn.commit()
+            local.pid = pid
+            local.conn = conn
+        return local.conn
+
+    def _get_sections(self, doc: AdmissionAmrFeatureDocument) -> \
+            Iterable[Tuple[_NoteIndex, _SectionIndex, int, int]]:
+        notes: Tuple[_NoteIndex, ...] = (doc._ds_ix,) + tuple(doc._ant_ixs)
+        note: _NoteIndex
+        # admissions might not have a discharge summary index
+        for note in filter(lambda n: n is not None, notes):
+            sec: _SectionIndex
+            for sec in note.secs:
+                if len(sec.paras) > 0 and sec.span[1] > sec.span[0]:
+                    yield (note, sec) + tuple(sec.span)
+
+    def _get_cuis(self, doc: AmrFeatureDocument, begin: int,
+                  end: int) -> Iterable[Tuple[str, int]]:
+        """Return the unique concepts of each sentence in a span."""
+        six: int
+        for six in range(begin, end):
+            cuis: Set[str] = set()
+            tok: FeatureToken
+            for tok in doc.sents[six].token_iter():
+                cui: str = getattr(tok, 'cui_', FeatureToken.NONE)
+                if tok.is_concept and cui != FeatureToken.NONE:
+                    cuis.add(cui)
+            yield from map(lambda c: (c, six), sorted(cuis))
+
+    def add(self, doc: AdmissionAmrFeatureDocument):
+        """Add or replace the sections and concepts of an admission."""
+        hadm_id: str = str(doc.hadm_id)
+        secs: List[Tuple[Any, ...]] = []
+        cuis: List[Tuple[Any, ...]] = []
+        note: _NoteIndex
+        sec: _SectionIndex
+        begin: int
+        end: int
+        for note, sec, begin, end in self._get_sections(doc):
+            secs.append((hadm_id, note.row_id, note.category, sec.id,
+                         sec.name, begin, end))
+            cuis.extend(map(
+                lambda c: (c[0], hadm_id, note.row_id, sec.id, c[1]),
+                self._get_cuis(doc, begin, end)))
+        conn: sqlite3.Connection = self._get_conn()
+        with conn:
+            conn.execute('delete from section where hadm_id = ?', (hadm_id,))
+            conn.execute('delete from concept where hadm_id = ?', (hadm_id,))
+            conn.executemany(
+                'insert into section values (?, ?, ?, ?, ?, ?, ?)', secs)
+            conn.executemany(
+                'insert into concept values (?, ?, ?, ?, ?)', cuis)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'indexed admission {hadm_id}: {len(secs)} ' +
+                         f'sections, {len(cuis)} concepts')
+
+    def delete(self, hadm_id: str):
+        """Remove an admission from the index."""
+        conn: sqlite3.Connection = self._get_conn()
+        with conn:
+            conn.execute('delete from section where hadm_id = ?',
+                         (str(hadm_id),))
+            conn.execute('delete from concept where hadm_id = ?',
+                         (str(hadm_id),))
+
+    def query(self, sec_name: str = None, category: str = None,
+              cui: str = None, limit: int = None) -> Tuple[AdmissionSpan, ...]:
+        """Find the spans that match all given criteria.  When ``cui`` is
+        given, a span is returned for each sentence that has the concept,
+        otherwise a span is returned for each section.
+
+        :param sec_name: the section name (i.e. ``discharge-diagnosis``)
+
+        :param category: the note category (i.e. ``discharge-summary``)
+
+        :param cui: the concept unique identifier (i.e. ``C0011849``)
+
+        :param limit: the maximum number of spans to return
+
+        """
+        cols: str = ', '.join(map(lambda c: f's.{c}', self._SPAN_COLS.split()))
+        sql: str
+        where: List[str] = []
+        params: List[Any] = []
+        if cui is None:
+            sql = f'select {cols} from section s'
+        else:
+            sql = (f'select {cols}, c.sent from concept c join section s ' +
+                   'on c.hadm_id = s.hadm_id and c.row_id = s.row_id and ' +
+                   'c.sec_id = s.sec_id')
+            where.append('c.cui = ?')
+            params.append(cui)
+        # the indexes use spaces in place of dashes
+        if sec_name is not None:
+            where.append('s.sec_name = ?')
+            params.append(sec_name.replace('-', ' '))
+        if category is not None:
+            where.append('s.category = ?')
+            params.append(category.replace('-', ' '))
+        if len(where) > 0:
+            sql += ' where ' + ' and '.join(where)
+        sql += ' order by s.hadm_id, s.begin' + \
+            ('' if cui is None else ', c.sent')
+        if limit is not None:
+            sql += ' limit ?'
+            params.append(limit)
+
+        def map_row(row: Tuple[Any, ...]) -> AdmissionSpan:
+            span: Tuple[int, int] = tuple(row[5:7]) if cui is None \
+                else (row[7], row[7] + 1)
+            return AdmissionSpan(str(row[0]), *row[1:5], span=span)
+
+        return tuple(map(map_row, self._get_conn().execute(sql, params)))
+
+    def create_documents(self, spans: Iterable[AdmissionSpan],
+                         stash: Stash) -> \
+            Iterable[Tuple[AdmissionSpan, AmrFeatureDocument]]:
+        """Create the documents of spans.  If ``stash`` has a ``load_lazy``
+        method (see :class:`~zensols.clinicamr.serial.AdmissionAmrCompactStash`)
+        only the sentences of the spans are read.  Otherwise, each admission
+        is loaded once.
+
+        :param spans: the spans to create, such as those from :meth:`query`
+
+        :param stash: the (cache) stash of the admissions
+
+        :return: ``(<span>, <document>)`` tuples in the order of ``spans``
+
+        """
+        lazy: bool = hasattr(stash, 'load_lazy')
+        hadm_id: str = None
+        adm: Any = None
+        try:
+            span: AdmissionSpan
+            for span in spans:
+                if span.hadm_id != hadm_id:
+                    if lazy and adm is not None:
+                        adm.close()
+                    hadm_id = span.hadm_id
+                    adm = stash.load_lazy(hadm_id) if lazy \
+                        else stash.load(hadm_id)
+                if adm is None:
+                    logger.warning(f'no admission {hadm_id} for {span}')
+                    continue
+                doc: AmrFeatureDocument = adm.create_span_document(*span.span) \
+                    if lazy else adm.span_index.create_view(*span.span)
+                yield (span, doc)
+        finally:
+            if lazy and adm is not None:
+                adm.close()
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return the number of indexed admissions, sections and concepts."""
+        conn: sqlite3.Connection = self._get_conn()
+        return {
+            'admissions': conn.execute(
+                'select count(distinct hadm_id) from section').fetchone()[0],
+            'sections': conn.execute(
+                'select count(*) from section').fetchone()[0],
+            'concepts': conn.execute(
+                'select count(*) from concept').fetchone()[0]}
+
+    def clear(self):
+        """Remove the index database."""
+        conn: sqlite3.Connection = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.pid = None
+        path: Path
+        for path in (self.path, Path(f'{self.path}-wal'),
+                     Path(f'{self.path}-shm')):
+            if path.is_file():
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(f'deleting: {path}')
+                path.unlink()
@@ -0,0 +1,181 @@
+"""Per stage timing instrumentation of the clinical AMR pipeline.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import Dict, List, Tuple, Any, Iterator, ContextManager
+from dataclasses import dataclass, field
+import sys
+import os
+import json
+import time
+import uuid
+import threading
+import logging
+from contextlib import contextmanager, nullcontext
+from io import TextIOBase
+from pathlib import Path
+from zensols.config import Writable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StageStats(object):
+    """The aggregated measurements of a pipeline stage."""
+
+    count: int = field(default=0)
+    """The number of times the stage ran."""
+
+    wall: float = field(default=0)
+    """The total wall time in seconds."""
+
+    max_wall: float = field(default=0)
+    """The longest wall time of a single run in seconds."""
+
+    nbytes: int = field(default=0)
+    """The number of UTF-8 encoded text bytes processed."""
+
+    def add(self, wall: float, nbytes: int):
+        self.count += 1
+        self.wall += wall
+        self.max_wall = max(self.max_wall, wall)
+        self.nbytes += nbytes
+
+
+@dataclass
+class PipelineInstrument(Writable):
+    """Records the wall time, count and bytes processed of each stage of the
+    pipeline, such as the SPRING parse, decorators, caching and coreference
+    resolution.  Stages are measured with :meth:`measure` and summarized with
+    :meth:`write`.  If :obj:`trace_path` is set, each measurement is also
+    appended as a JSON line to that file by :meth:`flush`, which is how
+    measurements of child processes (see
+    :class:`~zensols.clinicamr.adm.AdmissionAmrBatchStash`) are collected.
+    Each event is tagged with the :obj:`run_id` of the instance, which forked
+    child processes share with their parent, so runs appended to the same
+    file can be summarized separately.
+
+    Stages measured while another stage is running on the same thread are
+    nested, and are not added to the total time.
+
+    """
+    enabled: bool = field(default=False)
+    """Whether to record measurements."""
+
+    trace_path: Path = field(default=None)
+    """The JSON lines file of measurement events, or ``None`` to not trace."""
+
+    def __post_init__(self):
+        if isinstance(self.trace_path, str):
+            self.trace_path = Path(self.trace_path)
+        self.run_id: str = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+        self._stats: Dict[str, StageStats] = {}
+        self._total: float = 0
+        self._events: List[Dict[str, Any]] = []
+
+    def _add(self, stage: str, wall: float, nbytes: int, depth: int):
+        self._stats.setdefault(stage, StageStats()).add(wall, nbytes)
+        if depth == 0:
+            self._total += wall
+
+    @contextmanager
+    def _measure(self, stage: str, nbytes: int) -> Iterator[None]:
+        depth: int = getattr(self._depth, 'depth', 0)
+        self._depth.depth = depth + 1
+        # the clock time is only the trace timestamp since it can be adjusted
+        start: float = time.time()
+        t0: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall: float = time.perf_counter() - t0
+            self._depth.depth = depth
+            with self._lock:
+                self._add(stage, wall, nbytes, depth)
+                if self.trace_path is not None:
+                    self._events.append(dict(
+                        run=self.run_id, stage=stage, start=start, wall=wall,
+                        nbytes=nbytes, depth=depth, pid=os.getpid(),
+                        tid=threading.get_ident()))
+
+    def measure(self, stage: str, nbytes: int = 0) -> ContextManager:
+        """Return a context manager that records the time of a stage.
+
+        :param stage: the name of the pipeline stage
+
+        :param nbytes: the number of bytes processed by the stage
+
+        """
+        if self.enabled:
+            return self._measure(stage, nbytes)
+        return nullcontext()
+
+    @property
+    def stats(self) -> Dict[str, StageStats]:
+        """The measurements by stage name."""
+        with self._lock:
+            return dict(self._stats)
+
+    @property
+    def total(self) -> float:
+        """The wall time in seconds of the stages that are not nested."""
+        with self._lock:
+            return self._total
+
+    def flush(self):
+        """Append recorded events to the :obj:`trace_path` file."""
+        if self.trace_path is None:
+            return
+        with self._lock:
+            events: List[Dict[str, Any]] = self._events
+            self._events = []
+        if len(events) > 0:
+            self.trace_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.trace_path, 'a') as f:
+                f.write(''.join(map(lambda e: json.dumps(e) + '\n', events)))
+
+    def reset(self):
+        """Clear all measurements (but not the trace file)."""
+        with self._lock:
+            self._stats.clear()
+            self._total = 0
+            self._events.clear()
+
+    @classmethod
+    def from_trace(cls, trace_path: Path, run_id: str = None) -> \
+            PipelineInstrument:
+        """Create an instance with the measurements of a trace file written by
+        (possibly several processes') :meth:`flush`.
+
+        :param trace_path: the JSON lines trace file
+
+        :param run_id: the :obj:`run_id` of the measurements to read, or
+                       ``None`` for the last run in the file
+
+        """
+        inst = cls(enabled=True)
+        with open(trace_path) as f:
+            events: Tuple[Dict[str, Any], ...] = tuple(map(json.loads, f))
+        if run_id is None and len(events) > 0:
+            run_id = events[-1].get('run')
+        event: Dict[str, Any]
+        for event in filter(lambda e: e.get('run') == run_id, events):
+            inst._add(event['stage'], event['wall'], event['nbytes'],
+                      event.get('depth', 0))
+        return inst
+
+    def write(self, depth: int = 0, writer: TextIOBase = sys.stdout):
+        stats: Dict[str, StageStats] = self.stats
+        name: str
+        stat: StageStats
+        for name, stat in sorted(stats.items(), key=lambda s: -s[1].wall):
+            mean: float = stat.wall / stat.count if stat.count > 0 else 0
+            self._write_line(
+                f'{name}: {stat.wall:.2f}s, count={stat.count}, ' +
+                f'mean={mean * 1000:.1f}ms, max={stat.max_wall:.2f}s, ' +
+                f'bytes={stat.nbytes}', depth, writer)
+        self._write_line(f'total: {self.total:.2f}s', depth, writer)
@@ -4,17 +4,32 @@
 """
 __author__ = 'Paul Landes'
 
-from typing import Dict, Tuple, Sequence, Iterable
+from typing import Dict, Tuple, List, Set, Sequence, Iterable, Any, Optional
 from dataclasses import dataclass, field
+import dataclasses
 import logging
-from zensols.persist import Stash
+import hashlib
+import itertools as it
+import copy
+import threading
+from enum import Enum
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from penman.graph import Graph, Attribute
+from zensols.persist import Stash, persisted
 from zensols.nlp import (
     LexicalSpan, FeatureSentence, FeatureDocument, FeatureDocumentDecorator,
     FeatureSentenceDecorator
 )
 from zensols.amr import AmrSentence, AmrFeatureSentence, AmrFeatureDocument
+from zensols.amr.model import AmrParser
 from zensols.amr.annotate import AnnotationFeatureDocumentParser
+from zensols.amr.docparser import TokenAnnotationFeatureDocumentDecorator
 from zensols.mimic import ParagraphFactory, Section
+from .domain import ClinicAmrError, CacheFingerprint
+from .spring import SpringAmrParser
+from .instrument import PipelineInstrument
+from .failure import ParagraphFailureCache
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +44,39 @@ class ClinicAmrParagraphFactory(ParagraphFactory):
 
     A list of :class:`~zensols.amr.doc.AmrFeatureDocument` are returned.
 
+    If :obj:`content_key` is ``True``, paragraphs are cached by a hash of their
+    normalized text and :obj:`parser_id` so identical paragraphs (i.e.
+    boilerplate discharge instructions and copied forward notes) are parsed
+    only once across the corpus.  The ``id`` and ``is_header`` metadata are
+    then added each time the paragraph is created since they depend on the
+    note and section of the paragraph.
+
+    If :obj:`annotate_workers` is greater than 0, the paragraphs of a section
+    that are not cached are annotated concurrently in a thread pool, which
+    overlaps the (SPRING) parser's requests with decoration.  Cached
+    paragraphs are not given to the pool, and the paragraphs are returned in
+    section order.
+
+    Instances are thread safe when :obj:`stash` is (such as
+    :class:`~zensols.persist.DirectoryStash` and
+    :class:`~zensols.clinicamr.stash.ShardedSqliteStash`) so :meth:`create`
+    can be called from several threads.  Paragraphs are parsed with
+    :obj:`parse_annotator` so the shared :obj:`amr_annotator` is never
+    modified.
+
+    Cached paragraphs are stamped with the :obj:`fingerprint` of the
+    configuration they were created with.  When the parser or medical parser
+    changes, a cached paragraph is parsed again when it is next created.  When
+    only the settings applied after parsing change (such as the CUI format),
+    the annotated attributes and metadata are removed and the paragraph is
+    decorated again without parsing.  Paragraphs cached by previous versions
+    (without a fingerprint) are decorated again.
+
     """
+    _FINGERPRINT_ATTR = 'cache_fingerprint'
+    _CACHE_KEY_ATTR = 'cache_key'
+    _LOCATION_METADATA = ('id', 'is_header')
+
     delegate: ParagraphFactory = field()
     """The paragraph factory that chunks the paragraphs."""
 
@@ -68,9 +115,125 @@ class ClinicAmrParagraphFactory(ParagraphFactory):
     """Whether to remove empty sentences from paragraphs. If ``True`` empty
     paragraphs are skipped.
 
+    """
+    amr_parser: AmrParser = field(default=None)
+    """The parser used by :obj:`amr_annotator`.  If this is a
+    :class:`~zensols.clinicamr.spring.SpringAmrParser`, the sentences of all
+    uncached paragraphs of a section are parsed in batches before the
+    paragraphs are annotated.
+
+    """
+    content_key: bool = field(default=False)
+    """Whether to cache paragraphs by the hash of their normalized text
+    rather than by their note, section and paragraph index.
+
+    """
+    parser_id: str = field(default=None)
+    """Identifies the AMR parser and model used to parse the paragraphs, which
+    is part of the content hash of :obj:`content_key`.
+
+    """
+    doc_parser_id: str = field(default=None)
+    """Identifies the medical parser that parsed the paragraphs' features,
+    which is part of the :obj:`fingerprint`.
+
+    """
+    instrument: PipelineInstrument = field(default_factory=PipelineInstrument)
+    """Records the time spent in chunking, parsing, decorating and caching."""
+
+    annotate_workers: int = field(default=0)
+    """The number of threads used to concurrently annotate the paragraphs of
+    a section that are not cached, or 0 to annotate them one at a time.
+
+    """
+    failure_cache: ParagraphFailureCache = field(default=None)
+    """Records paragraphs that could not be parsed so they are skipped rather
+    than parsed again, or ``None`` to always parse them.
+
     """
     def __post_init__(self):
         Section.FILTER_ENUMS = False
+        self._parse_annotator: AnnotationFeatureDocumentParser = None
+        self._parse_annotator_lock = threading.Lock()
+
+    @property
+    def parse_annotator(self) -> AnnotationFeatureDocumentParser:
+        """A shallow copy of :obj:`amr_annotator` without its coreference
+        resolver, which is used to parse paragraphs since coreferences are
+        resolved over the admission.  The copy shares the annotator's models
+        and parser.
+
+        """
+        with self._parse_annotator_lock:
+            if self._parse_annotator is None:
+                anon: AnnotationFeatureDocumentParser = \
+                    copy.copy(self.amr_annotator)
+                anon.coref_resolver = None
+                self._parse_annotator = anon
+            return self._parse_annotator
+
+    @classmethod
+    def _get_settings(cls, obj: Any) -> Any:
+        """Return a representation of a decorator's class name and fields, or
+        of a field's value, with a stable :func:`repr`.
+
+        :raises ClinicAmrError: if a value can not be represented
+
+        """
+        if obj is None or isinstance(obj, (str, int, float, bool)):
+            return obj
+        if isinstance(obj, Enum):
+            return f'{type(obj).__name__}.{obj.name}'
+        if isinstance(obj, Path):
+            return str(obj)
+        if isinstance(obj, (list, tuple)):
+            return tuple(map(cls._get_settings, obj))
+        if isinstance(obj, (set, frozenset)):
+            return tuple(sorted(map(cls._get_settings, obj), key=repr))
+        if isinstance(obj, dict):
+            return tuple(sorted(
+                map(lambda kv: (cls._get_settings(kv[0]),
+                                cls._get_settings(kv[1])), obj.items()),
+                key=repr))
+        if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+            return (type(obj).__name__,) + tuple(map(
+                lambda f: (f.name,
+                           cls._get_settings(getattr(obj, f.name, None))),
+                filter(lambda f: f.init, dataclasses.fields(obj))))
+        raise ClinicAmrError(
+            f'Can not fingerprint setting of type {type(obj)}: {obj}')
+
+    @staticmethod
+    def _hash(*settings: Any) -> str:
+        return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+    def _get_annotation_decorators(self) -> \
+            Tuple[TokenAnnotationFeatureDocumentDecorator, ...]:
+        """Return the annotator's decorators that add graph attributes."""
+        return tuple(filter(
+            lambda d: isinstance(d, TokenAnnotationFeatureDocumentDecorator) and
+            d.method == 'attribute',
+            self.parse_annotator.document_decorators))
+
+    @property
+    @persisted('_fingerprint')
+    def fingerprint(self) -> CacheFingerprint:
+        """The fingerprint of the configuration that affects cached paragraphs.
+        The ``id`` and ``is_header`` metadata are only part of it when
+        :obj:`content_key` is ``False`` since they are otherwise not cached.
+
+        """
+        decs: Tuple[Any, ...] = \
+            tuple(self.parse_annotator.document_decorators) + \
+            tuple(self.sentence_decorators) + tuple(self.document_decorators)
+        settings: Tuple[Any, ...] = (tuple(map(self._get_settings, decs)),)
+        if not self.content_key:
+            settings += (self.id_format, self.add_is_header)
+        return CacheFingerprint(
+            parse=self._hash(self.parser_id, self.doc_parser_id),
+            decorate=self._hash(*settings),
+            roles=tuple(map(lambda d: f':{d.name}',
+                            self._get_annotation_decorators())))
 
     def _add_id(self, nid: int, sec: Section, pix: int,
                 doc: AmrFeatureDocument):
@@ -86,7 +249,8 @@ class ClinicAmrParagraphFactory(ParagraphFactory):
                     sent_id=six)
             sent.metadata = meta
 
-    def _add_is_header(self, sec: Section, sent: AmrFeatureSentence):
+    def _add_is_header(self, sec: Section, sent: AmrFeatureSentence,
+                       lexspan: LexicalSpan):
         hspans: Tuple[LexicalSpan, ...] = ()
         if len(sec.header_spans) > 0:
             off: int = sec.header_spans[0].begin
@@ -94,50 +258,331 @@ class ClinicAmrParagraphFactory(ParagraphFactory):
                 lambda hs: LexicalSpan(off - hs[0], off - hs[1]),
                 sec.header_spans))
         is_header: bool = any(map(
-            lambda hs: sent.lexspan.overlaps_with(hs), hspans))
+            lambda hs: lexspan.overlaps_with(hs), hspans))
         sent.amr.set_metadata('is_header', 'true' if is_header else 'false')
 
-    def _get_doc(self, sec: Section, pix: int, para: FeatureDocument) -> \
-            AmrFeatureDocument:
-        nid: int = sec.container.row_id
-        pid: str = f'{nid}-{sec.id}-{pix}'
-        fdoc: AmrFeatureDocument = self.stash.load(pid)
-        if fdoc is None:
-            cr = self.amr_annotator.coref_resolver
-            self.amr_annotator.coref_resolver = None
+    def _get_key(self, sec: Section, pix: int) -> str:
+        """Return the note, section and paragraph index key of a paragraph."""
+        return f'{sec.container.row_id}-{sec.id}-{pix}'
+
+    def _get_content_key(self, para: FeatureDocument) -> str:
+        """Return the hash of the paragraph's normalized text and parser."""
+        text: str = ' '.join(para.norm.split())
+        return hashlib.sha1(f'{self.parser_id}\n{text}'.encode()).hexdigest()
+
+    def _get_cache_key(self, sec: Section, pix: int,
+                       para: FeatureDocument) -> str:
+        """Return the key of the paragraph in :obj:`stash`."""
+        if self.content_key:
+            # hashing the text is cheaper than reading a stored key, and
+            # follows changes to the text and parser
+            return self._get_content_key(para)
+        return self._get_key(sec, pix)
+
+    @classmethod
+    def get_cache_key(cls, para: FeatureDocument) -> Optional[str]:
+        """Return the :obj:`stash` key of a paragraph returned by
+        :meth:`create`, or ``None`` if it was not created by this class.
+
+        """
+        return getattr(para, cls._CACHE_KEY_ATTR, None)
+
+    def prefetch(self, paras: Iterable[FeatureDocument]):
+        """Send the sentences of paragraphs to the parser in as few requests as
+        possible if :obj:`amr_parser` is a :class:`.SpringAmrParser` (see
+        :meth:`.SpringAmrParser.prefetch`).
+
+        """
+        if not isinstance(self.amr_parser, SpringAmrParser):
+            return
+        sents: List[str] = list(map(
+            lambda s: s.text,
+            it.chain.from_iterable(map(lambda p: p.sents, paras))))
+        if len(sents) > 0:
             try:
-                fdoc = self.amr_annotator.annotate(para)
-            finally:
-                self.amr_annotator.coref_resolver = cr
-            sdec: FeatureSentenceDecorator
-            for sdec in self.sentence_decorators:
-                sent: FeatureSentence
-                for sent in fdoc.sents:
-                    sdec.decorate(sent)
-            dec: FeatureDocumentDecorator
-            for dec in self.document_decorators:
-                dec.decorate(fdoc)
-            if self.id_format is not None:
-                self._add_id(nid, sec, pix, fdoc)
-            if self.add_is_header:
-                for s in fdoc:
-                    self._add_is_header(sec, s)
-            self.stash.dump(pid, fdoc)
+                with self.instrument.measure('spring_prefetch'):
+                    self.amr_parser.prefetch(sents)
+            except Exception as e:
+                # paragraphs are parsed individually when prefetching fails
+                logger.warning(f'Could not prefetch paragraphs: {e}')
+
+    def _is_failed(self, key: str) -> bool:
+        """Whether a paragraph failed to parse and should not be parsed again
+        (see :obj:`failure_cache`).
+
+        """
+        if self.failure_cache is None:
+            return False
+        failed: bool = self.failure_cache.get_skip(key) is not None
+        if failed and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'skipping failed paragraph: {key}')
+        return failed
+
+    def _annotate_key(self, key: str, para: FeatureDocument) -> \
+            AmrFeatureDocument:
+        """Annotate a paragraph and record whether it failed to parse."""
+        try:
+            fdoc: AmrFeatureDocument = self.annotate(para)
+        except Exception as e:
+            if self.failure_cache is not None:
+                self.failure_cache.add(key, para.text, e)
+            raise e
+        if self.failure_cache is not None:
+            self.failure_cache.remove(key)
         return fdoc
 
-    def create(self, sec: Section) -> Iterable[FeatureDocument]:
-        paras: Iterable[FeatureDocument] = self.delegate.create(sec)
+    def _decorate(self, fdoc: AmrFeatureDocument):
+        """Apply :obj:`sentence_decorators` and :obj:`document_decorators`."""
+        sdec: FeatureSentenceDecorator
+        for sdec in self.sentence_decorators:
+            sent: FeatureSentence
+            for sent in fdoc.sents:
+                sdec.decorate(sent)
+        dec: FeatureDocumentDecorator
+        for dec in self.document_decorators:
+            dec.decorate(fdoc)
+
+    def annotate(self, para: FeatureDocument) -> AmrFeatureDocument:
+        """Parse, annotate and decorate a paragraph.  This is used for text
+        that is not from a note, and the document is not cached.
+
+        """
+        with self.instrument.measure('annotate', len(para.text.encode())):
+            fdoc: AmrFeatureDocument = self.parse_annotator.annotate(para)
+        with self.instrument.measure('decorate'):
+            self._decorate(fdoc)
+        return fdoc
+
+    def _redecorate(self, fdoc: AmrFeatureDocument, prev: CacheFingerprint):
+        """Remove the annotated attributes (and location metadata) of a cached
+        paragraph and decorate it again with the current configuration.
+
+        :param prev: the fingerprint the paragraph was cached with, or ``None``
+                     if unknown
+
+        """
+        roles: Set[str] = set(self.fingerprint.roles)
+        if prev is not None:
+            roles.update(prev.roles)
+
+        def is_annotation(attr: Attribute) -> bool:
+            # indexed decorators add a number to the role
+            return attr.role in roles or attr.role.rstrip('0123456789') in roles
+
+        sent: AmrFeatureSentence
+        for sent in fdoc.sents:
+            if sent.is_failure:
+                continue
+            graph: Graph = sent.amr.graph
+            attrs: Set[Attribute] = set(filter(
+                is_annotation, graph.attributes()))
+            if len(attrs) > 0:
+                graph.triples = list(filter(
+                    lambda t: t not in attrs, graph.triples))
+                attr: Attribute
+                for attr in attrs:
+                    graph.epidata.pop(attr, None)
+            if not self.content_key:
+                name: str
+                for name in self._LOCATION_METADATA:
+                    graph.metadata.pop(name, None)
+            sent.amr.invalidate_graph_string()
+        dec: FeatureDocumentDecorator
+        for dec in self.parse_annotator.document_decorators:
+            dec.decorate(fdoc)
+        self._decorate(fdoc)
+
+    def _add_metadata(self, sec: Section, pix: int, para: FeatureDocument,
+                      fdoc: AmrFeatureDocument):
+        """Add the metadata that depends on the paragraph's location."""
+        if self.id_format is not None:
+            self._add_id(sec.container.row_id, sec, pix, fdoc)
+        if self.add_is_header:
+            # use the source paragraph offsets since content keyed documents
+            # have those of the first paragraph parsed with the same text
+            sents: Tuple[FeatureSentence, ...] = para.sents \
+                if len(para.sents) == len(fdoc.sents) else fdoc.sents
+            s: AmrFeatureSentence
+            ps: FeatureSentence
+            for s, ps in zip(fdoc, sents):
+                self._add_is_header(sec, s, ps.lexspan)
+
+    def _dump(self, key: str, fdoc: AmrFeatureDocument):
+        with self.instrument.measure('paragraph_cache_dump'):
+            self.stash.dump(key, fdoc)
+
+    def _load(self, sec: Section, pix: int, para: FeatureDocument) -> \
+            Tuple[str, AmrFeatureDocument, bool]:
+        """Return the cache key and cached document (if any) of a paragraph,
+        and whether the document must be decorated again.  Documents cached
+        with a different parse configuration are not returned so they are
+        parsed again.
+
+        """
+        with self.instrument.measure('paragraph_cache_load'):
+            key: str = self._get_cache_key(sec, pix, para)
+            fdoc: AmrFeatureDocument = self.stash.load(key)
+        stale: bool = False
+        if fdoc is not None:
+            prev: CacheFingerprint = getattr(fdoc, self._FINGERPRINT_ATTR, None)
+            if prev is not None and not self.fingerprint.is_parse(prev):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'parsing stale paragraph: {key}')
+                fdoc = None
+            else:
+                stale = prev != self.fingerprint
+        return key, fdoc, stale
+
+    def _load_section(self, sec: Section,
+                      paras: Tuple[FeatureDocument, ...]) -> \
+            List[Tuple[int, FeatureDocument, str, AmrFeatureDocument, bool]]:
+        """Load the paragraphs of a section (see :meth:`_load`) without those
+        that are empty or failed to parse.
+
+        """
+        loaded: List[Tuple[int, FeatureDocument, str,
+                           AmrFeatureDocument, bool]] = []
+        pix: int
         para: FeatureDocument
         for pix, para in enumerate(paras):
-            if self.remove_empty_sentences:
-                para.sents = tuple(filter(
-                    lambda s: len(s.norm.strip()) > 0,
-                    para.sents))
-            if len(para.sents) == 0:
-                continue
+            if para is not None:
+                key: str
+                fdoc: AmrFeatureDocument
+                stale: bool
+                key, fdoc, stale = self._load(sec, pix, para)
+                if fdoc is not None or not self._is_failed(key):
+                    loaded.append((pix, para, key, fdoc, stale))
+        return loaded
+
+    def _complete(self, sec: Section, pix: int, para: FeatureDocument,
+                  key: str, fdoc: AmrFeatureDocument, parsed: bool,
+                  stale: bool = False) -> AmrFeatureDocument:
+        """Add metadata to a paragraph document and cache it if ``parsed`` or
+        decorated again because it is ``stale``.
+
+        """
+        if stale:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'decorating stale paragraph: {key}')
+            with self.instrument.measure('redecorate'):
+                self._redecorate(
+                    fdoc, getattr(fdoc, self._FINGERPRINT_ATTR, None))
+        dump: bool = parsed or stale
+        if dump:
+            setattr(fdoc, self._FINGERPRINT_ATTR, self.fingerprint)
+        if self.content_key:
+            if dump:
+                self._dump(key, fdoc)
+            self._add_metadata(sec, pix, para, fdoc)
+        elif dump:
+            self._add_metadata(sec, pix, para, fdoc)
+            self._dump(key, fdoc)
+        # added after dumping since it is only used by the creator
+        setattr(fdoc, self._CACHE_KEY_ATTR, key)
+        return fdoc
+
+    def _annotate_measured(self, key: str, para: FeatureDocument) -> \
+            AmrFeatureDocument:
+        """Annotate a paragraph in the same stage :meth:`create` uses when
+        paragraphs are annotated one at a time.
+
+        """
+        with self.instrument.measure('paragraph', len(para.text.encode())):
+            return self._annotate_key(key, para)
+
+    def _create_concurrent(
+            self, sec: Section,
+            loaded: List[Tuple[int, FeatureDocument, str,
+                               AmrFeatureDocument, bool]]) -> \
+            List[AmrFeatureDocument]:
+        """Annotate the uncached paragraphs of a section in a thread pool and
+        return all paragraph documents in their original order.
+
+        """
+        n_misses: int = sum(map(lambda p: p[3] is None, loaded))
+        docs: List[AmrFeatureDocument] = []
+        with ThreadPoolExecutor(
+                max_workers=max(min(self.annotate_workers, n_misses), 1),
+                thread_name_prefix='camr-para') as pool:
+            futs: Dict[int, Future] = dict(map(
+                lambda p: (p[0], pool.submit(
+                    self._annotate_measured, p[2], p[1])),
+                filter(lambda p: p[3] is None, loaded)))
+            pix: int
+            para: FeatureDocument
+            key: str
+            fdoc: AmrFeatureDocument
+            stale: bool
+            for pix, para, key, fdoc, stale in loaded:
+                try:
+                    parsed: bool = fdoc is None
+                    if parsed:
+                        fdoc = futs[pix].result()
+                        docs.append(self._complete(
+                            sec, pix, para, key, fdoc, parsed, stale))
+                    else:
+                        nbytes: int = len(para.text.encode())
+                        with self.instrument.measure('paragraph', nbytes):
+                            docs.append(self._complete(
+                                sec, pix, para, key, fdoc, parsed, stale))
+                except Exception as e:
+                    msg: str = f'Could not parse AMR for <{para.text}>: {e}'
+                    logging.exception(msg)
+        return docs
+
+    def _filter_para(self, para: FeatureDocument) -> FeatureDocument:
+        """Remove empty sentences and return ``None`` for empty paragraphs."""
+        if self.remove_empty_sentences:
+            para.sents = tuple(filter(
+                lambda s: len(s.norm.strip()) > 0,
+                para.sents))
+        return None if len(para.sents) == 0 else para
+
+    def _chunk(self, sec: Section) -> Tuple[FeatureDocument, ...]:
+        """Chunk a section in to paragraphs with :obj:`delegate`, which are
+        ``None`` when empty so the indexes of the others are kept.
+
+        """
+        with self.instrument.measure('chunk', len(sec.body.encode())):
+            return tuple(map(self._filter_para, self.delegate.create(sec)))
+
+    def chunk(self, sec: Section) -> Tuple[FeatureDocument, ...]:
+        """Return the non-empty paragraphs of a section that are not yet
+        parsed.  This is used with :meth:`prefetch` and :meth:`annotate` for
+        text that is not from a note.
+
+        """
+        return tuple(filter(lambda p: p is not None, self._chunk(sec)))
+
+    def create(self, sec: Section) -> Iterable[FeatureDocument]:
+        # paragraph indexes are kept for their cache keys
+        paras: Tuple[FeatureDocument, ...] = self._chunk(sec)
+        loaded: List[Tuple[int, FeatureDocument, str,
+                           AmrFeatureDocument, bool]] = \
+            self._load_section(sec, paras)
+        # parse the sentences of uncached (and stale) paragraphs in batches
+        self.prefetch(map(lambda p: p[1],
+                          filter(lambda p: p[3] is None, loaded)))
+        # a pool is not needed when all paragraphs are cached
+        if self.annotate_workers > 0 and \
+           any(map(lambda p: p[3] is None, loaded)):
+            yield from self._create_concurrent(sec, loaded)
+            return
+        pix: int
+        para: FeatureDocument
+        key: str
+        fdoc: AmrFeatureDocument
+        stale: bool
+        for pix, para, key, fdoc, stale in loaded:
             doc: FeatureDocument = None
             try:
-                doc = self._get_doc(sec, pix, para)
+                nbytes: int = len(para.text.encode())
+                with self.instrument.measure('paragraph', nbytes):
+                    parsed: bool = fdoc is None
+                    if parsed:
+                        fdoc = self._annotate_key(key, para)
+                    doc = self._complete(
+                        sec, pix, para, key, fdoc, parsed, stale)
             except Exception as e:
                 msg: str = f'Could not parse AMR for <{para.text}>: {e}'
                 logging.exception(msg)
@@ -0,0 +1,383 @@
+"""A compact binary format for serializing admission documents.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Dict, Any, Iterable, Sequence, Union, BinaryIO
+from dataclasses import dataclass, field
+import sys
+import logging
+import os
+import mmap
+import copy
+import pickle
+import struct
+import zlib
+import shutil
+from io import BytesIO, TextIOBase
+from array import array
+from pathlib import Path
+from zensols.config import Writable
+from zensols.persist import Stash
+from zensols.amr import AmrFeatureSentence, AmrFeatureDocument
+from .domain import (
+    ClinicAmrError, _ParagraphIndex, _SectionIndex, _NoteIndex,
+    ParseFailure, NoteDocument, AdmissionAmrFeatureDocument, _create_span_doc
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AdmissionAmrSerializer(object):
+    """Serializes :class:`~zensols.clinicamr.domain.AdmissionAmrFeatureDocument`
+    instances in a compact binary format.  The format is:
+
+      * a magic number and format version,
+
+      * the length of the header,
+
+      * the compressed header, which has the note indexes encoded as integer
+        arrays with a table of the (interned) category and section names, the
+        parse failures, the remaining document state and the offsets of each
+        sentence,
+
+      * the sentences, each separately compressed, so that any span of
+        sentences can be read without reading the others.
+
+    Since the notes' sentences are separately compressed, the file sizes are
+    much smaller than the pickled document and a note or section is read
+    without the others (see :class:`.AdmissionAmrCompactStash`).
+
+    """
+    MAGIC = b'CAMR'
+    """Identifies the format of the file."""
+
+    VERSION = 1
+    """The version of the format."""
+
+    _PREAMBLE = struct.Struct('<4sBQ')
+
+    compress_level: int = field(default=6)
+    """The :mod:`zlib` compression level."""
+
+    def _compress(self, obj: Any) -> bytes:
+        return zlib.compress(
+            pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL),
+            self.compress_level)
+
+    @staticmethod
+    def _decompress(data: bytes) -> Any:
+        return pickle.loads(zlib.decompress(data))
+
+    @staticmethod
+    def _encode_notes(notes: Iterable[_NoteIndex]) -> \
+            Tuple[array, Tuple[str, ...]]:
+        """Encode note indexes as a flat integer array and name table."""
+        names: Dict[str, int] = {}
+        arr = array('q')
+        note: _NoteIndex
+        for note in notes:
+            cat: int = names.setdefault(note.category, len(names))
+            arr.extend((note.row_id, cat, len(note.secs)))
+            sec: _SectionIndex
+            for sec in note.secs:
+                name: int = names.setdefault(sec.name, len(names))
+                arr.extend((sec.id, name, len(sec.paras)))
+                para: _ParagraphIndex
+                for para in sec.paras:
+                    arr.extend(para.span)
+        return arr, tuple(names.keys())
+
+    @staticmethod
+    def _decode_notes(arr: array, names: Tuple[str, ...]) -> \
+            Tuple[_NoteIndex, ...]:
+        """Decode note indexes encoded with :meth:`_encode_notes`."""
+        notes: List[_NoteIndex] = []
+        it: Iterable[int] = iter(arr)
+        for row_id in it:
+            cat: str = names[next(it)]
+            secs: List[_SectionIndex] = []
+            for _ in range(next(it)):
+                sec_id, name, n_paras = next(it), names[next(it)], next(it)
+                paras: Tuple[_ParagraphIndex, ...] = tuple(map(
+                    lambda _: _ParagraphIndex(span=(next(it), next(it))),
+                    range(n_paras)))
+                secs.append(_SectionIndex(id=sec_id, name=name, paras=paras))
+            notes.append(_NoteIndex(
+                row_id=row_id, category=cat, secs=tuple(secs)))
+        return tuple(notes)
+
+    def write(self, doc: AdmissionAmrFeatureDocument, writer: BinaryIO):
+        """Write an admission in the compact format.
+
+        :param doc: the admission to serialize
+
+        :param writer: the binary stream to write the data
+
+        """
+        sents: Tuple[bytes, ...] = tuple(map(self._compress, doc.sents))
+        offsets = array('q', [0])
+        sent: bytes
+        for sent in sents:
+            offsets.append(offsets[-1] + len(sent))
+        notes, names = self._encode_notes((doc._ds_ix,) + doc._ant_ixs)
+        # keep any other state (i.e. coreference) but not the sentences or
+        # indexes, which are stored separately
+        state: AdmissionAmrFeatureDocument = copy.copy(doc)
+        state.sents = ()
+        state.amr = copy.copy(doc.amr)
+        state.amr.sents = ()
+        state._ds_ix = None
+        state._ant_ixs = None
+        state.parse_fails = None
+        state.__dict__.pop('_span_index_memo', None)
+        header: bytes = self._compress(dict(
+            notes=notes.tobytes(),
+            names=names,
+            offsets=offsets.tobytes(),
+            parse_fails=doc.parse_fails,
+            state=state))
+        writer.write(self._PREAMBLE.pack(
+            self.MAGIC, self.VERSION, len(header)))
+        writer.write(header)
+        for sent in sents:
+            writer.write(sent)
+
+    def read_header(self, reader: BinaryIO) -> Dict[str, Any]:
+        """Read only the header of an admission written with :meth:`write`.
+
+        :return: a dictionary with the decoded note indexes (``notes``), the
+                 sentence offsets relative to the first (``offsets``), the
+                 position of the first sentence (``start``), the parse
+                 failures (``parse_fails``) and document ``state``
+
+        """
+        magic, ver, hlen = self._PREAMBLE.unpack(
+            reader.read(self._PREAMBLE.size))
+        if magic != self.MAGIC or ver != self.VERSION:
+            raise ClinicAmrError(f'Unknown admission format: {magic}/{ver}')
+        header: Dict[str, Any] = self._decompress(reader.read(hlen))
+        notes = array('q')
+        notes.frombytes(header['notes'])
+        offsets = array('q')
+        offsets.frombytes(header['offsets'])
+        header['notes'] = self._decode_notes(notes, header.pop('names'))
+        header['offsets'] = offsets
+        header['start'] = self._PREAMBLE.size + hlen
+        return header
+
+    def read_sents(self, data: bytes, offsets: array, begin: int, end: int) -> \
+            Tuple[AmrFeatureSentence, ...]:
+        """Decode sentences in range ``[begin, end)`` from the data (or memory
+        map) that starts at the first sentence.
+
+        """
+        return tuple(map(
+            lambda i: self._decompress(data[offsets[i]:offsets[i + 1]]),
+            range(begin, end)))
+
+    def read(self, reader: BinaryIO) -> AdmissionAmrFeatureDocument:
+        """Read an admission written with :meth:`write`."""
+        header: Dict[str, Any] = self.read_header(reader)
+        offsets: array = header['offsets']
+        sents: Tuple[AmrFeatureSentence, ...] = self.read_sents(
+            reader.read(), offsets, 0, len(offsets) - 1)
+        notes: Tuple[_NoteIndex, ...] = header['notes']
+        doc: AdmissionAmrFeatureDocument = header['state']
+        doc.sents = sents
+        doc.amr.sents = tuple(map(lambda s: s.amr, sents))
+        doc._ds_ix = notes[0]
+        doc._ant_ixs = notes[1:]
+        doc.parse_fails = header['parse_fails']
+        return doc
+
+    def dumps(self, doc: AdmissionAmrFeatureDocument) -> bytes:
+        """Serialize an admission to bytes."""
+        bio = BytesIO()
+        self.write(doc, bio)
+        return bio.getvalue()
+
+    def loads(self, data: bytes) -> AdmissionAmrFeatureDocument:
+        """Deserialize an admission from bytes."""
+        return self.read(BytesIO(data))
+
+
+class _LazySentences(Sequence[AmrFeatureSentence]):
+    """A sequence of sentences decoded from a memory mapped admission file
+    only when they are accessed.
+
+    """
+    def __init__(self, serializer: AdmissionAmrSerializer, data: memoryview,
+                 offsets: array):
+        self._serializer = serializer
+        self._data = data
+        self._offsets = offsets
+        self._sents: Dict[int, AmrFeatureSentence] = {}
+
+    def _get(self, ix: int) -> AmrFeatureSentence:
+        sent: AmrFeatureSentence = self._sents.get(ix)
+        if sent is None:
+            sent = self._serializer.read_sents(
+                self._data, self._offsets, ix, ix + 1)[0]
+            self._sents[ix] = sent
+        return sent
+
+    def __getitem__(self, ix: Union[int, slice]) -> \
+            Union[AmrFeatureSentence, Tuple[AmrFeatureSentence, ...]]:
+        if isinstance(ix, slice):
+            return tuple(map(self._get, range(*ix.indices(len(self)))))
+        if ix < 0:
+            ix += len(self)
+        if ix < 0 or ix >= len(self):
+            raise IndexError(f'Sentence index out of range: {ix}')
+        return self._get(ix)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+
+class AdmissionAmrLazyDocument(Writable):
+    """A view of an admission file written by :class:`.AdmissionAmrSerializer`
+    that reads only its header (note, section and paragraph indexes) when
+    created.  The file is memory mapped and sentences are decoded only when
+    the notes, sections or paragraphs that have them are created.  Instances
+    should be closed with :meth:`close` or used as a context manager.
+
+    """
+    def __init__(self, path: Path, serializer: AdmissionAmrSerializer):
+        self._file: BinaryIO = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header: Dict[str, Any] = serializer.read_header(self._file)
+        self._data = memoryview(self._mmap)[header['start']:]
+        self._sents = _LazySentences(serializer, self._data, header['offsets'])
+        notes: Tuple[_NoteIndex, ...] = header['notes']
+        self._ds_ix: _NoteIndex = notes[0]
+        self._ant_ixs: Tuple[_NoteIndex, ...] = notes[1:]
+        self._state: AdmissionAmrFeatureDocument = header['state']
+        self.parse_fails: Tuple[ParseFailure, ...] = header['parse_fails']
+        """Sentences who have parsed features, but the AMR parse failed."""
+
+    @property
+    def hadm_id(self) -> str:
+        """The MIMIC-III admission ID."""
+        return self._state.hadm_id
+
+    def create_discharge_summary(self) -> NoteDocument:
+        """Return the discharge summary note."""
+        return NoteDocument(self._sents, self._ds_ix)
+
+    def create_note_antecedents(self) -> Iterable[NoteDocument]:
+        """Return the clinical notes of the admission."""
+        return map(lambda note_ix: NoteDocument(self._sents, note_ix),
+                   self._ant_ixs)
+
+    def create_span_document(self, begin: int, end: int) -> \
+            AmrFeatureDocument:
+        """Decode only the sentences of a span and return them as a document.
+
+        :param begin: the 0-index sentence beginning
+
+        :param end: the sentence ending (exclusive)
+
+        """
+        return _create_span_doc(self._sents, begin, end)
+
+    def create_document(self) -> AdmissionAmrFeatureDocument:
+        """Decode all sentences and return the admission document."""
+        doc: AdmissionAmrFeatureDocument = copy.copy(self._state)
+        doc.sents = self._sents[:]
+        doc.amr = copy.copy(self._state.amr)
+        doc.amr.sents = tuple(map(lambda s: s.amr, doc.sents))
+        doc._ds_ix = self._ds_ix
+        doc._ant_ixs = self._ant_ixs
+        doc.parse_fails = self.parse_fails
+        return doc
+
+    def close(self):
+        """Release the memory map and close the file."""
+        if self._file is not None:
+            self._data.release()
+            self._mmap.close()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> AdmissionAmrLazyDocument:
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, depth: int = 0, writer: TextIOBase = sys.stdout):
+        self._write_line(f'hadm: {self.hadm_id}', depth, writer)
+        self._write_line('summary:', depth, writer)
+        self._write_object(self.create_discharge_summary(), depth + 1, writer)
+        self._write_line('antecedents:', depth, writer)
+        for note in self.create_note_antecedents():
+            self._write_object(note, depth + 1, writer)
+
+
+@dataclass
+class AdmissionAmrCompactStash(Stash):
+    """A stash that stores admissions in a directory, one file for each, in the
+    format of :class:`.AdmissionAmrSerializer`.  Use :meth:`load_lazy` to
+    access notes and sections without reading the entire admission.
+
+    """
+    path: Path = field()
+    """The directory of the admission files."""
+
+    serializer: AdmissionAmrSerializer = field(
+        default_factory=AdmissionAmrSerializer)
+    """Reads and writes the admission files."""
+
+    def _get_path(self, name: str) -> Path:
+        return self.path / f'{name}.camr'
+
+    def load(self, name: str) -> AdmissionAmrFeatureDocument:
+        path: Path = self._get_path(name)
+        if path.is_file():
+            with open(path, 'rb') as f:
+                return self.serializer.read(f)
+
+    def load_lazy(self, name: str) -> AdmissionAmrLazyDocument:
+        """Return a view of an admission that decodes only the sentences of
+        the notes and sections that are accessed.
+
+        :param name: the MIMIC-III admission ID
+
+        :return: the admission view, or ``None`` if it is not in the stash
+
+        """
+        path: Path = self._get_path(name)
+        if path.is_file():
+            return AdmissionAmrLazyDocument(path, self.serializer)
+
+    def exists(self, name: str) -> bool:
+        return self._get_path(name).is_file()
+
+    def dump(self, name: str, inst: AdmissionAmrFeatureDocument):
+        path: Path = self._get_path(name)
+        tmp_path: Path = path.parent / f'.{path.name}.{os.getpid()}.tmp'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file so readers never see a partial file
+        with open(tmp_path, 'wb') as f:
+            self.serializer.write(inst, f)
+        tmp_path.rename(path)
+
+    def delete(self, name: str = None):
+        path: Path = self._get_path(name)
+        if path.is_file():
+            path.unlink()
+
+    def keys(self) -> Iterable[str]:
+        if self.path.is_dir():
+            return map(lambda p: p.stem, self.path.glob('*.camr'))
+        return iter(())
+
+    def clear(self):
+        if self.path.is_dir():
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f'deleting: {self.path}')
+            shutil.rmtree(self.path)
@@ -0,0 +1,396 @@
+"""A local HTTP service that parses clinical text and admissions with models
+that stay loaded between requests.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import Tuple, List, Dict, Any, Optional, Iterable, ClassVar
+from dataclasses import dataclass, field
+import logging
+import json
+import re
+import queue
+import itertools as it
+import signal
+import threading
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from zensols.persist import Stash
+from zensols.nlp import LexicalSpan, FeatureDocument, FeatureDocumentParser
+from zensols.amr import AmrFeatureSentence, AmrFeatureDocument
+from zensols.mimic import Section, SectionContainer
+from zensols.mimic.regexnote import DischargeSummaryNote
+from .domain import ClinicAmrError
+from .parafac import ClinicAmrParagraphFactory
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _TextNote(SectionContainer):
+    """The text of a request with the sections of a discharge summary (see
+    :class:`~zensols.mimic.regexnote.DischargeSummaryNote`), or a single
+    section when none are found.
+
+    """
+    _SECTION_REGEX: ClassVar[Dict[str, re.Pattern]] = \
+        DischargeSummaryNote._SECTION_REGEX
+    _get_matches = DischargeSummaryNote._get_matches
+
+    text: str = field()
+    """The text of the request."""
+
+    doc: FeatureDocument = field()
+    """The parsed :obj:`text`."""
+
+    row_id: int = field(default=None)
+    """Text requests have no note ID."""
+
+    def _get_doc(self) -> FeatureDocument:
+        return self.doc
+
+    def _get_sections(self) -> Iterable[Section]:
+        # add to match on regexs that expect two newlines between sections
+        matches: Iterable[re.Match] = filter(
+            lambda m: m.end() - m.start() > 0,
+            self._get_matches(self.text + '\n\n'))
+        secs: List[Section] = list(map(
+            lambda x: Section(
+                id=x[0],
+                name=None,
+                container=self,
+                header_spans=(LexicalSpan(x[1].start(1), x[1].end(1)),),
+                body_span=LexicalSpan(x[1].start(2), x[1].end(2))),
+            enumerate(matches)))
+        if len(secs) == 0:
+            secs.append(Section(0, self.DEFAULT_SECTION_NAME, self, (),
+                                LexicalSpan(0, len(self.text))))
+        return secs
+
+
+@dataclass
+class ParseService(object):
+    """A localhost HTTP server that parses note text or loads admissions and
+    returns their AMR graphs, which have the CUI attributes added by
+    :obj:`paragraph_factory`.  The parser models are loaded once when the
+    service starts so each request takes only the parse time.
+
+    Requests are ``POST /parse`` with a JSON body that has either a ``text``
+    or ``hadm_id`` key and an optional ``format`` key of ``json`` (the
+    default) or ``penman``.  Request text is sectioned like a discharge
+    summary and chunked in to paragraphs by :obj:`paragraph_factory` as the
+    notes of admissions are.  Text requests that arrive within
+    :obj:`batch_timeout` seconds of each other are parsed together so their
+    sentences are sent to the SPRING server in as few requests as possible.
+    At most :obj:`max_concurrent` requests are processed at a time, and the
+    rest wait up to :obj:`request_timeout` seconds before they are refused.
+    ``GET /health`` returns the status of the service.
+
+    Admissions are loaded one at a time on the thread that calls
+    :meth:`serve`, which should be the main thread, since coreferences of
+    admissions that are not cached can not be resolved on a child thread
+    (see :meth:`.AdmissionAmrStash.load_current`).  Requests are served on
+    other threads.
+
+    The server stops on ``SIGINT`` or ``SIGTERM`` after the requests in
+    progress are finished.
+
+    """
+    paragraph_factory: ClinicAmrParagraphFactory = field()
+    """Parses, annotates and decorates the paragraphs of text requests."""
+
+    doc_parser: FeatureDocumentParser = field()
+    """Parses the text of requests before they are annotated with AMRs."""
+
+    adm_amr_stash: Stash = field()
+    """Loads the admissions of ``hadm_id`` requests."""
+
+    host: str = field(default='127.0.0.1')
+    """The address the server binds, which is only the local host by default.
+
+    """
+    port: int = field(default=8089)
+    """The port the server listens on."""
+
+    max_concurrent: int = field(default=4)
+    """The maximum number of requests processed at a time."""
+
+    batch_size: int = field(default=16)
+    """The maximum number of text requests parsed together."""
+
+    batch_timeout: float = field(default=0.05)
+    """The seconds to wait for more text requests to add to a batch."""
+
+    request_timeout: float = field(default=300)
+    """The seconds a request waits to be processed before it is refused."""
+
+    def __post_init__(self):
+        self._server: ThreadingHTTPServer = None
+        self._requests: queue.Queue = queue.Queue()
+        self._adm_requests: queue.Queue = queue.Queue()
+        self._limit = threading.BoundedSemaphore(self.max_concurrent)
+        self._stop = threading.Event()
+
+    def _get_batch(self) -> List[Tuple[str, Future]]:
+        """Wait on the next text request and return it with any others that
+        arrive within :obj:`batch_timeout` seconds.
+
+        """
+        batch: List[Tuple[str, Future]] = []
+        while len(batch) == 0 and not self._stop.is_set():
+            try:
+                batch.append(self._requests.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        while 0 < len(batch) < self.batch_size:
+            try:
+                batch.append(self._requests.get(timeout=self.batch_timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _chunk(self, text: str) -> Tuple[FeatureDocument, ...]:
+        """Parse, section and chunk the text of a request in to paragraphs."""
+        note = _TextNote(text, self.doc_parser(text))
+        return tuple(it.chain.from_iterable(
+            map(self.paragraph_factory.chunk, note.sections_ordered)))
+
+    def _parse_batch(self, batch: List[Tuple[str, Future]]):
+        """Parse the text of a batch of requests and set their results."""
+        paras: List[Optional[Tuple[FeatureDocument, ...]]] = []
+        text: str
+        fut: Future
+        for text, fut in batch:
+            try:
+                paras.append(self._chunk(text))
+            except Exception as e:
+                fut.set_exception(e)
+                paras.append(None)
+        self.paragraph_factory.prefetch(it.chain.from_iterable(
+            filter(lambda p: p is not None, paras)))
+        para: Tuple[FeatureDocument, ...]
+        for (text, fut), para in zip(batch, paras):
+            if para is not None:
+                try:
+                    fut.set_result(tuple(
+                        map(self.paragraph_factory.annotate, para)))
+                except Exception as e:
+                    fut.set_exception(e)
+
+    def _run_batches(self):
+        """Parse text requests in batches (the batch thread's target)."""
+        while not self._stop.is_set():
+            batch: List[Tuple[str, Future]] = self._get_batch()
+            if len(batch) > 0:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'parsing batch of {len(batch)} requests')
+                self._parse_batch(batch)
+        # refuse requests that were not batched before stopping
+        while not self._requests.empty():
+            self._requests.get()[1].set_exception(
+                ClinicAmrError('Service stopped'))
+
+    def parse_text(self, text: str) -> Tuple[AmrFeatureDocument, ...]:
+        """Parse text in the next batch and wait on the result.
+
+        :return: the paragraphs of the text
+
+        """
+        fut = Future()
+        self._requests.put((text, fut))
+        return fut.result()
+
+    def _load_admission(self, hadm_id: str) -> AmrFeatureDocument:
+        doc: AmrFeatureDocument = self.adm_amr_stash.load(str(hadm_id))
+        if doc is None:
+            raise ClinicAmrError(f'No such admission: {hadm_id}')
+        return doc
+
+    def _run_admissions(self, thread: threading.Thread):
+        """Load the requested admissions until ``thread`` exits."""
+        while thread.is_alive() or not self._adm_requests.empty():
+            hadm_id: str
+            fut: Future
+            try:
+                hadm_id, fut = self._adm_requests.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                fut.set_result(self._load_admission(hadm_id))
+            except Exception as e:
+                fut.set_exception(e)
+
+    def load_admission(self, hadm_id: str) -> AmrFeatureDocument:
+        """Load (and parse if not cached) an admission on the thread serving
+        requests and wait on the result.
+
+        """
+        fut = Future()
+        self._adm_requests.put((hadm_id, fut))
+        return fut.result()
+
+    def _get_sents(self, docs: Tuple[AmrFeatureDocument, ...]) -> \
+            Iterable[AmrFeatureSentence]:
+        return it.chain.from_iterable(map(lambda d: d.sents, docs))
+
+    def _to_json(self, docs: Tuple[AmrFeatureDocument, ...]) -> \
+            Dict[str, Any]:
+        def map_sent(sent: AmrFeatureSentence) -> Dict[str, Any]:
+            return {'text': sent.norm, 'graph': sent.amr.graph_string}
+
+        dct: Dict[str, Any] = {
+            'sents': list(map(map_sent, self._get_sents(docs)))}
+        hadm_id: str = getattr(docs[0], 'hadm_id', None) \
+            if len(docs) > 0 else None
+        if hadm_id is not None:
+            dct['hadm_id'] = str(hadm_id)
+        return dct
+
+    def _to_penman(self, docs: Tuple[AmrFeatureDocument, ...]) -> str:
+        return '\n\n'.join(map(lambda s: s.amr.graph_string,
+                                self._get_sents(docs)))
+
+    def process(self, req: Dict[str, Any]) -> Tuple[str, str]:
+        """Process a parse request.
+
+        :param req: the request with either a ``text`` or ``hadm_id`` key and
+                    an optional ``format`` key
+
+        :return: the response content type and body
+
+        """
+        fmt: str = req.get('format', 'json')
+        if fmt not in {'json', 'penman'}:
+            raise ClinicAmrError(f'Unknown format: {fmt}')
+        docs: Tuple[AmrFeatureDocument, ...]
+        if 'text' in req:
+            docs = self.parse_text(req['text'])
+        elif 'hadm_id' in req:
+            docs = (self.load_admission(req['hadm_id']),)
+        else:
+            raise ClinicAmrError("Expecting a 'text' or 'hadm_id' key")
+        if fmt == 'penman':
+            return 'text/plain', self._to_penman(docs)
+        else:
+            return 'application/json', json.dumps(self._to_json(docs))
+
+    def _create_handler(self) -> type:
+        service: ParseService = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, status: HTTPStatus, ctype: str, body: str):
+                data: bytes = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', f'{ctype}; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _error(self, status: HTTPStatus, msg: str):
+                self._respond(status, 'application/json',
+                              json.dumps({'error': msg}))
+
+            def do_GET(self):
+                if self.path == '/health':
+                    self._respond(HTTPStatus.OK, 'application/json',
+                                  json.dumps({'status': 'ok'}))
+                else:
+                    self._error(HTTPStatus.NOT_FOUND, f'No path: {self.path}')
+
+            def do_POST(self):
+                if self.path != '/parse':
+                    self._error(HTTPStatus.NOT_FOUND, f'No path: {self.path}')
+                    return
+                try:
+                    n_bytes = int(self.headers.get('Content-Length', 0))
+                    req: Dict[str, Any] = json.loads(self.rfile.read(n_bytes))
+                except Exception as e:
+                    self._error(HTTPStatus.BAD_REQUEST, f'Bad request: {e}')
+                    return
+                if not service._limit.acquire(
+                        timeout=service.request_timeout):
+                    self._error(HTTPStatus.SERVICE_UNAVAILABLE,
+                                'Too many requests')
+                    return
+                try:
+                    self._respond(HTTPStatus.OK, *service.process(req))
+                except ClinicAmrError as e:
+                    self._error(HTTPStatus.BAD_REQUEST, str(e))
+                except Exception as e:
+                    logger.exception(f'Could not process {req}: {e}')
+                    self._error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+                finally:
+                    service._limit.release()
+
+            def log_message(self, format: str, *args):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(format % args)
+
+        return Handler
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """The host and port the server is bound to after :meth:`start`."""
+        return self._server.server_address[:2]
+
+    def start(self):
+        """Bind the server and start the batch thread without serving."""
+        self._stop.clear()
+        self._server = ThreadingHTTPServer(
+            (self.host, self.port), self._create_handler())
+        # wait on requests in progress when the server closes
+        self._server.daemon_threads = False
+        self._server.block_on_close = True
+        self._batch_thread = threading.Thread(
+            target=self._run_batches, name='parse-service-batch')
+        self._batch_thread.start()
+
+    def stop(self):
+        """Stop accepting requests, finish those in progress and then stop the
+        batch thread.
+
+        """
+        server: ThreadingHTTPServer = self._server
+        if server is not None:
+            server.shutdown()
+
+    def _close(self):
+        # wait on the requests in progress
+        self._server.server_close()
+        self._stop.set()
+        self._batch_thread.join()
+        self._server = None
+
+    def serve(self):
+        """Serve requests until ``SIGINT`` or ``SIGTERM`` is received."""
+        def handle_signal(signum: int, frame: Any):
+            logger.info(f'received signal {signum}, shutting down...')
+            threading.Thread(target=self.stop, daemon=True).start()
+
+        if self._server is None:
+            self.start()
+        prev: Dict[int, Any] = {}
+        if threading.current_thread() is threading.main_thread():
+            sig: int
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                prev[sig] = signal.signal(sig, handle_signal)
+        host, port = self.address
+        logger.info(f'serving on http://{host}:{port}')
+        serve_thread = threading.Thread(
+            target=self._server.serve_forever, name='parse-service-http')
+        serve_thread.start()
+        try:
+            self._run_admissions(serve_thread)
+        finally:
+            self.stop()
+            serve_thread.join()
+            # load admissions of requests in progress while they finish
+            close_thread = threading.Thread(
+                target=self._close, name='parse-service-close')
+            close_thread.start()
+            self._run_admissions(close_thread)
+            for sig, handler in prev.items():
+                signal.signal(sig, handler)
+        logger.info('service stopped')
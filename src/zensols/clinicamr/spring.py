@@ -1,15 +1,288 @@
 """Use the paper implementation of the SPRING parser.
 
 """
+from __future__ import annotations
 __author__ = 'Paul Landes'
 
-from typing import Tuple, Iterable
+from typing import (
+    TYPE_CHECKING, Tuple, List, Dict, Any, Union, Iterable, Sequence
+)
 from dataclasses import dataclass, field
-from spacy.tokens import Span
-from zensols.nlp import FeatureDocument, FeatureDocumentParser
+import logging
+import threading
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+from requests.models import Response
 from zensols.amr import AmrError, AmrFailure, AmrSentence
 from zensols.amr.model import AmrParser
-from zensols.amrspring import AmrPrediction, AmrParseClient
+from zensols.amrspring import (
+    AmrParseClient, AmrServiceError, AmrServiceRequestError
+)
+from .instrument import PipelineInstrument
+if TYPE_CHECKING:
+    # imported by the configuration when the parser is created
+    from spacy.tokens import Span, Doc
+    from zensols.nlp import FeatureDocument
+    from zensols.nlp.sparser import SpacyFeatureDocumentParser
+    from zensols.amrspring import AmrPrediction
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SentenceBatcher(object):
+    """Groups sentences, each with the origin it came from, into batches sent
+    to the parser in a single request.  A batch is closed when it has
+    :obj:`batch_size` sentences or when adding a sentence would exceed
+    :obj:`max_tokens`.
+
+    """
+    batch_size: int = field(default=64)
+    """The maximum number of sentences in a batch."""
+
+    max_tokens: int = field(default=None)
+    """The maximum number of (white space delimited) tokens in a batch, or
+    ``None`` to batch only by :obj:`batch_size`.
+
+    """
+    def batch(self, sents: Iterable[Tuple[Any, str]]) -> \
+            Iterable[Tuple[Tuple[Any, str], ...]]:
+        """Group sentences into batches.
+
+        :param sents: ``(<origin>, <sentence text>)`` tuples
+
+        :return: batches of the ``sents`` tuples in the order given
+
+        """
+        batch: List[Tuple[Any, str]] = []
+        toks: int = 0
+        item: Tuple[Any, str]
+        for item in sents:
+            n_toks: int = len(item[1].split())
+            if len(batch) > 0 and self.max_tokens is not None and \
+               toks + n_toks > self.max_tokens:
+                yield tuple(batch)
+                batch.clear()
+                toks = 0
+            batch.append(item)
+            toks += n_toks
+            if len(batch) >= self.batch_size:
+                yield tuple(batch)
+                batch.clear()
+                toks = 0
+        if len(batch) > 0:
+            yield tuple(batch)
+
+
+@dataclass
+class MimicMaskNormalizer(object):
+    """Removes MIMIC masks from sentences as they result in ``<pointer:0>``
+    type tokens from the SPRING parser.  Uncached sentences are batched through
+    the spaCy pipeline of :obj:`doc_parser` with only the components needed to
+    tokenize the masks and the normalized text is kept in a least recently
+    used cache, which avoids reparsing the heavily repeated templated text of
+    clinical notes.
+
+    """
+    doc_parser: SpacyFeatureDocumentParser = field()
+    """The parser with the MIMIC tokenizer component used to normalize."""
+
+    disable_components: Sequence[str] = field(default=('ner', 'lemmatizer'))
+    """The spaCy pipeline components not needed to create normalized text."""
+
+    batch_size: int = field(default=256)
+    """The number of sentences given to each spaCy pipeline batch."""
+
+    cache_size: int = field(default=100000)
+    """The maximum number of normalized sentences to cache."""
+
+    def __post_init__(self):
+        self._cache: Dict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _normalize(self, sents: Tuple[str, ...]) -> Iterable[str]:
+        """Parse and normalize sentences with the spaCy pipeline."""
+        sdocs: Iterable[Doc] = self.doc_parser.model.pipe(
+            sents,
+            batch_size=self.batch_size,
+            disable=self.disable_components)
+        sent: str
+        sdoc: Doc
+        for sent, sdoc in zip(sents, sdocs):
+            doc: FeatureDocument = self.doc_parser.from_spacy_doc(
+                sdoc, text=sent)
+            yield doc.norm
+
+    def __call__(self, sents: Iterable[str]) -> Tuple[str, ...]:
+        """Return the normalized text of sentences.
+
+        :param sents: the (unnormalized) sentence text
+
+        :return: the normalized text in the same order as ``sents``
+
+        """
+        sents = tuple(sents)
+        norms: Dict[str, str] = {}
+        with self._lock:
+            sent: str
+            for sent in sents:
+                norm: str = self._cache.get(sent)
+                if norm is not None:
+                    self._cache.move_to_end(sent)
+                    norms[sent] = norm
+        misses: Tuple[str, ...] = tuple(
+            filter(lambda s: s not in norms, dict.fromkeys(sents)))
+        if len(misses) > 0:
+            norms.update(zip(misses, self._normalize(misses)))
+            with self._lock:
+                for sent in misses:
+                    self._cache[sent] = norms[sent]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return tuple(map(lambda s: norms[s], sents))
+
+    def clear(self):
+        """Clear the normalized sentence cache."""
+        with self._lock:
+            self._cache.clear()
+
+
+@dataclass
+class _SessionAmrParseClient(AmrParseClient):
+    """A client that keeps its connection to the SPRING server open across
+    requests.  Instances are not thread safe.
+
+    """
+    def __post_init__(self):
+        self.session = requests.Session()
+
+    def _invoke(self, data: Dict[str, Any]):
+        endpoint: str = f'http://{self.host}:{self.port}/parse'
+        res: Response = self.session.post(endpoint, json=data)
+        if res.status_code != 200:
+            raise AmrServiceRequestError(data, res)
+        serv_res: Dict[str, Any] = res.json()
+        if 'error' in serv_res:
+            raise AmrServiceError(serv_res['error'])
+        return serv_res
+
+
+@dataclass
+class AsyncAmrParseClient(object):
+    """An :mod:`asyncio` adapter around
+    :class:`~zensols.amrspring.AmrParseClient` that keeps several requests in
+    flight at once.  Requests are run on a bounded pool of threads, each with
+    its own client and connection to the server, by an event loop in a
+    background thread so the caller can continue with (CPU bound) feature
+    parsing while the SPRING server works.  Failed requests are retried with
+    exponential backoff.
+
+    """
+    delegate: AmrParseClient = field()
+    """The client with the host and port of the SPRING server."""
+
+    pool_size: int = field(default=4)
+    """The maximum number of connections (threads) used for requests."""
+
+    max_in_flight: int = field(default=8)
+    """The maximum number of requests sent, or waiting to be retried, at a
+    time.
+
+    """
+    retries: int = field(default=3)
+    """The number of times to retry a failed request."""
+
+    backoff: float = field(default=0.5)
+    """The seconds to wait before the first retry, which doubles with each
+    subsequent retry.
+
+    """
+    def __post_init__(self):
+        self._loop: asyncio.AbstractEventLoop = None
+        self._lock = threading.Lock()
+        self._worker = threading.local()
+        self._clients: List[_SessionAmrParseClient] = []
+
+    def _init_worker(self):
+        """Create the client used by the calling pool thread."""
+        client = _SessionAmrParseClient(
+            host=self.delegate.host,
+            port=self.delegate.port)
+        with self._lock:
+            self._clients.append(client)
+        self._worker.client = client
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Lazily start the event loop thread."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size,
+                    thread_name_prefix='spring-client',
+                    initializer=self._init_worker)
+                self._in_flight = asyncio.Semaphore(self.max_in_flight)
+                thread = threading.Thread(
+                    target=loop.run_forever,
+                    name='spring-client-loop',
+                    daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    async def _parse(self, sents: Tuple[str, ...]) -> Tuple[AmrPrediction, ...]:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        async with self._in_flight:
+            attempt: int = 0
+            while True:
+                try:
+                    # run in the pool thread with that thread's client
+                    return await loop.run_in_executor(
+                        self._executor,
+                        lambda: tuple(self._worker.client.parse(sents)))
+                except Exception as e:
+                    if attempt >= self.retries:
+                        raise e
+                    delay: float = self.backoff * (2 ** attempt)
+                    logger.warning(f'SPRING request failed ({e}), retry ' +
+                                   f'{attempt + 1} in {delay}s')
+                    attempt += 1
+                    await asyncio.sleep(delay)
+
+    def submit(self, sents: Tuple[str, ...]) -> Future:
+        """Send sentences to the server without waiting on the response.
+
+        :param sents: the sentences to parse
+
+        :return: a future with the predictions in the order of ``sents``
+
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._parse(tuple(sents)), self._get_loop())
+
+    def parse(self, sents: Tuple[str, ...]) -> Iterable[AmrPrediction]:
+        """Parse sentences and wait on the response (see
+        :meth:`~zensols.amrspring.AmrParseClient.parse`).
+
+        """
+        return self.submit(sents).result()
+
+    def close(self):
+        """Stop the event loop, connection thread pool and connections."""
+        with self._lock:
+            loop: asyncio.AbstractEventLoop = self._loop
+            self._loop = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            # pool threads create their client with the lock held
+            self._executor.shutdown(wait=True)
+        with self._lock:
+            client: _SessionAmrParseClient
+            for client in self._clients:
+                client.session.close()
+            self._clients.clear()
 
 
 @dataclass
@@ -18,6 +291,16 @@ class SpringAmrParser(AmrParser):
     :class:`zensols.amr.model.AmrParser`.  This is to allow us to use the
     clinical notes trained THYME parser.
 
+    Sentences are sent to the server in batches (see :obj:`batcher`).  Callers
+    that know which sentences will be parsed, such as across all paragraphs of
+    a section, can send them in fewer requests with :meth:`prefetch`.  If
+    :obj:`client` is an :class:`.AsyncAmrParseClient`, the batches are sent
+    concurrently and :meth:`prefetch` returns without waiting on the server.
+
+    Instances are thread safe: threads may prefetch and parse at the same
+    time.  A thread's prefetched sentences might be parsed again if they are
+    evicted by another thread's prefetch before they are parsed.
+
     Citation:
 
       `Bevilacqua et al. (2021)`_ One SPRING to Rule Them Both: Symmetric AMR
@@ -28,21 +311,116 @@ class SpringAmrParser(AmrParser):
       .. _Bevilacqua et al. (2021): https://ojs.aaai.org/index.php/AAAI/article/view/17489
 
     """
-    client: AmrParseClient = field(default=None)
-    doc_parser: FeatureDocumentParser = field(default=None)
+    client: Union[AmrParseClient, AsyncAmrParseClient] = field(default=None)
+    """The client that sends requests to the SPRING server."""
 
-    def _parse_sents(self, sents: Iterable[Span]) -> Iterable[AmrSentence]:
-        def map_mimic(sent: Span) -> str:
-            """Remove MIMIC masks as they result in ``<pointer:0>`` type tokens
-            from the SPRING parser.
+    normalizer: MimicMaskNormalizer = field(default=None)
+    """Removes MIMIC masks from sentences before they are parsed."""
+
+    instrument: PipelineInstrument = field(default_factory=PipelineInstrument)
+    """Records the time spent normalizing and parsing sentences."""
+
+    batcher: SentenceBatcher = field(default_factory=SentenceBatcher)
+    """Groups sentences sent to the SPRING server in each request."""
+
+    _prefetched: Dict[str, Tuple[Future, int]] = field(
+        default_factory=dict, init=False, repr=False)
+    """Batch prediction futures and their sentence index of :meth:`prefetch`
+    keyed by normalized sentence text.
+
+    """
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False)
+    """Guards :obj:`_prefetched` across threads."""
+
+    def _submit(self, sent_strs: Iterable[str]) -> \
+            Iterable[Tuple[Future, Tuple[str, ...]]]:
+        """Send MIMIC mask normalized sentences to the server in batches.
+
+        :return: tuples of each batch's prediction future and its sentences
+
+        """
+        batch: Tuple[Tuple[Any, str], ...]
+        for batch in self.batcher.batch(map(lambda s: (None, s), sent_strs)):
+            strs: Tuple[str, ...] = tuple(map(lambda b: b[1], batch))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'parsing batch of {len(strs)} sentences')
+            fut: Future
+            if isinstance(self.client, AsyncAmrParseClient):
+                fut = self.client.submit(strs)
+            else:
+                fut = Future()
+                fut.set_result(tuple(self.client.parse(strs)))
+            yield (fut, strs)
 
-            """
-            doc: FeatureDocument = self.doc_parser(sent.text)
-            return doc.norm
+    def prefetch(self, sents: Iterable[str]):
+        """Parse sentences in as few requests as possible and keep the results
+        for subsequent calls to the parser.  Completed results of previous
+        prefetches are discarded.
 
-        sent_strs: Tuple[str] = tuple(map(map_mimic, sents))
+        :param sents: the sentence text that will be parsed
+
+        """
+        with self.instrument.measure('mimic_norm'):
+            sent_strs: Tuple[str, ...] = tuple(set(self.normalizer(sents)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'prefetching {len(sent_strs)} sentences')
+        batches: Tuple[Tuple[Future, Tuple[str, ...]], ...] = \
+            tuple(self._submit(sent_strs))
+        with self._lock:
+            # keep other threads' prefetches that are still in flight
+            done: Tuple[str, ...] = tuple(map(
+                lambda p: p[0], filter(lambda p: p[1][0].done(),
+                                       self._prefetched.items())))
+            sent: str
+            for sent in done:
+                del self._prefetched[sent]
+            fut: Future
+            strs: Tuple[str, ...]
+            for fut, strs in batches:
+                ix: int
+                for ix, sent in enumerate(strs):
+                    self._prefetched[sent] = (fut, ix)
+
+    def _get_prediction(self, sent: str,
+                        fetched: Dict[str, Tuple[Future, int]],
+                        preds: Dict[str, AmrPrediction]) -> AmrPrediction:
+        """Return a prediction from the prefetched results or ``preds``."""
+        prefetched: Tuple[Future, int] = fetched.get(sent)
+        if prefetched is None:
+            return preds[sent]
+        try:
+            return prefetched[0].result()[prefetched[1]]
+        except Exception:
+            # parse on its own if the prefetch batch request failed
+            with self._lock:
+                if self._prefetched.get(sent) is prefetched:
+                    del self._prefetched[sent]
+            return next(iter(self.client.parse((sent,))))
+
+    def _parse_sents(self, sents: Iterable[Span]) -> Iterable[AmrSentence]:
+        with self.instrument.measure('mimic_norm'):
+            sent_strs: Tuple[str, ...] = self.normalizer(
+                map(lambda s: s.text, sents))
+        # take the prefetched futures now so other threads' prefetches can
+        # not evict them while waiting on the server
+        with self._lock:
+            fetched: Dict[str, Tuple[Future, int]] = dict(filter(
+                lambda p: p[1] is not None,
+                map(lambda s: (s, self._prefetched.get(s)), sent_strs)))
+        missing: Tuple[str, ...] = tuple(filter(
+            lambda s: s not in fetched, sent_strs))
+        preds: Dict[str, AmrPrediction] = {}
+        nbytes: int = sum(map(lambda s: len(s.encode()), sent_strs))
+        with self.instrument.measure('spring_parse', nbytes):
+            fut: Future
+            strs: Tuple[str, ...]
+            for fut, strs in tuple(self._submit(missing)):
+                preds.update(zip(strs, fut.result()))
+            pred_sents: Tuple[AmrPrediction, ...] = tuple(map(
+                lambda s: self._get_prediction(s, fetched, preds), sent_strs))
         pred: AmrPrediction
-        for pred in self.client.parse(sent_strs):
+        for pred in pred_sents:
             if pred.is_error:
                 fail = AmrFailure(message=pred.error, sent=pred.sent)
                 yield AmrSentence(fail)
@@ -0,0 +1,203 @@
+"""Compact storage backends for the paragraph and admission caches.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Any, Tuple, List, Iterable, Optional
+from dataclasses import dataclass, field
+import logging
+import atexit
+import os
+import threading
+import pickle
+import shutil
+import sqlite3
+import zlib
+from pathlib import Path
+from zensols.persist import Stash
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ShardedSqliteStash(Stash):
+    """A stash that pickles its instances into a fixed number of SQLite
+    database files (shards) rather than a file per instance as
+    :class:`~zensols.persist.DirectoryStash` does.  This avoids creating
+    millions of files in full corpus runs, which makes clearing and listing
+    the cache slow.
+
+    Each shard has a single table indexed by key.  Connections are created per
+    process and thread, and the databases use write ahead logging so the
+    processes of :class:`~zensols.clinicamr.adm.AdmissionAmrBatchStash` can
+    write concurrently.  Shard databases are created on the first write to
+    them.  The connections of all threads are committed and closed by
+    :meth:`close`, which is also called when the process exits.
+
+    """
+    path: Path = field()
+    """The directory that has the shard database files."""
+
+    shards: int = field(default=16)
+    """The number of database files used to store the data."""
+
+    batch_size: int = field(default=1)
+    """The number of writes to a shard before they are committed.  Writes that
+    are not yet committed are only visible to the process and thread that
+    wrote them, and are committed with :meth:`flush` (by the thread that wrote
+    them) or :meth:`close`.  Other processes and threads can not write to the
+    shard until they are committed.
+
+    """
+    timeout: float = field(default=60)
+    """The seconds to wait on other processes' write locks."""
+
+    def __post_init__(self):
+        self._local = threading.local()
+        # the (process ID, connection) of all threads, which are closed by
+        # close; the generation is incremented so threads open new connections
+        self._opened: List[Tuple[int, sqlite3.Connection]] = []
+        self._opened_lock = threading.Lock()
+        self._generation: int = 0
+        atexit.register(self.close)
+
+    def _get_conns(self) -> List[sqlite3.Connection]:
+        """Return the shard connections of the current process and thread."""
+        local: threading.local = self._local
+        pid: int = os.getpid()
+        if getattr(local, 'pid', None) != pid or \
+           local.generation != self._generation:
+            # connections are not carried over from a forked process, or were
+            # closed by another thread
+            local.pid = pid
+            local.generation = self._generation
+            local.conns = [None] * self.shards
+            local.pending = [0] * self.shards
+        return local.conns
+
+    def _get_shard_path(self, shard: int) -> Path:
+        return self.path / f'shard-{shard:03d}.sqlite3'
+
+    def _get_existing_shards(self) -> Iterable[int]:
+        return filter(lambda s: self._get_shard_path(s).is_file(),
+                      range(self.shards))
+
+    def _get_conn(self, shard: int, create: bool = True) -> \
+            Optional[sqlite3.Connection]:
+        """Return the current thread's connection to a shard.
+
+        :param create: whether to create the shard database if it does not
+                       exist, otherwise ``None`` is returned for a missing shard
+
+        """
+        conns: List[sqlite3.Connection] = self._get_conns()
+        conn: sqlite3.Connection = conns[shard]
+        if conn is None:
+            path: Path = self._get_shard_path(shard)
+            if not create and not path.is_file():
+                return None
+            self.path.mkdir(parents=True, exist_ok=True)
+            # closed by the thread that calls close
+            conn = sqlite3.connect(
+                path, timeout=self.timeout, check_same_thread=False)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            conn.execute('create table if not exists stash ' +
+                         '(key text primary key, data blob) without rowid')
+            conn.commit()
+            conns[shard] = conn
+            with self._opened_lock:
+                self._opened.append((os.getpid(), conn))
+        return conn
+
+    def _get_shard(self, name: str) -> int:
+        # use a hash that is the same across processes
+        return zlib.crc32(str(name).encode()) % self.shards
+
+    def _write(self, shard: int, rows: List[Tuple[str, bytes]]):
+        conn: sqlite3.Connection = self._get_conn(shard)
+        conn.executemany(
+            'insert or replace into stash (key, data) values (?, ?)', rows)
+        pending: List[int] = self._local.pending
+        pending[shard] += len(rows)
+        if pending[shard] >= self.batch_size:
+            conn.commit()
+            pending[shard] = 0
+
+    def load(self, name: str) -> Any:
+        conn: sqlite3.Connection = self._get_conn(
+            self._get_shard(name), create=False)
+        if conn is not None:
+            row: Tuple[bytes] = conn.execute(
+                'select data from stash where key = ?',
+                (str(name),)).fetchone()
+            if row is not None:
+                return pickle.loads(row[0])
+
+    def exists(self, name: str) -> bool:
+        conn: sqlite3.Connection = self._get_conn(
+            self._get_shard(name), create=False)
+        return conn is not None and \
+            conn.execute('select 1 from stash where key = ?',
+                         (str(name),)).fetchone() is not None
+
+    def dump(self, name: str, inst: Any):
+        data: bytes = pickle.dumps(inst, protocol=pickle.HIGHEST_PROTOCOL)
+        self._write(self._get_shard(name), [(str(name), data)])
+
+    def delete(self, name: str = None):
+        shard: int = self._get_shard(name)
+        conn: sqlite3.Connection = self._get_conn(shard, create=False)
+        if conn is not None:
+            conn.execute('delete from stash where key = ?', (str(name),))
+            conn.commit()
+
+    def keys(self) -> Iterable[str]:
+        shard: int
+        for shard in self._get_existing_shards():
+            conn: sqlite3.Connection = self._get_conn(shard)
+            yield from map(lambda r: r[0], conn.execute(
+                'select key from stash').fetchall())
+
+    def __len__(self) -> int:
+        return sum(map(
+            lambda s: self._get_conn(s).execute(
+                'select count(*) from stash').fetchone()[0],
+            self._get_existing_shards()))
+
+    def flush(self):
+        """Commit the current thread's writes that are pending due to
+        :obj:`batch_size`.
+
+        """
+        shard: int
+        conn: sqlite3.Connection
+        for shard, conn in enumerate(self._get_conns()):
+            if conn is not None:
+                conn.commit()
+                self._local.pending[shard] = 0
+
+    def close(self):
+        """Commit pending writes and close the connections of all threads of
+        the current process, which must no longer be using this instance.
+
+        """
+        pid: int = os.getpid()
+        with self._opened_lock:
+            self._generation += 1
+            opened: List[Tuple[int, sqlite3.Connection]] = self._opened
+            self._opened = []
+        conn_pid: int
+        conn: sqlite3.Connection
+        for conn_pid, conn in opened:
+            # connections of a parent process belong to the parent
+            if conn_pid == pid:
+                conn.commit()
+                conn.close()
+
+    def clear(self):
+        self.close()
+        if self.path.is_dir():
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f'deleting: {self.path}')
+            shutil.rmtree(self.path)
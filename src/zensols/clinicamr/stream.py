@@ -0,0 +1,209 @@
+"""Stream admissions, notes, sections and paragraphs of the corpus.
+
+"""
+__author__ = 'Paul Landes'
+
+from typing import Tuple, Set, Iterable, Any, Union, Callable
+from dataclasses import dataclass, field
+import logging
+import threading
+import queue
+from zensols.persist import Stash
+from zensols.amr import AmrFeatureDocument
+from .domain import NoteDocument, SectionDocument, AdmissionAmrFeatureDocument
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Uncached(object):
+    """An admission to be loaded by the consumer of the stream."""
+    hadm_id: str = field()
+
+
+@dataclass
+class AdmissionParagraph(object):
+    """A paragraph of an admission's note with where it came from.
+
+    """
+    hadm_id: str = field()
+    """The MIMIC-III admission ID."""
+
+    row_id: int = field()
+    """The MIMIC-III unique row ID of the clinical note."""
+
+    category: str = field()
+    """The category of the note (i.e. ``discharge summary``)."""
+
+    sec_id: int = field()
+    """The :obj:`~zensols.mimic.note.Section.id`."""
+
+    sec_name: str = field()
+    """The :obj:`~zensols.mimic.note.Section.name`."""
+
+    para_idx: int = field()
+    """The index of the paragraph in the section."""
+
+    doc: AmrFeatureDocument = field()
+    """The paragraph's AMR document."""
+
+
+@dataclass
+class AdmissionStreamer(object):
+    """Iterates over the admissions of the corpus, or their notes, sections or
+    paragraphs, in admission ID order.  Admissions are loaded ahead of the
+    consumer on a background thread and at most :obj:`prefetch` are held
+    waiting so memory use stays constant over the corpus.
+
+    Admissions that are not yet cached, or must be rebuilt, are created on the
+    consumer's thread since coreferences can not be resolved on a child thread
+    (see :meth:`.AdmissionAmrStash.load_current`).
+
+    """
+    stash: Stash = field()
+    """The admission stash (see :class:`~.adm.AdmissionAmrStash`)."""
+
+    prefetch: int = field(default=2)
+    """The number of admissions loaded ahead of the consumer."""
+
+    hadm_ids: Tuple[str, ...] = field(default=None)
+    """The admissions to stream, or ``None`` for all of :obj:`stash`."""
+
+    note_categories: Set[str] = field(default=None)
+    """The note categories to keep (i.e. ``discharge-summary``), or ``None``
+    to keep all.
+
+    """
+    section_names: Set[str] = field(default=None)
+    """The section names to keep (i.e. ``hospital-course``), or ``None`` to
+    keep all.
+
+    """
+    def _get_keys(self) -> Iterable[str]:
+        if self.hadm_ids is not None:
+            return self.hadm_ids
+        return sorted(map(str, self.stash.keys()), key=lambda k: (len(k), k))
+
+    def _put(self, q: queue.Queue, stop: threading.Event, item: Any) -> bool:
+        """Add to the queue unless the consumer stopped.
+
+        :return: whether the item was added
+
+        """
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _load(self, q: queue.Queue, stop: threading.Event):
+        """Load admissions on to the queue (the background thread's target).
+        Admissions that can not be loaded from the cache are added as
+        :class:`._Uncached` so the consumer creates them.
+
+        """
+        load_current: Callable = getattr(self.stash, 'load_current', None)
+        try:
+            hadm_id: str
+            for hadm_id in self._get_keys():
+                if stop.is_set():
+                    break
+                item: Union[AdmissionAmrFeatureDocument, _Uncached]
+                if load_current is None:
+                    item = self.stash.load(hadm_id)
+                else:
+                    item = load_current(hadm_id)
+                    if item is None:
+                        item = _Uncached(hadm_id)
+                if item is None:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f'no admission: {hadm_id}')
+                elif not self._put(q, stop, item):
+                    break
+        except Exception as e:
+            self._put(q, stop, e)
+        finally:
+            self._put(q, stop, None)
+
+    def admissions(self) -> Iterable[AdmissionAmrFeatureDocument]:
+        """Return the admissions."""
+        q = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._load, args=(q, stop), daemon=True,
+            name='admission-stream')
+        thread.start()
+        try:
+            while True:
+                item: Union[AdmissionAmrFeatureDocument, _Uncached,
+                            Exception] = q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if isinstance(item, _Uncached):
+                    # not cached, so parse on this thread
+                    hadm_id: str = item.hadm_id
+                    item = self.stash.load(hadm_id)
+                    if item is None:
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(f'no admission: {hadm_id}')
+                        continue
+                yield item
+        finally:
+            # let the loader finish when the consumer stops early
+            stop.set()
+
+    @staticmethod
+    def _normalize(names: Set[str]) -> Set[str]:
+        # the admission's indexes use spaces in place of dashes
+        return None if names is None else \
+            set(map(lambda n: n.replace('-', ' '), names))
+
+    def notes(self) -> Iterable[Tuple[str, NoteDocument]]:
+        """Return ``(<hadm_id>, <note>)`` tuples with the discharge summary
+        of each admission first.
+
+        """
+        cats: Set[str] = self._normalize(self.note_categories)
+        adm: AdmissionAmrFeatureDocument
+        for adm in self.admissions():
+            note: NoteDocument
+            for note in (adm.create_discharge_summary(),) + \
+                    tuple(adm.create_note_antecedents()):
+                if cats is None or note.category in cats:
+                    yield (adm.hadm_id, note)
+
+    def sections(self) -> Iterable[Tuple[str, NoteDocument, SectionDocument]]:
+        """Return ``(<hadm_id>, <note>, <section>)`` tuples."""
+        names: Set[str] = self._normalize(self.section_names)
+        hadm_id: str
+        note: NoteDocument
+        for hadm_id, note in self.notes():
+            sec: SectionDocument
+            for sec in note.create_sections():
+                if names is None or sec.name in names:
+                    yield (hadm_id, note, sec)
+
+    def paragraphs(self) -> Iterable[AdmissionParagraph]:
+        """Return the paragraphs of the kept notes and sections."""
+        hadm_id: str
+        note: NoteDocument
+        sec: SectionDocument
+        for hadm_id, note, sec in self.sections():
+            pix: int
+            doc: AmrFeatureDocument
+            for pix, doc in enumerate(sec.create_paragraphs()):
+                yield AdmissionParagraph(
+                    hadm_id=hadm_id,
+                    row_id=note.row_id,
+                    category=note.category,
+                    sec_id=sec.id,
+                    sec_name=sec.name,
+                    para_idx=pix,
+                    doc=doc)
+
+    def __iter__(self) -> Iterable[AdmissionAmrFeatureDocument]:
+        return self.admissions()
@@ -0,0 +1,137 @@
+"""Incrementally write generated sentences to CSV or Parquet files.
+
+"""
+from __future__ import annotations
+__author__ = 'Paul Landes'
+
+from typing import List, Set
+from dataclasses import dataclass, field
+import logging
+import itertools as it
+from pathlib import Path
+import pandas as pd
+from zensols.cli import ApplicationError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GeneratedSentenceWriter(object):
+    """Appends the generated sentence data frame of each admission to a CSV or
+    Parquet (based on the :obj:`path` extension) file so that memory use does
+    not grow with the number of admissions and completed work survives a
+    failure.  When :obj:`resume` is ``True``, rows already in the file are
+    kept and :meth:`is_complete` indicates which admissions to skip.
+
+    Parquet output is a directory with a part file for each :meth:`flush`,
+    which is read as one table with :func:`pandas.read_parquet`.  Each part is
+    complete once written so a failure loses only the buffered rows, and
+    resuming reads only the admission ID column of each part.  Parquet output
+    needs :mod:`pyarrow`.
+
+    """
+    path: Path = field()
+    """The output file, which has either a ``.csv`` or ``.parquet`` extension,
+    or directory of part files for Parquet output.
+
+    """
+    resume: bool = field(default=False)
+    """Whether to keep the existing data in :obj:`path` rather than
+    overwriting it.
+
+    """
+    flush_rows: int = field(default=10000)
+    """The number of buffered rows that trigger a :meth:`flush`."""
+
+    def __post_init__(self):
+        self._is_parquet: bool = self.path.suffix == '.parquet'
+        if not self._is_parquet and self.path.suffix != '.csv':
+            raise ApplicationError(f'Unknown output file type: {self.path}')
+        self._dfs: List[pd.DataFrame] = []
+        self._n_buffered: int = 0
+        self._completed: Set[str] = set()
+        self._has_data: bool = False
+        self._n_parts: int = 0
+        if self._is_parquet and self.resume and self.path.is_file():
+            raise ApplicationError(
+                f'Expecting a directory of Parquet files: {self.path}')
+        if self.resume and self.path.exists():
+            self._completed = set(self._read_ids())
+            if self._is_parquet:
+                self._n_parts = len(self._get_parts())
+            self._has_data = True
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f'resuming {self.path} with ' +
+                            f'{len(self._completed)} admissions')
+
+    def _get_parts(self) -> List[Path]:
+        """Return the Parquet part files in the order they were written."""
+        return sorted(self.path.glob('part-*.parquet'))
+
+    def _read_ids(self) -> List[str]:
+        """Return the admission IDs in the existing output file."""
+        if self._is_parquet:
+            return list(it.chain.from_iterable(map(
+                lambda p: pd.read_parquet(p, columns=['hadm_id'])['hadm_id'].
+                astype(str), self._get_parts())))
+        else:
+            return pd.read_csv(self.path, usecols=['hadm_id'], dtype=str)[
+                'hadm_id'].tolist()
+
+    def is_complete(self, hadm_id: str) -> bool:
+        """Whether the admission's sentences are already in the output."""
+        return str(hadm_id) in self._completed
+
+    def write(self, df: pd.DataFrame):
+        """Add the generated sentences of an admission."""
+        self._dfs.append(df)
+        self._n_buffered += len(df)
+        if self._n_buffered >= self.flush_rows:
+            self.flush()
+
+    def _write_parquet(self, df: pd.DataFrame):
+        """Write the next part file, which is renamed in to place once written
+        so partially written parts are never read.
+
+        """
+        if not self._has_data:
+            # overwrite the previous output
+            if self.path.is_file():
+                self.path.unlink()
+            part: Path
+            for part in self._get_parts():
+                part.unlink()
+            self.path.mkdir(parents=True, exist_ok=True)
+        part = self.path / f'part-{self._n_parts:05d}.parquet'
+        tmp: Path = part.with_suffix('.tmp')
+        df.to_parquet(tmp, index=False)
+        tmp.replace(part)
+        self._n_parts += 1
+
+    def flush(self):
+        """Write the buffered rows to the output file."""
+        if len(self._dfs) == 0:
+            return
+        df: pd.DataFrame = pd.concat(self._dfs, ignore_index=True)
+        self._dfs.clear()
+        self._n_buffered = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self._is_parquet:
+            self._write_parquet(df)
+        else:
+            df.to_csv(self.path, mode='a' if self._has_data else 'w',
+                      header=not self._has_data, index=False)
+        self._has_data = True
+        self._completed.update(df['hadm_id'].astype(str))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'wrote {len(df)} rows to {self.path}')
+
+    def close(self):
+        """Flush the buffered rows."""
+        self.flush()
+
+    def __enter__(self) -> GeneratedSentenceWriter:
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -1,13 +1,49 @@
+import unittest
 import logging
+import pickle
+import copy
 from io import StringIO
 from pathlib import Path
 from zensols.clinicamr.adm import AdmissionAmrFactoryStash
+from zensols.clinicamr.stream import AdmissionStreamer
+from zensols.clinicamr.serial import (
+    AdmissionAmrSerializer, AdmissionAmrCompactStash
+)
+from zensols.amr import AmrDocument
 from zensols.clinicamr import AdmissionAmrFeatureDocument
+from zensols.clinicamr.domain import _NoteIndex
 from util import TestBase
 
 logger = logging.getLogger(__name__)
 
 
+class TestAdmissionPickle(unittest.TestCase):
+    def _adm(self) -> AdmissionAmrFeatureDocument:
+        return AdmissionAmrFeatureDocument(
+            sents=(),
+            amr=AmrDocument(()),
+            hadm_id='1',
+            _ds_ix=_NoteIndex(1, 'discharge summary', ()),
+            _ant_ixs=())
+
+    def test_new_admission(self):
+        # an admission that never accessed its span index
+        adm: AdmissionAmrFeatureDocument = self._adm()
+        self.assertFalse('_span_index_memo' in adm.__dict__)
+        adm2 = pickle.loads(pickle.dumps(adm))
+        self.assertEqual('1', adm2.hadm_id)
+        self.assertEqual(adm._ds_ix, adm2._ds_ix)
+        adm3 = copy.copy(adm)
+        self.assertEqual('1', adm3.hadm_id)
+        self.assertEqual(AdmissionAmrSerializer().loads(
+            AdmissionAmrSerializer().dumps(adm))._ds_ix, adm._ds_ix)
+        # the memoized index is not copied
+        adm.__dict__['_span_index_memo'] = object()
+        self.assertFalse(
+            '_span_index_memo' in pickle.loads(pickle.dumps(adm)).__dict__)
+        self.assertFalse('_span_index_memo' in copy.copy(adm).__dict__)
+
+
 class TestAdmissionGraph(TestBase):
     """This test takes a long time and easily fails given the large comparison
     it makes.
@@ -25,6 +61,26 @@ class TestAdmissionGraph(TestBase):
         if self._validate_db_exists():
             self._test_pickle()
 
+    def test_lazy(self):
+        if self._validate_db_exists():
+            self._test_lazy()
+
+    def test_rebuild(self):
+        if self._validate_db_exists():
+            self._test_rebuild()
+
+    def test_span_index(self):
+        if self._validate_db_exists():
+            self._test_span_index()
+
+    def test_fingerprint(self):
+        if self._validate_db_exists():
+            self._test_fingerprint()
+
+    def test_stream(self):
+        if self._validate_db_exists():
+            self._test_stream()
+
     def _get_adm(self) -> AdmissionAmrFeatureDocument:
         stash: AdmissionAmrFactoryStash = self.config_factory(
             'camr_adm_amr_factory_stash')
@@ -62,3 +118,139 @@ class TestAdmissionGraph(TestBase):
         adm2.write(writer=sio)
         actual: str = sio.getvalue()
         self.assertEqual(should, actual)
+
+        # indexes and failures are shared by clones
+        clone = adm.clone()
+        self.assertEqual(adm, clone)
+        self.assertIs(adm._ds_ix, clone._ds_ix)
+        self.assertIs(adm._ant_ixs, clone._ant_ixs)
+        self.assertIs(adm.parse_fails, clone.parse_fails)
+
+        ser = AdmissionAmrSerializer()
+        data: bytes = ser.dumps(adm)
+        adm3 = ser.loads(data)
+        self.assertNotEqual(id(adm), id(adm3))
+        self.assertEqual(adm, adm3)
+        self.assertEqual(adm._ds_ix, adm3._ds_ix)
+        self.assertEqual(adm._ant_ixs, adm3._ant_ixs)
+        self.assertTrue(len(data) < len(pickle.dumps(adm)))
+
+        sio = StringIO()
+        adm3.write(writer=sio)
+        actual: str = sio.getvalue()
+        self.assertEqual(should, actual)
+
+    def _test_lazy(self):
+        adm: AdmissionAmrFeatureDocument = self._get_adm()
+        stash = AdmissionAmrCompactStash(Path('target/adm-compact'))
+        stash.dump(adm.hadm_id, adm)
+        with stash.load_lazy(adm.hadm_id) as lazy:
+            ds_should = adm.create_discharge_summary().create_document()
+            ds = lazy.create_discharge_summary().create_document()
+            self.assertEqual(ds_should, ds)
+            # only the discharge summary sentences are decoded
+            self.assertEqual(len(ds), len(lazy._sents._sents))
+            sio = StringIO()
+            adm.write(writer=sio)
+            should: str = sio.getvalue()
+            sio = StringIO()
+            lazy.write(writer=sio)
+            self.assertEqual(should, sio.getvalue())
+            self.assertEqual(adm, lazy.create_document())
+
+    def _test_rebuild(self):
+        stash = self.config_factory('camr_adm_amr_stash')
+        fac: AdmissionAmrFactoryStash = stash.factory
+        adm: AdmissionAmrFeatureDocument = stash.load('151608')
+        info = adm.build_info
+        self.assertTrue(info.is_selection(
+            fac.keep_notes, fac.keep_summary_sections))
+        # the keys are those of the paragraph cache
+        para_stash = fac.paragraph_factory.stash
+        self.assertTrue(all(map(para_stash.exists, info.para_keys)))
+        self.assertEqual(adm, stash.load('151608'))
+        # keep fewer sections so the sentences (and coreferences) change
+        sec_names = set(map(lambda s: s.name,
+                            adm.create_discharge_summary().create_sections()))
+        keep = frozenset(filter(
+            lambda n: n.replace('-', ' ') in sec_names,
+            fac.keep_summary_sections))
+        keep = frozenset(sorted(keep)[:1])
+        fac.keep_summary_sections = keep
+        adm2: AdmissionAmrFeatureDocument = stash.load('151608')
+        self.assertEqual(keep, adm2.build_info.keep_summary_sections)
+        self.assertTrue(len(adm2.build_info.para_keys) < len(info.para_keys))
+        self.assertTrue(len(adm2) < len(adm))
+        self.assertEqual(set(map(lambda n: n.replace('-', ' '), keep)),
+                         set(map(lambda s: s.name, adm2.
+                                 create_discharge_summary().
+                                 create_sections())))
+        # the cache is updated with the rebuilt admission
+        self.assertEqual(
+            keep, stash.delegate.load('151608').build_info.
+            keep_summary_sections)
+
+    def _test_fingerprint(self):
+        stash = self.config_factory('camr_adm_amr_stash')
+        fac: AdmissionAmrFactoryStash = stash.factory
+        para_fac = fac.paragraph_factory
+        adm: AdmissionAmrFeatureDocument = stash.load('151608')
+        fp = adm.build_info.fingerprint
+        self.assertEqual(para_fac.fingerprint, fp)
+        # change only the CUI format so the graphs are decorated again
+        dec = next(filter(lambda d: d.name == 'cui-id',
+                          para_fac.parse_annotator.document_decorators))
+        dec.feature_format = '{cui_}'
+        dec._formatted.clear()
+        dec.__dict__.pop('_format_ids', None)
+        para_fac.__dict__.pop('_fingerprint', None)
+        adm2: AdmissionAmrFeatureDocument = stash.load('151608')
+        fp2 = adm2.build_info.fingerprint
+        self.assertNotEqual(fp, fp2)
+        self.assertTrue(fp2.is_parse(fp))
+        self.assertEqual(adm.build_info.para_keys, adm2.build_info.para_keys)
+        self.assertEqual(adm.coreference_relations,
+                         adm2.coreference_relations)
+        # the cache is updated with the decorated admission
+        self.assertEqual(fp2, stash.delegate.load('151608').build_info.
+                         fingerprint)
+
+    def _test_span_index(self):
+        adm: AdmissionAmrFeatureDocument = self._get_adm()
+        ix = adm.span_index
+        ds = adm.create_discharge_summary()
+        # views are memoized
+        self.assertIs(ds, adm.create_discharge_summary())
+        self.assertIs(ds.create_document(), ds.create_document())
+        paras = []
+        ant_paras = []
+        for note in (ds,) + tuple(adm.create_note_antecedents()):
+            self.assertIs(note, ix.get_note(note.row_id))
+            for sec in note.create_sections():
+                for pix, para in enumerate(sec.create_paragraphs()):
+                    self.assertIs(para, ix.get_paragraph(
+                        note.row_id, sec.id, pix))
+                    paras.append(para)
+                    if note is not ds:
+                        ant_paras.append(para)
+        self.assertEqual(paras, list(ix.find_paragraphs()))
+        self.assertEqual(ant_paras, list(ix.find_paragraphs(antecedents=True)))
+        sec = next(iter(ds.create_sections()))
+        self.assertEqual(
+            list(sec.create_paragraphs()),
+            list(ix.find_paragraphs(sec_name=sec.name, antecedents=False)))
+        # the memoized index is not persisted
+        adm2 = self._pickle(adm)
+        self.assertFalse('_span_index_memo' in adm2.__dict__)
+        self.assertEqual(ds.create_document(),
+                         adm2.create_discharge_summary().create_document())
+
+    def _test_stream(self):
+        streamer: AdmissionStreamer = self.config_factory(
+            'camr_adm_amr_streamer')
+        streamer.stash.delegate.delete('151608')
+        streamer.hadm_ids = ('151608',)
+        adms = tuple(streamer)
+        self.assertEqual(1, len(adms))
+        # coreferences are resolved for admissions that were not cached
+        self.assertTrue(len(adms[0].coreference_relations) > 0)
@@ -0,0 +1,43 @@
+import unittest
+from types import SimpleNamespace
+from zensols.clinicamr.spring import SpringAmrParser
+from zensols.clinicamr.bench import (
+    StubAmrParseClient, SyntheticNoteFactory, BenchmarkResult
+)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_notes(self):
+        fac = SyntheticNoteFactory(seed=1, sections=3, paragraphs=2)
+        notes = tuple(fac.create(4))
+        self.assertEqual(4, len(notes))
+        self.assertEqual(notes, tuple(fac.create(4)))
+        for note in notes:
+            # the date line and two paragraphs in each section
+            self.assertEqual(1 + 3 * 2, len(note.split('\n\n')))
+            self.assertTrue('[**' in note)
+        self.assertNotEqual(notes, tuple(
+            SyntheticNoteFactory(seed=2, sections=3).create(4)))
+
+    def test_result(self):
+        res = BenchmarkResult('parser', 'cold', 2., sentences=10, paragraphs=4)
+        dct = res.asdict()
+        self.assertEqual(5., dct['sentences_per_sec'])
+        self.assertEqual(2., dct['paragraphs_per_sec'])
+        self.assertEqual(0, dct['admissions_per_sec'])
+
+    def test_stub_client(self):
+        parser = SpringAmrParser(
+            client=StubAmrParseClient(),
+            normalizer=lambda sents: tuple(sents))
+        texts = ('He was seen in the ED.', 'CXR showed "pneumonia".')
+        parser.prefetch(texts)
+        sents = tuple(parser._parse_sents(
+            map(lambda t: SimpleNamespace(text=t), texts)))
+        self.assertEqual(2, len(sents))
+        for text, sent in zip(texts, sents):
+            self.assertFalse(sent.is_failure)
+            self.assertEqual(text.replace('"', "'"), sent.metadata['snt'])
+            n_toks = str(len(text.split()))
+            self.assertEqual([('s', ':quant', n_toks)],
+                             sent.graph.attributes())
@@ -0,0 +1,26 @@
+import unittest
+from zensols.clinicamr.coref import NoteBlockCoreference
+
+
+class TestNoteBlockCoreference(unittest.TestCase):
+    def test_blocks(self):
+        blocker = NoteBlockCoreference(window=2)
+        blocks = blocker._get_blocks(((0, 5), (5, 6), (6, 12)))
+        self.assertEqual([(0, 5), (5, 6), (6, 12)], blocks)
+        self.assertEqual([(3, 6), (5, 8)], blocker._get_windows(blocks))
+        blocker = NoteBlockCoreference(window=0, max_block=4)
+        blocks = blocker._get_blocks(((0, 5), (5, 6), (6, 12)))
+        self.assertEqual([(0, 4), (4, 5), (5, 6), (6, 10), (10, 12)], blocks)
+        self.assertEqual([], blocker._get_windows(blocks))
+
+    def test_merge(self):
+        chains = (((0, 'p'), (2, 'h')),
+                  ((7, 'x'), (5, 'y')),
+                  ((2, 'h'), (4, 'z')),
+                  ((5, 'y'), (7, 'x')),
+                  ((9, 'a'),))
+        should = (((0, 'p'), (2, 'h'), (4, 'z')),
+                  ((5, 'y'), (7, 'x')))
+        self.assertEqual(should, NoteBlockCoreference._merge(chains))
+        self.assertEqual(should, NoteBlockCoreference._merge(
+            reversed(chains)))
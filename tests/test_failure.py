@@ -0,0 +1,74 @@
+import unittest
+import shutil
+import time
+from io import StringIO
+from pathlib import Path
+from zensols.persist import DirectoryStash
+from zensols.amr import AmrError
+from zensols.amrspring import AmrServiceError
+from zensols.clinicamr.domain import ClinicAmrError
+from zensols.clinicamr.failure import ParagraphFailureCache
+
+
+class TestParagraphFailureCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path('target/failure')
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+        self.stash = DirectoryStash(self.dir)
+
+    def tearDown(self):
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+
+    def _cache(self, **kwargs):
+        return ParagraphFailureCache(self.stash, parser_id='p1', **kwargs)
+
+    def test_version(self):
+        cache = self._cache()
+        self.assertIsNone(cache.get_skip('1-2-0'))
+        cache.add('1-2-0', 'bad text', AmrError('boom'))
+        fail = cache.get_skip('1-2-0')
+        self.assertEqual('AmrError: boom', fail.error)
+        self.assertEqual(1, fail.attempts)
+        fail = cache.add('1-2-0', 'bad text', AmrError('again'))
+        self.assertEqual(2, fail.attempts)
+        # a new parser retries
+        cache.parser_id = 'p2'
+        self.assertIsNone(cache.get_skip('1-2-0'))
+        cache.remove('1-2-0')
+        self.assertEqual(0, len(tuple(cache.failures())))
+
+    def test_policies(self):
+        cache = self._cache(retry_policy='never')
+        cache.add('k', 'text', AmrError('boom'))
+        cache.parser_id = 'p2'
+        self.assertIsNotNone(cache.get_skip('k'))
+        cache = self._cache(retry_policy='days', retry_days=1)
+        self.assertIsNotNone(cache.get_skip('k'))
+        fail = self.stash.load('k')
+        fail.created = time.time() - 2 * 86400
+        self.stash.dump('k', fail)
+        self.assertIsNone(cache.get_skip('k'))
+        with self.assertRaisesRegex(ClinicAmrError, 'Unknown retry'):
+            self._cache(retry_policy='always')
+
+    def test_not_parse_error(self):
+        cache = self._cache()
+        self.assertIsNone(cache.add('k', 'text', ConnectionError('down')))
+        self.assertIsNone(cache.add('k', 'text', ValueError('bug')))
+        self.assertIsNone(cache.get_skip('k'))
+        self.assertEqual(0, len(tuple(cache.failures())))
+
+    def test_report(self):
+        cache = self._cache()
+        cache.add('a', 'text a', AmrError('boom'))
+        cache.add('b', 'text b', AmrServiceError('x'))
+        stats = cache.get_stats()
+        self.assertEqual(2, stats['failures'])
+        self.assertEqual(0, stats['retry'])
+        self.assertEqual(1, stats['error: AmrServiceError'])
+        sio = StringIO()
+        cache.write(writer=sio, limit=1)
+        self.assertTrue(sio.getvalue().startswith('b: parser=p1'))
+        self.assertTrue('failures: 2' in sio.getvalue())
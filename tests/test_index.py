@@ -0,0 +1,77 @@
+import unittest
+import shutil
+from types import SimpleNamespace
+from pathlib import Path
+from zensols.nlp import FeatureToken
+from zensols.clinicamr.domain import _ParagraphIndex, _SectionIndex, _NoteIndex
+from zensols.clinicamr.index import AdmissionCorpusIndex
+
+
+class TestAdmissionCorpusIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path('target/index')
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+        self.index = AdmissionCorpusIndex(self.dir / 'index.sqlite3')
+
+    def tearDown(self):
+        self.index.clear()
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+
+    def _sent(self, *cuis):
+        toks = tuple(map(lambda c: SimpleNamespace(
+            is_concept=c != FeatureToken.NONE, cui_=c), cuis))
+        return SimpleNamespace(token_iter=lambda: iter(toks))
+
+    def _adm(self, hadm_id: str):
+        none = FeatureToken.NONE
+        ds = _NoteIndex(1, 'discharge summary', (
+            _SectionIndex(2, 'history of present illness', (
+                _ParagraphIndex((0, 2)),)),
+            _SectionIndex(3, 'discharge diagnosis', (
+                _ParagraphIndex((2, 3)), _ParagraphIndex((3, 4))))))
+        ant = _NoteIndex(5, 'nursing', (
+            _SectionIndex(2, 'history of present illness', (
+                _ParagraphIndex((4, 5)),)),))
+        sents = (self._sent('C1', none), self._sent(none),
+                 self._sent('C2', 'C1', 'C1'), self._sent(none),
+                 self._sent('C1'))
+        return SimpleNamespace(
+            hadm_id=hadm_id, _ds_ix=ds, _ant_ixs=(ant,), sents=sents)
+
+    def test_query(self):
+        self.index.add(self._adm('10'))
+        self.index.add(self._adm('11'))
+        # replaces the previous entries
+        self.index.add(self._adm('10'))
+        self.assertEqual({'admissions': 2, 'sections': 6, 'concepts': 8},
+                         self.index.get_stats())
+        spans = self.index.query(sec_name='history-of-present-illness')
+        self.assertEqual(4, len(spans))
+        self.assertEqual(('10', 1, 'discharge summary', 2), (
+            spans[0].hadm_id, spans[0].row_id, spans[0].category,
+            spans[0].sec_id))
+        self.assertEqual([(0, 2), (4, 5), (0, 2), (4, 5)],
+                         list(map(lambda s: s.span, spans)))
+        spans = self.index.query(
+            sec_name='history-of-present-illness', category='nursing')
+        self.assertEqual([('10', 5), ('11', 5)],
+                         list(map(lambda s: (s.hadm_id, s.row_id), spans)))
+        spans = self.index.query(cui='C1', category='discharge-summary')
+        self.assertEqual([(0, 1), (2, 3), (0, 1), (2, 3)],
+                         list(map(lambda s: s.span, spans)))
+        self.assertEqual('discharge diagnosis', spans[1].sec_name)
+        self.assertEqual(1, len(self.index.query(cui='C2', limit=1)))
+        self.index.delete('10')
+        self.assertEqual(1, self.index.get_stats()['admissions'])
+
+    def test_no_discharge_summary(self):
+        adm = self._adm('12')
+        adm._ds_ix = None
+        self.index.add(adm)
+        self.assertEqual({'admissions': 1, 'sections': 1, 'concepts': 1},
+                         self.index.get_stats())
+        spans = self.index.query(sec_name='history-of-present-illness')
+        self.assertEqual([('12', 5, (4, 5))], list(map(
+            lambda s: (s.hadm_id, s.row_id, s.span), spans)))
@@ -0,0 +1,83 @@
+import unittest
+import shutil
+import time
+from io import StringIO
+from pathlib import Path
+from zensols.clinicamr.instrument import PipelineInstrument
+
+
+class TestPipelineInstrument(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path('target/instrument')
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+
+    def tearDown(self):
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+
+    def test_disabled(self):
+        inst = PipelineInstrument()
+        with inst.measure('parse', 10):
+            pass
+        self.assertEqual({}, inst.stats)
+
+    def test_nested(self):
+        inst = PipelineInstrument(enabled=True)
+        with inst.measure('paragraph', len('héllo'.encode())):
+            for i in range(2):
+                with inst.measure('parse'):
+                    time.sleep(0.05)
+        with inst.measure('coref'):
+            time.sleep(0.05)
+        stats = inst.stats
+        self.assertEqual(1, stats['paragraph'].count)
+        self.assertEqual(6, stats['paragraph'].nbytes)
+        self.assertEqual(2, stats['parse'].count)
+        self.assertTrue(stats['parse'].wall >= 0.1)
+        self.assertTrue(stats['parse'].max_wall >= 0.05)
+        self.assertTrue(stats['paragraph'].wall >= stats['parse'].wall)
+        # the nested parse stages are not counted twice
+        self.assertAlmostEqual(
+            stats['paragraph'].wall + stats['coref'].wall, inst.total)
+
+    def test_trace(self):
+        path = self.dir / 'trace.jsonl'
+        prev = PipelineInstrument(enabled=True, trace_path=path)
+        with prev.measure('parse', 5):
+            pass
+        prev.flush()
+        inst = PipelineInstrument(enabled=True, trace_path=path)
+        for i in range(3):
+            with inst.measure('parse', 10):
+                time.sleep(0.01)
+        with inst.measure('coref'):
+            time.sleep(0.05)
+        self.assertEqual(3, inst.stats['parse'].count)
+        self.assertEqual(30, inst.stats['parse'].nbytes)
+        inst.flush()
+        inst.flush()
+        # only the last run is read
+        loaded = PipelineInstrument.from_trace(path)
+        self.assertEqual({'parse', 'coref'}, set(loaded.stats.keys()))
+        self.assertEqual(3, loaded.stats['parse'].count)
+        self.assertEqual(30, loaded.stats['parse'].nbytes)
+        self.assertAlmostEqual(inst.stats['parse'].wall,
+                               loaded.stats['parse'].wall)
+        self.assertAlmostEqual(inst.total, loaded.total)
+        loaded = PipelineInstrument.from_trace(path, prev.run_id)
+        self.assertEqual({'parse'}, set(loaded.stats.keys()))
+        self.assertEqual(1, loaded.stats['parse'].count)
+        self.assertEqual(5, loaded.stats['parse'].nbytes)
+        sio = StringIO()
+        inst.write(writer=sio)
+        lines = sio.getvalue().strip().split('\n')
+        self.assertEqual(3, len(lines))
+        # stages are sorted by descending time
+        stats = inst.stats
+        self.assertTrue(lines[0].startswith(
+            f'coref: {stats["coref"].wall:.2f}s, count=1, '))
+        self.assertTrue(lines[1].startswith(
+            f'parse: {stats["parse"].wall:.2f}s, count=3, '))
+        self.assertTrue(lines[1].endswith(', bytes=30'))
+        self.assertEqual(f'total: {inst.total:.2f}s', lines[2])
@@ -37,6 +37,65 @@ class TestParagraph(TestBase):
                 print(sent.amr.graph_only, file=writer)
             print('_' * 79, file=writer)
 
+    def _get_section(self, hadm_id: str) -> Section:
+        stash: Stash = self.config_factory('mimic_corpus').hospital_adm_stash
+        adm: HospitalAdmission = stash[hadm_id]
+        ds_note: Note = sorted(
+            adm.notes_by_category[DischargeSummaryNote.CATEGORY],
+            key=lambda n: n.chartdate, reverse=True)[0]
+        return ds_note.sections_by_name['history-of-present-illness'][0]
+
+    def test_fingerprint(self):
+        if not self._validate_db_exists():
+            return
+        fac = self.config_factory('camr_paragraph_factory')
+        sec: Section = self._get_section('134891')
+        paras: Tuple[AmrFeatureDocument] = tuple(fac.create(sec))
+        fp = fac.fingerprint
+        # change only the CUI format so the paragraphs are decorated again
+        dec = next(filter(lambda d: d.name == 'cui-id',
+                          fac.parse_annotator.document_decorators))
+        dec.feature_format = '{cui_}'
+        dec._formatted.clear()
+        dec.__dict__.pop('_format_ids', None)
+        fac.__dict__.pop('_fingerprint', None)
+        self.assertTrue(fac.fingerprint.is_parse(fp))
+        self.assertNotEqual(fp, fac.fingerprint)
+        paras2: Tuple[AmrFeatureDocument] = tuple(fac.create(sec))
+        self.assertEqual(len(paras), len(paras2))
+        for para, para2 in zip(paras, paras2):
+            for sent, sent2 in zip(para, para2):
+                cuis = tuple(filter(lambda a: a.role == ':cui-id',
+                                    sent2.amr.graph.attributes()))
+                self.assertTrue(all(map(lambda a: ' ' not in a.target, cuis)))
+                self.assertEqual(sent.amr.metadata['id'],
+                                 sent2.amr.metadata['id'])
+                self.assertEqual(len(sent.amr.graph.instances()),
+                                 len(sent2.amr.graph.instances()))
+            # decorated paragraphs are stamped with the new fingerprint
+            self.assertEqual(fac.fingerprint, para2.cache_fingerprint)
+
+    def test_settings(self):
+        from zensols.nlp.decorate import CopyFeatureTokenContainerDecorator
+        from zensols.clinicamr.domain import ClinicAmrError
+        from zensols.clinicamr.parafac import ClinicAmrParagraphFactory
+        fac = ClinicAmrParagraphFactory
+        dec = CopyFeatureTokenContainerDecorator(
+            feature_ids=(('idx', 'idx_abs'),))
+        settings = fac._get_settings(dec)
+        self.assertEqual(('CopyFeatureTokenContainerDecorator',
+                          ('feature_ids', (('idx', 'idx_abs'),))), settings)
+        # nested settings are part of the fingerprint
+        dec2 = CopyFeatureTokenContainerDecorator(
+            feature_ids=(('i', 'idx_abs'),))
+        self.assertNotEqual(fac._hash(settings),
+                            fac._hash(fac._get_settings(dec2)))
+        # sets are ordered so the hash is stable
+        self.assertEqual(fac._get_settings({'b', 'a'}),
+                         fac._get_settings({'a', 'b'}))
+        with self.assertRaises(ClinicAmrError):
+            fac._get_settings(object())
+
     def test_parse(self):
         hadm_id: str = '134891'
         if not self._validate_db_exists():
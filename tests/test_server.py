@@ -0,0 +1,119 @@
+import unittest
+import json
+import threading
+import urllib.request
+from urllib.error import HTTPError
+from zensols.clinicamr.server import ParseService
+
+
+class _Amr(object):
+    def __init__(self, text: str):
+        self.graph_string = f'# ::snt {text}\n(s / sentence)'
+
+
+class _Sent(object):
+    def __init__(self, text: str):
+        self.norm = text
+        self.amr = _Amr(text)
+
+
+class _Doc(object):
+    def __init__(self, text: str, hadm_id: str = None):
+        self.sents = tuple(map(_Sent, text.split('. ')))
+        if hadm_id is not None:
+            self.hadm_id = hadm_id
+
+
+class _ParagraphFactory(object):
+    def __init__(self):
+        self.batches = []
+
+    def chunk(self, sec):
+        return tuple(map(_Doc, filter(
+            lambda p: len(p) > 0, sec.body.strip().split('\n\n'))))
+
+    def prefetch(self, docs):
+        self.batches.append(len(tuple(docs)))
+
+    def annotate(self, doc):
+        return doc
+
+
+class _Stash(dict):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.threads = []
+
+    def load(self, name):
+        self.threads.append(threading.current_thread())
+        return self.get(name)
+
+
+class TestParseService(unittest.TestCase):
+    def setUp(self):
+        self.fac = _ParagraphFactory()
+        self.service = ParseService(
+            paragraph_factory=self.fac,
+            doc_parser=_Doc,
+            adm_amr_stash=_Stash({'1': _Doc('Admitted. Discharged', '1')}),
+            port=0,
+            batch_timeout=0.3)
+        self.service.start()
+        self.thread = threading.Thread(target=self.service.serve)
+        self.thread.start()
+        self.url = 'http://%s:%d' % self.service.address
+
+    def tearDown(self):
+        self.service.stop()
+        self.thread.join()
+
+    def _post(self, req):
+        hreq = urllib.request.Request(
+            f'{self.url}/parse', data=json.dumps(req).encode(),
+            headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(hreq) as res:
+            return res.read().decode()
+
+    def test_text(self):
+        res = json.loads(self._post({'text': 'He has flu. She is ok'}))
+        self.assertEqual(['He has flu', 'She is ok'],
+                         list(map(lambda s: s['text'], res['sents'])))
+        self.assertTrue(res['sents'][0]['graph'].endswith('(s / sentence)'))
+        res = self._post({'text': 'He has flu', 'format': 'penman'})
+        self.assertEqual('# ::snt He has flu\n(s / sentence)', res)
+
+    def test_sections(self):
+        text = ('HISTORY OF PRESENT ILLNESS:  He has flu\n\n' +
+                'HOSPITAL COURSE:  He was treated. He is ok\n\nHe left')
+        res = json.loads(self._post({'text': text}))
+        self.assertEqual(['He has flu', 'He was treated', 'He is ok'],
+                         list(map(lambda s: s['text'], res['sents'])))
+        self.assertEqual([2], self.fac.batches)
+
+    def test_admission(self):
+        res = json.loads(self._post({'hadm_id': 1}))
+        self.assertEqual('1', res['hadm_id'])
+        self.assertEqual(2, len(res['sents']))
+        # admissions are loaded on the thread that serves
+        self.assertEqual([self.thread], self.service.adm_amr_stash.threads)
+        with self.assertRaises(HTTPError) as cm:
+            self._post({'hadm_id': 2})
+        self.assertEqual(400, cm.exception.code)
+
+    def test_batch(self):
+        results = []
+        threads = list(map(
+            lambda i: threading.Thread(target=lambda: results.append(
+                self._post({'text': f'sentence {i}'}))),
+            range(4)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(4, len(results))
+        self.assertEqual(4, sum(self.fac.batches))
+        self.assertTrue(len(self.fac.batches) < 4)
+
+    def test_health(self):
+        with urllib.request.urlopen(f'{self.url}/health') as res:
+            self.assertEqual({'status': 'ok'}, json.loads(res.read()))
@@ -0,0 +1,121 @@
+import unittest
+import time
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zensols.amrspring import AmrParseClient, AmrServiceRequestError
+from zensols.clinicamr.spring import SentenceBatcher, AsyncAmrParseClient
+
+
+class TestSentenceBatcher(unittest.TestCase):
+    def _sents(self, n: int):
+        return tuple(map(lambda i: (i, f'sentence number {i}'), range(n)))
+
+    def test_batch_size(self):
+        batcher = SentenceBatcher(batch_size=3)
+        batches = tuple(batcher.batch(self._sents(7)))
+        self.assertEqual((3, 3, 1), tuple(map(len, batches)))
+        self.assertEqual(tuple(range(7)),
+                         tuple(map(lambda s: s[0], sum(batches, ()))))
+
+    def test_max_tokens(self):
+        batcher = SentenceBatcher(batch_size=100, max_tokens=7)
+        batches = tuple(batcher.batch(self._sents(5)))
+        self.assertEqual((2, 2, 1), tuple(map(len, batches)))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Stands in for the SPRING server by echoing sentences after failing
+    :obj:`fails` requests.
+
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.connections.add(self.client_address)
+            fail: bool = server.requests <= server.fails
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(server.delay)
+        if fail:
+            self._send(500, {})
+        else:
+            self._send(200, {'amrs': dict(map(
+                lambda s: (s[0], {'status': 'ok',
+                                  'graph': f'(p / parsed :snt "{s[1]}")'}),
+                enumerate(data['sents'])))})
+
+    def _send(self, status: int, res: dict):
+        body: bytes = json.dumps(res).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.connections = set()
+        self.server.fails = 0
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _client(self, **kwargs) -> AsyncAmrParseClient:
+        host, port = self.server.server_address
+        return AsyncAmrParseClient(AmrParseClient(host, port), **kwargs)
+
+    def test_ordered(self):
+        self.server.delay = 0.05
+        client = self._client(pool_size=4, max_in_flight=4)
+        try:
+            batches = tuple(map(lambda i: (f'a{i}', f'b{i}'), range(8)))
+            t0 = time.time()
+            futs = tuple(map(client.submit, batches))
+            preds = tuple(map(lambda f: f.result(), futs))
+            self.assertTrue((time.time() - t0) < 8 * 0.05)
+        finally:
+            client.close()
+        self.assertEqual(8, len(preds))
+        for batch, pred in zip(batches, preds):
+            self.assertEqual(2, len(pred))
+            self.assertEqual(batch, tuple(map(lambda p: p.sent, pred)))
+            self.assertTrue(f'"{batch[1]}"' in pred[1].graph)
+        # each pool thread reuses its own connection
+        self.assertEqual(8, self.server.requests)
+        self.assertTrue(1 < len(self.server.connections) <= 4)
+
+    def test_retry(self):
+        self.server.fails = 2
+        client = self._client(pool_size=1, retries=2, backoff=0.05)
+        try:
+            t0 = time.time()
+            self.assertEqual(1, len(client.parse(('a',))))
+            # backoff doubles: 0.05 + 0.1
+            self.assertTrue((time.time() - t0) >= 0.15)
+        finally:
+            client.close()
+        self.assertEqual(3, self.server.requests)
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_fail(self):
+        self.server.fails = 5
+        client = self._client(retries=1, backoff=0)
+        try:
+            with self.assertRaises(AmrServiceRequestError):
+                client.parse(('a',))
+        finally:
+            client.close()
+        self.assertEqual(2, self.server.requests)
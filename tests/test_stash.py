@@ -0,0 +1,67 @@
+import unittest
+import shutil
+import threading
+from pathlib import Path
+from zensols.clinicamr.stash import ShardedSqliteStash
+
+
+class TestShardedSqliteStash(unittest.TestCase):
+    def setUp(self):
+        self.path = Path('target/stash')
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
+
+    def tearDown(self):
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
+
+    def test_crud(self):
+        stash = ShardedSqliteStash(self.path, shards=3)
+        self.assertEqual(0, len(stash))
+        self.assertFalse(stash.exists('a'))
+        self.assertEqual(None, stash.load('a'))
+        stash.delete('a')
+        # reads do not create shard databases
+        self.assertFalse(self.path.exists())
+        stash.dump('a', {'x': 1})
+        for i in range(10):
+            stash.dump(str(i), (i, str(i)))
+        self.assertEqual(11, len(stash))
+        self.assertEqual({'x': 1}, stash.load('a'))
+        self.assertEqual((5, '5'), stash.load('5'))
+        self.assertEqual(set(['a'] + list(map(str, range(10)))),
+                         set(stash.keys()))
+        self.assertEqual(3, len(tuple(self.path.glob('*.sqlite3'))))
+        stash.delete('a')
+        self.assertFalse(stash.exists('a'))
+        stash.clear()
+        self.assertFalse(self.path.exists())
+        self.assertEqual(0, len(tuple(stash.keys())))
+
+    def test_batch(self):
+        stash = ShardedSqliteStash(self.path, shards=1, batch_size=5)
+        stash.dump('a', 1)
+        # uncommitted writes are not seen by a separate instance
+        self.assertFalse(ShardedSqliteStash(self.path, shards=1).exists('a'))
+        stash.close()
+        reader = ShardedSqliteStash(self.path, shards=1)
+        self.assertEqual(1, reader.load('a'))
+        reader.close()
+
+    def test_close_threads(self):
+        stash = ShardedSqliteStash(self.path, shards=2, batch_size=5)
+        thread = threading.Thread(target=lambda: stash.dump('a', 1))
+        thread.start()
+        thread.join()
+        # a shard has a single writer, so use a key of the other shard
+        stash.dump('d', 2)
+        # pending writes of all threads are committed
+        stash.close()
+        reader = ShardedSqliteStash(self.path, shards=2)
+        self.assertEqual(1, reader.load('a'))
+        self.assertEqual(2, reader.load('d'))
+        reader.close()
+        # the stash is usable after closing
+        stash.dump('c', 3)
+        stash.close()
+        self.assertEqual(3, ShardedSqliteStash(self.path, shards=2).load('c'))
@@ -0,0 +1,79 @@
+import unittest
+import time
+import threading
+from zensols.clinicamr.stream import AdmissionStreamer
+
+
+class _DictStash(object):
+    def __init__(self, data, fail: str = None, delay: float = 0):
+        self.data = data
+        self.fail = fail
+        self.delay = delay
+        self.loaded = []
+
+    def keys(self):
+        return self.data.keys()
+
+    def load(self, name):
+        time.sleep(self.delay)
+        if name == self.fail:
+            raise ValueError(f'bad admission: {name}')
+        self.loaded.append(name)
+        return self.data.get(name)
+
+
+class _CacheStash(_DictStash):
+    """Admissions in :obj:`cached` are returned by :meth:`load_current`."""
+    def __init__(self, data, cached):
+        super().__init__(data)
+        self.cached = cached
+        self.threads = {}
+
+    def load_current(self, name):
+        if name in self.cached:
+            return self.load(name)
+
+    def load(self, name):
+        self.threads[name] = threading.current_thread()
+        return super().load(name)
+
+
+class TestAdmissionStreamer(unittest.TestCase):
+    def setUp(self):
+        self.data = {'100': 'a', '12': 'b', '9': None, '30': 'c'}
+
+    def test_order(self):
+        streamer = AdmissionStreamer(_DictStash(self.data))
+        self.assertEqual(['b', 'c', 'a'], list(streamer))
+        streamer.hadm_ids = ('30', '9', '12')
+        self.assertEqual(['c', 'b'], list(streamer.admissions()))
+
+    def test_bounded(self):
+        stash = _DictStash(dict(map(lambda i: (str(i), i), range(20))))
+        streamer = AdmissionStreamer(stash, prefetch=2)
+        adms = streamer.admissions()
+        self.assertEqual(0, next(adms))
+        time.sleep(0.2)
+        # the consumed admission, the queued and the one waiting to be queued
+        self.assertEqual(4, len(stash.loaded))
+        adms.close()
+        time.sleep(0.2)
+        self.assertTrue(len(stash.loaded) < 6)
+
+    def test_error(self):
+        streamer = AdmissionStreamer(_DictStash(self.data, fail='30'))
+        adms = streamer.admissions()
+        self.assertEqual('b', next(adms))
+        with self.assertRaisesRegex(ValueError, 'bad admission: 30'):
+            next(adms)
+
+    def test_uncached(self):
+        stash = _CacheStash(self.data, cached={'12', '30'})
+        streamer = AdmissionStreamer(stash)
+        self.assertEqual(['b', 'c', 'a'], list(streamer))
+        main = threading.main_thread()
+        # uncached admissions are created (and resolved) on the main thread
+        self.assertEqual(main, stash.threads['100'])
+        self.assertEqual(main, stash.threads['9'])
+        self.assertNotEqual(main, stash.threads['12'])
+        self.assertNotEqual(main, stash.threads['30'])
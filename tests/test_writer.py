@@ -0,0 +1,67 @@
+import unittest
+import shutil
+import importlib.util
+from pathlib import Path
+import pandas as pd
+from zensols.clinicamr.writer import GeneratedSentenceWriter
+
+
+class TestGeneratedSentenceWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path('target/writer')
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+
+    def tearDown(self):
+        if self.dir.is_dir():
+            shutil.rmtree(self.dir)
+
+    def _df(self, hadm_id: str, n: int = 2) -> pd.DataFrame:
+        return pd.DataFrame(
+            map(lambda i: (hadm_id, i, f'org {i}', f'gen {i}'), range(n)),
+            columns='hadm_id sec_id org gen'.split())
+
+    def test_resume(self):
+        path = self.dir / 'gen.csv'
+        with GeneratedSentenceWriter(path, flush_rows=3) as writer:
+            writer.write(self._df('1'))
+            self.assertFalse(path.exists())
+            writer.write(self._df('2'))
+            self.assertTrue(path.exists())
+            writer.write(self._df('3'))
+        self.assertEqual(6, len(pd.read_csv(path)))
+        with GeneratedSentenceWriter(path, resume=True) as writer:
+            self.assertTrue(writer.is_complete('2'))
+            self.assertFalse(writer.is_complete('4'))
+            writer.write(self._df('4'))
+        df = pd.read_csv(path, dtype={'hadm_id': str})
+        self.assertEqual(['1', '2', '3', '4'], sorted(set(df['hadm_id'])))
+        self.assertEqual(8, len(df))
+        with GeneratedSentenceWriter(path) as writer:
+            self.assertFalse(writer.is_complete('2'))
+            writer.write(self._df('5'))
+        self.assertEqual(2, len(pd.read_csv(path)))
+
+    def test_parquet_resume(self):
+        if importlib.util.find_spec('pyarrow') is None:
+            self.skipTest('pyarrow is not installed')
+        path = self.dir / 'gen.parquet'
+        with GeneratedSentenceWriter(path, flush_rows=3) as writer:
+            writer.write(self._df('1'))
+            writer.write(self._df('2'))
+            # each flushed part is readable before the writer is closed
+            self.assertEqual(4, len(pd.read_parquet(path)))
+            writer.write(self._df('3'))
+        self.assertEqual(2, len(tuple(path.glob('part-*.parquet'))))
+        self.assertEqual(6, len(pd.read_parquet(path)))
+        with GeneratedSentenceWriter(path, resume=True) as writer:
+            self.assertTrue(writer.is_complete('2'))
+            self.assertFalse(writer.is_complete('4'))
+            writer.write(self._df('4'))
+        df = pd.read_parquet(path)
+        self.assertEqual(['1', '2', '3', '4'], sorted(set(df['hadm_id'])))
+        self.assertEqual(8, len(df))
+        with GeneratedSentenceWriter(path) as writer:
+            self.assertFalse(writer.is_complete('2'))
+            writer.write(self._df('5'))
+        self.assertEqual(2, len(pd.read_parquet(path)))